@@ -0,0 +1,90 @@
+"""
+Benchmark the per-message cost of building the runnable callbacks of
+ChatApp: reused session and process callbacks, against building all of
+them for each message as before.
+
+Langfuse is included when it is installed and LANGFUSE_SECRET_KEY is set,
+events are not sent as no run goes through the callbacks.
+
+Usage (with the environment of the app, LLM_PROFILES etc.):
+    PYTHONPATH=src python scripts/bench_callback_setup.py \
+        --sessions 100 --messages 20
+"""
+
+import argparse
+import asyncio
+import os
+import time
+
+import chainlit as cl
+from chainlit.context import init_http_context
+
+from apps.chat import chat_app
+from apps.handlers import AnswerCallbackHandler
+
+
+def legacy_callbacks(app: chat_app.ChatApp):
+    """Callbacks built from scratch for each message"""
+    callbacks = [cl.AsyncLangchainCallbackHandler()]
+    try:
+        if os.getenv("LANGFUSE_SECRET_KEY"):
+            from langfuse.callback import CallbackHandler
+
+            callbacks.append(CallbackHandler())
+    except Exception:
+        pass
+
+    callbacks.append(
+        AnswerCallbackHandler(
+            on_message_complete=app.add_message_to_memory,
+            output_validator=(
+                chat_app.validate_output
+                if app.output_guardrails
+                and "sentinel" in app.get_llm_profile().name.lower()
+                else None
+            ),
+            flush_interval=app.stream_flush_interval,
+            flush_size=app.stream_flush_size,
+        )
+    )
+    return callbacks
+
+
+async def run(
+    app: chat_app.ChatApp, sessions: int, messages: int, legacy: bool
+):
+    wall = 0.0
+    cpu = 0.0
+
+    for _ in range(sessions):
+        init_http_context()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for _ in range(messages):
+            if legacy:
+                legacy_callbacks(app)
+            else:
+                app.get_runnable_callbacks()
+        wall += time.perf_counter() - wall_start
+        cpu += time.process_time() - cpu_start
+
+    turns = sessions * messages
+    print(
+        f"{'legacy' if legacy else 'reused':<7} "
+        f"wall/message={wall / turns * 1e6:9.1f}us "
+        f"cpu/message={cpu / turns * 1e6:9.1f}us"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+
+    app = chat_app.ChatApp(output_guardrails=True)
+    for legacy in (True, False):
+        asyncio.run(run(app, args.sessions, args.messages, legacy))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Micro-benchmark of the per-token overhead of the two execution modes of
+BaseChainlitApp.run_runnable: "events" (astream_events) and "lean" (astream).
+
+A fake chat model streams tokens with no delay into the same prompt | llm
+chain the chat app uses, with a token-counting callback standing in for
+AnswerCallbackHandler.
+
+Usage:
+    python scripts/bench_execution_mode.py --tokens 2000 --runs 5
+"""
+
+import argparse
+import asyncio
+import time
+from typing import Any
+from typing import AsyncIterator
+from typing import List
+from typing import Optional
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessageChunk
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.outputs import ChatResult
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
+
+
+class FakeStreamingChatModel(BaseChatModel):
+    """Streams `tokens` tokens natively in async, with no delay"""
+
+    tokens: int
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-streaming"
+
+    def _generate(self, messages: List[BaseMessage], *args, **kwargs):
+        content = "".join(f" tok{i}" for i in range(self.tokens))
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))]
+        )
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        for i in range(self.tokens):
+            chunk = ChatGenerationChunk(
+                message=AIMessageChunk(content=f" tok{i}")
+            )
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+class TokenCounter(AsyncCallbackHandler):
+    def __init__(self):
+        self.tokens = 0
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens += 1
+
+
+def build_runnable(tokens: int):
+    prompt = ChatPromptTemplate.from_messages([("placeholder", "{messages}")])
+    llm = FakeStreamingChatModel(tokens=tokens)
+    return (prompt | llm).with_config({"run_name": "bench"})
+
+
+async def run_events(runnable, config: RunnableConfig):
+    async for _ in runnable.astream_events(
+        {"messages": [("user", "hi")]},
+        version="v2",
+        config=config,
+        include_names=["bench"],
+    ):
+        pass
+
+
+async def run_lean(runnable, config: RunnableConfig):
+    async for _ in runnable.astream(
+        {"messages": [("user", "hi")]}, config=config
+    ):
+        pass
+
+
+async def bench(mode: str, tokens: int, runs: int):
+    run = run_events if mode == "events" else run_lean
+    elapsed = 0.0
+    streamed = 0
+
+    for _ in range(runs):
+        counter = TokenCounter()
+        runnable = build_runnable(tokens)
+
+        start = time.perf_counter()
+        await run(runnable, RunnableConfig(callbacks=[counter]))
+        elapsed += time.perf_counter() - start
+        streamed += counter.tokens
+
+    print(
+        f"{mode:<7} tokens/run={streamed // runs:<6} "
+        f"per-token={elapsed / streamed * 1e6:8.1f}us "
+        f"per-run={elapsed / runs * 1000:8.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for mode in ("events", "lean"):
+        asyncio.run(bench(mode, args.tokens, args.runs))
+
+
+if __name__ == "__main__":
+    main()
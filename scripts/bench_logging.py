@@ -0,0 +1,120 @@
+"""
+Measure the logging cost of a chat turn on the calling (event loop)
+thread, with the log lines a turn emits: the handler and memory messages,
+a Sentinel call with its response, and one debug line per streamed event
+in the "events" execution mode.
+
+Output goes to stdout, so redirect it, e.g.:
+    LOG_LEVEL=DEBUG PYTHONPATH=src python scripts/bench_logging.py \
+        --turns 200 --events 300 > /dev/null
+
+Results are printed to stderr. Use --legacy to compare with the logging
+helper from before the background writer.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from libs import logging_helper
+from libs.logging_helper import logger
+
+SENTINEL_RESPONSE = json.dumps(
+    {
+        "results": {
+            guardrail: {"score": 0.01, "details": "x" * 200}
+            for guardrail in ("jailbreak", "off-topic", "lionguard")
+        }
+    }
+)
+SENTINEL_HEADERS = [(f"x-header-{i}", "value" * 4) for i in range(15)]
+
+
+def chat_turn(events: int, legacy: bool):
+    logger.info({"msg": "Received new user message"})
+    logger.info({"msg": "Adding message to history", "message_id": "abc"})
+    logger.info(
+        {
+            "msg": "Prompt window",
+            "messages": 12,
+            "history_messages": 40,
+            "prompt_tokens": 1800,
+            "token_budget": 4000,
+        }
+    )
+    logger.debug({"msg": "Calling Sentinel API", "payload": "y" * 500})
+    if legacy:
+        # Body and headers of every response at INFO
+        logger.info(
+            {
+                "msg": "Sentinel API response",
+                "response": SENTINEL_RESPONSE,
+                "response_headers": SENTINEL_HEADERS,
+                "duration": 0.2,
+            }
+        )
+    else:
+        logger.info(
+            {
+                "msg": "Sentinel API response",
+                "status_code": 200,
+                "duration": 0.2,
+            }
+        )
+        logger.debug(
+            lambda: {
+                "msg": "Sentinel API response body",
+                "response": SENTINEL_RESPONSE,
+                "response_headers": SENTINEL_HEADERS,
+            }
+        )
+    for i in range(events):
+        logger.debug(
+            {
+                "msg": "Streaming event",
+                "event_type": "on_chat_model_stream",
+                "name": "ChatOpenAI",
+            }
+        )
+    logger.info({"msg": "Adding message to history", "message_id": "def"})
+    logger.info({"msg": "Finish handling user message", "time_taken": 1.5})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--events", type=int, default=300)
+    parser.add_argument(
+        "--legacy",
+        action="store_true",
+        help="Log Sentinel responses the way they were before lazy logging",
+    )
+    args = parser.parse_args()
+
+    start_cpu, start = time.thread_time(), time.perf_counter()
+    for _ in range(args.turns):
+        chat_turn(args.events, args.legacy)
+    wall = time.perf_counter() - start
+    cpu = time.thread_time() - start_cpu
+
+    # Let a background listener, if any, finish writing
+    flush_start = time.perf_counter()
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+    if stop := getattr(logging_helper, "stop_logging", None):
+        stop()
+    drain = time.perf_counter() - flush_start
+
+    print(
+        f"level={logging.getLevelName(logger.getEffectiveLevel())} "
+        f"per turn: caller wall={wall / args.turns * 1000:.3f}ms "
+        f"caller cpu={cpu / args.turns * 1000:.3f}ms "
+        f"(drain after run {drain * 1000:.0f}ms)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
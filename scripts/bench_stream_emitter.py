@@ -0,0 +1,120 @@
+"""
+Benchmark websocket emits and CPU per streamed answer of
+AnswerCallbackHandler, with and without token coalescing.
+
+The Chainlit message is replaced by a stand-in that serializes each emit
+the way socket.io does, so no server is needed.
+
+Usage:
+    PYTHONPATH=src python scripts/bench_stream_emitter.py \
+        --sessions 50 --tokens 300 --token-interval 0.005
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from chainlit.chat_context import chat_context
+from chainlit.context import init_http_context
+from langchain_core.outputs import LLMResult
+
+from apps import handlers
+
+
+class EmitCountingMessage:
+    emits = 0
+
+    def __init__(self, content="", **kwargs):
+        self.id = str(uuid.uuid4())
+        self.content = content
+
+    async def send(self):
+        chat_context.add(self)
+        self._emit("new_message", {"id": self.id, "output": self.content})
+        return self
+
+    async def stream_token(self, token: str):
+        self.content += token
+        self._emit("stream_token", {"id": self.id, "token": token})
+
+    async def update(self):
+        self._emit("update_message", {"id": self.id, "output": self.content})
+
+    def _emit(self, event: str, data: dict):
+        EmitCountingMessage.emits += 1
+        # socket.io event packet encoding
+        ("42" + json.dumps([event, data])).encode("utf-8")
+
+
+async def stream_answer(
+    flush_interval: float, tokens: int, token_interval: float
+):
+    async def on_message_complete(message):
+        pass
+
+    handler = handlers.AnswerCallbackHandler(
+        on_message_complete=on_message_complete,
+        flush_interval=flush_interval,
+    )
+    run_id = uuid.uuid4()
+
+    await handler.on_chat_model_start({}, [[]], run_id=run_id, metadata={})
+    for i in range(tokens):
+        await handler.on_llm_new_token(f" tok{i}", run_id=run_id)
+        await asyncio.sleep(token_interval)
+    await handler.on_llm_end(LLMResult(generations=[]), run_id=run_id)
+
+
+async def run(
+    flush_interval: float, sessions: int, tokens: int, token_interval: float
+):
+    init_http_context()
+    EmitCountingMessage.emits = 0
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+
+    await asyncio.gather(
+        *(
+            stream_answer(flush_interval, tokens, token_interval)
+            for _ in range(sessions)
+        )
+    )
+
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    emits = EmitCountingMessage.emits
+    print(
+        f"flush_interval={flush_interval:<6} "
+        f"emits/answer={emits / sessions:8.1f} "
+        f"emits/sec={emits / wall:10.1f} "
+        f"cpu/answer={cpu / sessions * 1000:8.2f}ms "
+        f"wall={wall:.2f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=300)
+    parser.add_argument("--token-interval", type=float, default=0.005)
+    parser.add_argument(
+        "--flush-intervals", type=float, nargs="+", default=[0, 0.03]
+    )
+    args = parser.parse_args()
+
+    handlers.cl.Message = EmitCountingMessage
+
+    for flush_interval in args.flush_intervals:
+        asyncio.run(
+            run(
+                flush_interval,
+                args.sessions,
+                args.tokens,
+                args.token_interval,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
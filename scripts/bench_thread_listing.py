@@ -0,0 +1,190 @@
+"""
+Benchmark thread listing and thread reads of the SQLAlchemy data layer on
+a seeded SQLite database: Chainlit's SQLAlchemyDataLayer, the keyset
+paginated BatchSQLAlchemyDataLayer without and with the composite indexes,
+and CachedDataLayer in front of it.
+
+Needs the aiosqlite driver, e.g. `pip install aiosqlite`.
+
+Usage:
+    PYTHONPATH=src python scripts/bench_thread_listing.py \
+        --threads 100000 --users 100 --steps 2 --pages 20
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+from datetime import timedelta
+
+from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
+from chainlit.types import Pagination
+from chainlit.types import ThreadFilter
+
+from apps.data_layer import BatchSQLAlchemyDataLayer
+from apps.data_layer import CachedDataLayer
+
+SCHEMA = """
+CREATE TABLE threads (
+    "id" TEXT PRIMARY KEY, "createdAt" TEXT, "name" TEXT, "userId" TEXT,
+    "userIdentifier" TEXT, "tags" TEXT, "metadata" TEXT);
+CREATE TABLE steps (
+    "id" TEXT PRIMARY KEY, "name" TEXT, "type" TEXT, "threadId" TEXT,
+    "parentId" TEXT, "streaming" BOOLEAN, "waitForAnswer" BOOLEAN,
+    "isError" BOOLEAN, "metadata" TEXT, "tags" TEXT, "input" TEXT,
+    "output" TEXT, "createdAt" TEXT, "start" TEXT, "end" TEXT,
+    "generation" TEXT, "showInput" TEXT, "language" TEXT, "indent" INT,
+    "defaultOpen" BOOLEAN);
+CREATE TABLE elements (
+    "id" TEXT PRIMARY KEY, "threadId" TEXT, "type" TEXT, "url" TEXT,
+    "chainlitKey" TEXT, "name" TEXT, "display" TEXT, "objectKey" TEXT,
+    "size" TEXT, "page" INT, "language" TEXT, "forId" TEXT, "mime" TEXT,
+    "props" TEXT);
+CREATE TABLE feedbacks (
+    "id" TEXT PRIMARY KEY, "forId" TEXT, "threadId" TEXT, "value" INT,
+    "comment" TEXT);
+"""
+
+
+def seed(path: str, threads: int, users: int, steps: int):
+    if os.path.exists(path):
+        os.remove(path)
+
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+    start = datetime(2024, 1, 1)
+    thread_rows, step_rows = [], []
+    for i in range(threads):
+        thread_id = str(uuid.uuid4())
+        created_at = start + timedelta(seconds=i * 37)
+        user_id = random.choice(user_ids)
+        thread_rows.append(
+            (
+                thread_id,
+                created_at.isoformat() + "Z",
+                f"Thread {i}",
+                user_id,
+                user_id,
+            )
+        )
+        for j in range(steps):
+            step_rows.append(
+                (
+                    str(uuid.uuid4()),
+                    "user_message" if j % 2 == 0 else "assistant_message",
+                    thread_id,
+                    f"message {j} of thread {i} " * 10,
+                    (created_at + timedelta(seconds=j)).isoformat() + "Z",
+                )
+            )
+
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.executemany(
+        'INSERT INTO threads ("id", "createdAt", "name", "userId", '
+        '"userIdentifier") VALUES (?, ?, ?, ?, ?)',
+        thread_rows,
+    )
+    conn.executemany(
+        'INSERT INTO steps ("id", "type", "threadId", "output", "createdAt")'
+        " VALUES (?, ?, ?, ?, ?)",
+        step_rows,
+    )
+    conn.commit()
+    conn.close()
+
+    return user_ids, [row[0] for row in thread_rows]
+
+
+async def list_pages(data_layer, user_id: str, pages: int, first: int):
+    cursor = None
+    for _ in range(pages):
+        page = await data_layer.list_threads(
+            Pagination(first=first, cursor=cursor),
+            ThreadFilter(userId=user_id),
+        )
+        if not page.pageInfo.hasNextPage:
+            break
+        cursor = page.pageInfo.endCursor
+
+
+async def bench(name, data_layer, user_ids, thread_ids, pages, first):
+    start = time.perf_counter()
+    for user_id in user_ids:
+        await list_pages(data_layer, user_id, pages, first)
+    listing = (time.perf_counter() - start) / (len(user_ids) * pages)
+
+    start = time.perf_counter()
+    for thread_id in thread_ids:
+        await data_layer.get_thread(thread_id)
+    get_thread = (time.perf_counter() - start) / len(thread_ids)
+
+    print(
+        f"{name:<28} list page={listing * 1000:8.2f}ms "
+        f"get_thread={get_thread * 1000:8.2f}ms"
+    )
+
+
+async def main(args):
+    user_ids, thread_ids = seed(args.db, args.threads, args.users, args.steps)
+    users = user_ids[: args.sample_users]
+    threads = random.sample(thread_ids, args.sample_threads)
+    conninfo = f"sqlite+aiosqlite:///{args.db}"
+    print(
+        f"threads={args.threads} users={args.users} "
+        f"steps/thread={args.steps} page size={args.first}"
+    )
+
+    stock = SQLAlchemyDataLayer(conninfo=conninfo)
+    await bench(
+        "SQLAlchemyDataLayer", stock, users, threads, args.pages, args.first
+    )
+    await stock.engine.dispose()
+
+    paginated = BatchSQLAlchemyDataLayer(conninfo=conninfo)
+    await bench(
+        "keyset, no index", paginated, users, threads, args.pages, args.first
+    )
+
+    await paginated.create_indexes()
+    await bench(
+        "keyset + indexes", paginated, users, threads, args.pages, args.first
+    )
+
+    cached = CachedDataLayer(paginated)
+    await bench(
+        "keyset + indexes, cold",
+        cached,
+        users,
+        threads,
+        args.pages,
+        args.first,
+    )
+    await bench(
+        "keyset + indexes, cached",
+        cached,
+        users,
+        threads,
+        args.pages,
+        args.first,
+    )
+    await paginated.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db", default="/tmp/bench_threads.sqlite")
+    parser.add_argument("--threads", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--steps", type=int, default=2)
+    parser.add_argument("--first", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--sample-users", type=int, default=5)
+    parser.add_argument("--sample-threads", type=int, default=50)
+    args = parser.parse_args()
+
+    random.seed(0)
+    asyncio.run(main(args))
@@ -0,0 +1,35 @@
+"""
+Add the composite indexes that thread listing and chat resume need to the
+Chainlit data layer database: threads ("userId", "createdAt") and
+steps ("threadId", "createdAt"). Safe to run more than once.
+
+Usage:
+    CHAINLIT_DB_CONNECTION=postgresql+asyncpg://... \
+        PYTHONPATH=src python scripts/create_data_layer_indexes.py
+"""
+
+import argparse
+import asyncio
+import os
+
+from apps.data_layer import BatchSQLAlchemyDataLayer
+from apps.data_layer import THREAD_INDEXES
+
+
+async def main(conninfo: str):
+    data_layer = BatchSQLAlchemyDataLayer(conninfo=conninfo)
+    await data_layer.create_indexes()
+    await data_layer.engine.dispose()
+
+    for statement in THREAD_INDEXES:
+        print(statement)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--conninfo", default=os.getenv("CHAINLIT_DB_CONNECTION")
+    )
+    args = parser.parse_args()
+
+    asyncio.run(main(args.conninfo))
@@ -0,0 +1,84 @@
+"""
+Local stand-in for the Sentinel API, for development and load testing.
+
+Scores are deterministic: a text scores 0.99 on every requested guardrail
+if it contains one of the flagged phrases, 0.01 otherwise.
+
+Usage:
+    python scripts/sentinel_stub_server.py --port 8100 --latency 0.2
+
+then set SENTINEL_BASE_URL=http://localhost:8100 (any SENTINEL_API_KEY).
+GET /stats returns the number of requests and texts received.
+"""
+
+import argparse
+import asyncio
+from typing import Any
+from typing import Dict
+from typing import List
+
+import uvicorn
+from fastapi import Body
+from fastapi import FastAPI
+
+FLAGGED_PHRASES = [
+    "ignore everything",
+    "ignore all previous instructions",
+    "repeat water non-stop",
+    "system prompt",
+]
+
+app = FastAPI(docs_url=None, redoc_url=None)
+app.state.latency = 0.0
+app.state.stats = {"requests": 0, "batch_requests": 0, "texts": 0}
+
+
+def score(text: str, guardrails: Dict[str, Any]) -> Dict[str, Any]:
+    flagged = any(phrase in text.lower() for phrase in FLAGGED_PHRASES)
+    return {
+        "results": {
+            guardrail: {"score": 0.99 if flagged else 0.01}
+            for guardrail in guardrails
+        }
+    }
+
+
+@app.post("/api/v1/validate")
+async def validate(payload: Dict[str, Any] = Body(...)):
+    app.state.stats["requests"] += 1
+    app.state.stats["texts"] += 1
+    await asyncio.sleep(app.state.latency)
+
+    return score(payload["text"], payload.get("guardrails", {}))
+
+
+@app.post("/api/v1/validate/batch")
+async def validate_batch(payload: Dict[str, Any] = Body(...)):
+    texts: List[str] = payload["texts"]
+    app.state.stats["batch_requests"] += 1
+    app.state.stats["texts"] += len(texts)
+    await asyncio.sleep(app.state.latency)
+
+    return {
+        "results": [
+            score(text, payload.get("guardrails", {})) for text in texts
+        ]
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return app.state.stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per request"
+    )
+    args = parser.parse_args()
+
+    app.state.latency = args.latency
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -1,13 +1,19 @@
+import asyncio
+import contextlib
 import logging
+import math
 import os
 import time
 import uuid
 from abc import abstractmethod
+from contextlib import asynccontextmanager
 from typing import Any
+from typing import AsyncIterator
 from typing import Dict
 from typing import List
 from typing import Literal
 from typing import Optional
+from typing import Set
 
 import chainlit as cl
 import uvicorn
@@ -18,7 +24,6 @@ from langchain.memory import ConversationBufferMemory
 from langchain.memory.chat_memory import BaseChatMemory
 from langchain_community.llms.fake import FakeListLLM
 from langchain_core.callbacks import BaseCallbackHandler
-from langchain_core.chat_history import InMemoryChatMessageHistory
 from langchain_core.messages import AIMessage
 from langchain_core.messages import BaseMessage
 from langchain_core.messages import HumanMessage
@@ -27,11 +32,24 @@ from langchain_core.runnables import Runnable
 from langchain_core.runnables import RunnableConfig
 from pydantic import BaseModel
 from pydantic import Field
+from pydantic import PrivateAttr
 from starlette.datastructures import Headers
 
+from apps.handlers import OutputGuardrailError
+from apps.handlers import STREAM_FLUSH_INTERVAL
+from apps.handlers import STREAM_FLUSH_SIZE
+from apps.memory import IndexedChatMessageHistory
+from apps.memory import load_tokenizer
+from apps.memory import session_memory
+from apps.memory import to_pending_record
 from constants import LLM_PROFILES
+from libs import admission
 from libs import cryptography_helper
+from libs import metrics
+from libs import tracing
+from libs.admission import AdmissionRejected
 from libs.logging_helper import logger
+from libs.rate_limit import rate_limiter
 
 cl_to_langchain_msg_type_map = {
     "user_message": HumanMessage,
@@ -39,6 +57,13 @@ cl_to_langchain_msg_type_map = {
     "system_message": SystemMessage,
 }
 
+CHAT_RESUME_MAX_MESSAGES = int(os.getenv("CHAT_RESUME_MAX_MESSAGES", "0"))
+CHAT_RESUME_REMOVE_CONCURRENCY = int(
+    os.getenv("CHAT_RESUME_REMOVE_CONCURRENCY", "8")
+)
+# Seconds a new message waits for the answer it cancels to wind down
+CANCEL_TIMEOUT = float(os.getenv("CANCEL_TIMEOUT", "5"))
+
 LOADING_IMAGE = """![loading](public/images/loading/4.svg "loading")"""
 
 
@@ -47,6 +72,9 @@ class BaseChainlitApp(BaseModel):
 
     data_layer_type: Literal["sqlalchemy", "none"] = Field(default="none")
     """Data Layer type"""
+    data_layer_write_behind: bool = Field(default=True)
+    """Queue data layer writes and flush them in batches in the background,
+    instead of writing on the request path"""
     password_auth: bool = Field(default=False)
     """Enable password authentication"""
     header_auth: bool = Field(default=False)
@@ -55,6 +83,28 @@ class BaseChainlitApp(BaseModel):
     """Whether this app support resuming a chat"""
     actions: List[str] = Field(default=[])
     """List of action names that this app support"""
+    stream_flush_interval: float = Field(default=STREAM_FLUSH_INTERVAL)
+    """Seconds to coalesce streamed tokens into one emit, 0 to disable"""
+    stream_flush_size: int = Field(default=STREAM_FLUSH_SIZE)
+    """Emit streamed tokens as soon as this many characters are pending"""
+
+    chat_resume_max_messages: int = Field(default=CHAT_RESUME_MAX_MESSAGES)
+    """Messages loaded into memory when resuming a chat, 0 for all,
+    older ones are paged in when the prompt needs them"""
+    chat_resume_remove_concurrency: int = Field(
+        default=CHAT_RESUME_REMOVE_CONCURRENCY
+    )
+    """How many empty messages to remove from the UI at once on resume"""
+
+    execution_mode: Literal["lean", "events"] = Field(default="lean")
+    """How to run the runnable: "lean" streams it with `astream` and lets
+    the callbacks handle the output, "events" goes through `astream_events`
+    and logs every event, for diagnostics"""
+
+    _process_callbacks: Optional[List[BaseCallbackHandler]] = PrivateAttr(
+        default=None
+    )
+    """Callbacks shared by every session, see `get_process_callbacks`"""
 
     names_in_stream_events: List[str] = Field(
         default=[
@@ -67,14 +117,28 @@ class BaseChainlitApp(BaseModel):
     def setup(self):
         """Hook up Chainlit events while allowing subclass to override"""
 
+        # Chainlit is mounted as a sub-app, so process-wide lifecycle hooks
+        # have to be attached to the parent FastAPI app
+        from apps.fastapi_app import app as fastapi_app
+
         if self.data_layer_type == "sqlalchemy":
-            from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
+            from apps.data_layer import THREAD_CACHE_MAX_SIZE
+            from apps.data_layer import BatchSQLAlchemyDataLayer
+            from apps.data_layer import CachedDataLayer
+            from apps.data_layer import WriteBehindDataLayer
 
-            cl.data._data_layer = SQLAlchemyDataLayer(
+            data_layer = BatchSQLAlchemyDataLayer(
                 conninfo=os.environ["CHAINLIT_DB_CONNECTION"],
                 ssl_require=os.getenv("CHAINLIT_DB_REQUIRE_SSL", "false")
                 == "true",
             )
+            if self.data_layer_write_behind:
+                data_layer = WriteBehindDataLayer(data_layer)
+                fastapi_app.router.on_shutdown.append(data_layer.aclose)
+            if THREAD_CACHE_MAX_SIZE > 0:
+                data_layer = CachedDataLayer(data_layer)
+
+            cl.data._data_layer = data_layer
 
         if self.password_auth:
             cl.password_auth_callback(self.password_auth_callback)
@@ -84,6 +148,12 @@ class BaseChainlitApp(BaseModel):
 
         cl.on_logout(self.on_logout)
 
+        fastapi_app.router.on_startup.append(load_tokenizer)
+        fastapi_app.router.on_startup.append(self.on_app_startup)
+        fastapi_app.router.on_shutdown.append(self.on_app_shutdown)
+        fastapi_app.router.on_shutdown.append(session_memory.close)
+        fastapi_app.router.on_shutdown.append(self.flush_process_callbacks)
+
         cl.set_starters(self.get_conversation_starters)
 
         @cl.set_chat_profiles
@@ -94,9 +164,10 @@ class BaseChainlitApp(BaseModel):
         async def on_chat_start():
             """Add conversation memory to session before runnable setup"""
 
-            cl.user_session.set(
-                "memory", ConversationBufferMemory(return_messages=True)
+            session_memory.set(
+                cl.user_session.get("id"), IndexedChatMessageHistory()
             )
+            metrics.ACTIVE_SESSIONS.inc()
 
             await self.setup_runnable()
 
@@ -109,40 +180,76 @@ class BaseChainlitApp(BaseModel):
                 cl.on_settings_update(self.on_chat_settings_update)
 
         async def on_chat_resume(thread: cl.types.ThreadDict):
-            memory: BaseChatMemory = ConversationBufferMemory(
-                return_messages=True,
-                chat_memory=InMemoryChatMessageHistory(
-                    messages=[
-                        cl_to_langchain_msg_type_map[message["type"]](
-                            content=message["output"],
-                            additional_kwargs={"id": message["id"]},
-                        )
-                        for message in thread["steps"]
-                        if message["type"] in cl_to_langchain_msg_type_map
-                        and message["output"] != ""
-                    ]
-                ),
-            )
+            start_time = time.time()
 
-            # Remove any empty message from the UI
-            for message in thread["steps"]:
-                if (
-                    message["type"] in cl_to_langchain_msg_type_map
-                    and message["output"] == ""
+            # Single pass over the steps for the messages to keep in memory
+            # and the empty ones to remove from the UI
+            messages: List[BaseMessage] = []
+            empty_message_ids: List[str] = []
+            for step in thread["steps"]:
+                if not (
+                    message_type := cl_to_langchain_msg_type_map.get(
+                        step["type"]
+                    )
                 ):
-                    await cl.Message(id=message["id"], content="").remove()
+                    continue
+                if step["output"] == "":
+                    empty_message_ids.append(step["id"])
+                else:
+                    messages.append(
+                        message_type(
+                            content=step["output"],
+                            additional_kwargs={"id": step["id"]},
+                        )
+                    )
 
-            cl.user_session.set("memory", memory)
+            # Only the latest messages are loaded, older ones are paged in
+            # when needed
+            split = (
+                max(len(messages) - self.chat_resume_max_messages, 0)
+                if self.chat_resume_max_messages > 0
+                else 0
+            )
+            session_memory.set(
+                cl.user_session.get("id"),
+                IndexedChatMessageHistory(
+                    messages=messages[split:],
+                    older=map(to_pending_record, messages[:split]),
+                ),
+            )
+            metrics.ACTIVE_SESSIONS.inc()
 
-            await self.setup_runnable()
+            await asyncio.gather(
+                self.remove_messages(empty_message_ids),
+                self.setup_runnable(),
+            )
 
             await self.on_chat_resume(thread)
 
+            logger.info(
+                {
+                    "msg": "Resumed chat",
+                    "steps": len(thread["steps"]),
+                    "loaded_messages": len(messages) - split,
+                    "older_messages": split,
+                    "removed_messages": len(empty_message_ids),
+                    "time_taken": time.time() - start_time,
+                }
+            )
+
         if self.support_chat_resume:
             cl.on_chat_resume(on_chat_resume)
 
+        @cl.on_chat_end
+        async def on_chat_end():
+            session_memory.discard(cl.user_session.get("id"))
+            metrics.ACTIVE_SESSIONS.dec()
+
         @cl.on_message
         async def on_message(message: cl.Message):
+            if not await self.check_rate_limit():
+                return
+
             tags: List[str] = []
             metadata: Dict[str, str] = {}
 
@@ -158,6 +265,9 @@ class BaseChainlitApp(BaseModel):
 
             @cl.action_callback(action_name)
             async def on_action_taken(action: cl.Action):
+                if not await self.check_rate_limit():
+                    return
+
                 await self.on_action_taken(action.name, action)
 
     async def password_auth_callback(self, username: str, password: str):
@@ -188,7 +298,41 @@ class BaseChainlitApp(BaseModel):
 
     @property
     def memory(self) -> BaseChatMemory:
-        return cl.user_session.get("memory")
+        return ConversationBufferMemory(
+            return_messages=True, chat_memory=self.chat_history
+        )
+
+    @property
+    def chat_history(self) -> IndexedChatMessageHistory:
+        """Memory of the session, as loaded in RAM by `aget_chat_history`,
+        without blocking the event loop on a disk read"""
+        session_id = cl.user_session.get("id")
+        if (history := session_memory.get_cached(session_id)) is None:
+            history = IndexedChatMessageHistory()
+            session_memory.set(session_id, history)
+
+        return history
+
+    async def aget_chat_history(self) -> IndexedChatMessageHistory:
+        """Memory of the session, loading it back if it was spilled"""
+        session_id = cl.user_session.get("id")
+        if (history := await session_memory.aget(session_id)) is None:
+            history = IndexedChatMessageHistory()
+            session_memory.set(session_id, history)
+
+        return history
+
+    async def remove_messages(self, message_ids: List[str]):
+        """Remove messages from the UI, a few at a time"""
+        semaphore = asyncio.Semaphore(self.chat_resume_remove_concurrency)
+
+        async def remove(message_id: str):
+            async with semaphore:
+                await cl.Message(id=message_id, content="").remove()
+
+        await asyncio.gather(
+            *(remove(message_id) for message_id in message_ids)
+        )
 
     async def add_message_to_memory(
         self, message: cl.Message, check_for_edit: bool = False, **kwargs
@@ -201,25 +345,22 @@ class BaseChainlitApp(BaseModel):
         ):
             raise ValueError(f"Invalid message type: {message.type}")
 
-        if check_for_edit:
-            messages: List[BaseMessage] = []
-            for history_message in self.memory.chat_memory.messages:
-                if history_message.additional_kwargs.get("id") == message.id:
-                    # Message already exists in history,
-                    # so this must be a user-edited message.
-                    # In this case we need to remove the remaining messages
-
-                    self.memory.chat_memory.messages = messages
-                    break
+        history = await self.aget_chat_history()
 
-                messages.append(history_message)
+        if (
+            check_for_edit
+            and (index := history.index_of(message.id)) is not None
+        ):
+            # Message already exists in history,
+            # so this must be a user-edited message.
+            # In this case we need to remove the remaining messages
+            history.truncate(index)
 
         # check if the last message in memory is empty, if so, remove it
         if (
-            self.memory.chat_memory.messages
-            and self.memory.chat_memory.messages[-1].content == ""
-        ):
-            removed_message = self.memory.chat_memory.messages.pop()
+            last_message := history.last_message
+        ) is not None and last_message.content == "":
+            removed_message = history.pop()
 
             await cl.Message(
                 id=removed_message.additional_kwargs.get("id"), content=""
@@ -227,7 +368,7 @@ class BaseChainlitApp(BaseModel):
 
         kwargs["id"] = message.id
 
-        self.memory.chat_memory.add_message(
+        history.add_message(
             message_type(content=message.content, additional_kwargs=kwargs)
         )
 
@@ -248,6 +389,15 @@ class BaseChainlitApp(BaseModel):
         """Subclass need to override this if resuming chat is supported"""
         pass
 
+    async def on_app_startup(self):
+        """Called once per worker process when the server starts"""
+        pass
+
+    async def on_app_shutdown(self):
+        """Called once per worker process when the server stops,
+        subclass can override this to release shared resources"""
+        pass
+
     async def get_chat_settings(
         self, user: Optional[cl.User]
     ) -> Optional[cl.ChatSettings]:
@@ -261,17 +411,117 @@ class BaseChainlitApp(BaseModel):
     async def on_message(self, message: cl.Message, **kwargs):
         """Default implementation using runnable and streaming"""
         start_time = time.time()
-        logger.info(
-            {
-                "msg": "Received new user message",
-                **(
-                    {"message": message.content}
-                    if logger.level == logging.DEBUG
-                    else {}
-                ),
-            }
+        with tracing.span(
+            "chat.turn",
+            new_trace=True,
+            session_id=cl.user_session.get("id"),
+            message_id=message.id,
+        ) as turn:
+            logger.info(
+                {
+                    "msg": "Received new user message",
+                    "turn_id": turn.trace_id,
+                    **(
+                        {"message": message.content}
+                        if logger.level == logging.DEBUG
+                        else {}
+                    ),
+                }
+            )
+            # Only the latest message of a session is answered: this turn
+            # is registered first, so a later message cancels it even while
+            # it waits for the previous one
+            previous_run = cl.user_session.get("active_run")
+            cl.user_session.set("active_run", asyncio.current_task())
+
+            try:
+                await self.cancel_run(previous_run)
+                async with self.admit():
+                    await self.handle_message(message, turn)
+            except asyncio.CancelledError:
+                metrics.TURNS_CANCELLED.inc()
+                logger.info(
+                    {
+                        "msg": "Cancelled handling user message",
+                        "turn_id": turn.trace_id,
+                        "time_taken": time.time() - start_time,
+                    }
+                )
+                raise
+            except AdmissionRejected as e:
+                turn.set(rejected=e.upstream)
+                logger.warning(
+                    {
+                        "msg": "Message rejected by admission control",
+                        "upstream": e.upstream,
+                        "reason": e.reason,
+                        "turn_id": turn.trace_id,
+                    }
+                )
+                await cl.Message(
+                    "The service is busy right now. "
+                    "Please try again in a moment.",
+                    type="system_message",
+                ).send()
+
+            time_taken = time.time() - start_time
+            metrics.TURN_LATENCY.observe(time_taken)
+            metrics.SESSION_MEMORY_MESSAGES.observe(
+                len(await self.aget_chat_history())
+            )
+            logger.info(
+                {
+                    "msg": "Finish handling user message",
+                    "turn_id": turn.trace_id,
+                    "time_taken": time_taken,
+                }
+            )
+
+            if cl.user_session.get("active_run") is asyncio.current_task():
+                cl.user_session.set("active_run", None)
+
+            with tracing.span("memory.spill"):
+                await session_memory.spill()
+
+    async def cancel_run(self, task: Optional[asyncio.Task]):
+        """Cancel an answer still running in this session, if any, and
+        wait for it, and for the answers cancelled before it, to keep what
+        they showed"""
+        cancelled_runs: Optional[Set[asyncio.Task]] = cl.user_session.get(
+            "cancelled_runs"
         )
-        await self.add_message_to_memory(message, check_for_edit=True)
+        if cancelled_runs is None:
+            cancelled_runs = set()
+            cl.user_session.set("cancelled_runs", cancelled_runs)
+
+        if (
+            task is not None
+            and not task.done()
+            and task is not asyncio.current_task()
+        ):
+            task.cancel()
+            cancelled_runs.add(task)
+            task.add_done_callback(cancelled_runs.discard)
+
+        if not cancelled_runs:
+            return
+
+        _, pending = await asyncio.wait(
+            list(cancelled_runs), timeout=CANCEL_TIMEOUT
+        )
+        if pending:
+            logger.warning(
+                {
+                    "msg": "Previous answer still running after cancel",
+                    "timeout": CANCEL_TIMEOUT,
+                }
+            )
+
+    async def handle_message(self, message: cl.Message, turn: tracing.Span):
+        """Answer an admitted message: update memory, build the prompt
+        and run the runnable"""
+        with tracing.span("memory.add_message"):
+            await self.add_message_to_memory(message, check_for_edit=True)
 
         # waiting_message = await self.get_waiting_message().send()
         # cl.user_session.set("waiting_message", waiting_message)
@@ -280,32 +530,37 @@ class BaseChainlitApp(BaseModel):
         # cb = cl.AsyncLangchainCallbackHandler(stream_final_answer=True)
         callbacks = self.get_runnable_callbacks()
 
-        runnable_input = await self.get_runnable_input(message)
+        with tracing.span("prompt.build"):
+            runnable_input = await self.get_runnable_input(message)
 
-        # Just invoke the runnable here and let the callbacks handle results
+        # Just invoke the runnable here and let the callbacks handle
+        # results
         try:
-            # await runnable.ainvoke(runnable_input, callbacks=callbacks)
-            async for event in runnable.astream_events(
-                runnable_input,
-                version="v2",
-                config=RunnableConfig(callbacks=callbacks),
-                include_names=self.names_in_stream_events,
-            ):
-                logger.debug(
-                    {
-                        "msg": "Streaming event",
-                        "event_type": event["event"],
-                        "name": event["name"],
-                        # "data": event["data"],
-                    }
+            with tracing.span("runnable.run", name=runnable.get_name()):
+                await self.run_runnable(
+                    runnable,
+                    runnable_input,
+                    RunnableConfig(callbacks=callbacks),
                 )
+        except AdmissionRejected:
+            raise
+        except OutputGuardrailError as e:
+            # The answer was already replaced by the answer handler
+            logger.info(
+                {
+                    "msg": "Answer stopped by output guardrail",
+                    "error": str(e),
+                }
+            )
         except Exception as e:
             error_id = str(uuid.uuid4())[:8]
+            turn.set(error_id=error_id)
             logger.error(
                 {
                     "msg": "Error while handling new user message",
                     "error": str(e),
                     "error_id": error_id,
+                    "turn_id": turn.trace_id,
                 }
             )
             unknown_error_text = (
@@ -320,12 +575,119 @@ class BaseChainlitApp(BaseModel):
             # await cl.user_session.get("waiting_message").remove()
             cl.user_session.set("waiting_message", None)
 
-        logger.info(
+    async def check_rate_limit(self) -> bool:
+        """Count a message or action of the user against the limit of their
+        role, telling them when to retry if it is over the limit"""
+        user = cl.user_session.get("user")
+        if user is not None:
+            key = getattr(user, "id", None) or user.identifier
+            role = user.metadata.get("role", "default")
+        else:
+            key = cl.user_session.get("id")
+            role = "default"
+
+        if not (retry_after := await rate_limiter.check(key, role)):
+            return True
+
+        logger.warning(
             {
-                "msg": "Finish handling user message",
-                "time_taken": time.time() - start_time,
+                "msg": "Message rejected by rate limit",
+                "role": role,
+                "retry_after": retry_after,
             }
         )
+        await cl.Message(
+            "You are sending messages too quickly. "
+            f"Please try again in {math.ceil(retry_after)} seconds.",
+            type="system_message",
+        ).send()
+        return False
+
+    def get_upstream_limits(self) -> Dict[str, int]:
+        """Slots per worker of each upstream held for the whole turn, 0 for
+        no limit.
+
+        This method can be overridden in subclasses to limit the turns
+        running at once. Single calls to an upstream are limited with
+        `admission.upstream_slot` instead."""
+        return {}
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """Queue the upstream calls of the turn as its user, and hold the
+        slots of the turn, showing the position in the queue to the user
+        while the turn waits to be answered"""
+        user = cl.user_session.get("user")
+        user_key = user.identifier if user else cl.user_session.get("id")
+        queue_message: Optional[cl.Message] = None
+
+        async def show_position(position: Optional[int]):
+            nonlocal queue_message
+
+            if position is None:
+                # Admitted
+                if queue_message is not None:
+                    await queue_message.remove()
+                    queue_message = None
+                return
+
+            content = (
+                "Many people are chatting right now, "
+                f"you are number {position} in the queue."
+            )
+            if queue_message is None:
+                queue_message = cl.Message(content, type="system_message")
+                await queue_message.send()
+            else:
+                queue_message.content = content
+                await queue_message.update()
+
+        user_token = admission.admission_user.set(user_key)
+        feedback_token = admission.queue_feedback.set(show_position)
+        try:
+            async with contextlib.AsyncExitStack() as slots:
+                with tracing.span("admission"):
+                    # Same order in every turn, so turns never wait on
+                    # each other's slots
+                    for upstream, limit in sorted(
+                        self.get_upstream_limits().items()
+                    ):
+                        await slots.enter_async_context(
+                            admission.upstream_slot(
+                                upstream, limit, show_position=True
+                            )
+                        )
+
+                yield
+        finally:
+            admission.queue_feedback.reset(feedback_token)
+            admission.admission_user.reset(user_token)
+            if queue_message is not None:
+                await queue_message.remove()
+
+    async def run_runnable(
+        self, runnable: Runnable, runnable_input: Any, config: RunnableConfig
+    ):
+        """Run the runnable to completion, in the configured execution mode"""
+        if self.execution_mode == "events":
+            async for event in runnable.astream_events(
+                runnable_input,
+                version="v2",
+                config=config,
+                include_names=self.names_in_stream_events,
+            ):
+                logger.debug(
+                    {
+                        "msg": "Streaming event",
+                        "event_type": event["event"],
+                        "name": event["name"],
+                        # "data": event["data"],
+                    }
+                )
+        else:
+            # Streaming makes the chat models emit tokens to the callbacks
+            async for _ in runnable.astream(runnable_input, config=config):
+                pass
 
     @classmethod
     def get_waiting_message(cls) -> cl.Message:
@@ -351,22 +713,57 @@ class BaseChainlitApp(BaseModel):
         """
         Return a list of callbacks used when running a runnable.
 
-        This method should be overridden in subclasses if a custom callback
-        is needed.
+        Only the Chainlit tracer is built per message, as it keeps the
+        steps of a single run. The others are built once per session
+        (`get_session_callbacks`) or once per process
+        (`get_process_callbacks`).
 
         Returns:
             List of callbacks.
         """
-        callbacks = [cl.AsyncLangchainCallbackHandler()]
-        try:
-            if os.getenv("LANGFUSE_SECRET_KEY"):
-                from langfuse.callback import CallbackHandler
+        if (
+            session_callbacks := cl.user_session.get("session_callbacks")
+        ) is None:
+            session_callbacks = self.get_session_callbacks()
+            cl.user_session.set("session_callbacks", session_callbacks)
 
-                callbacks.append(CallbackHandler())
-        except Exception:
-            pass
+        return [
+            cl.AsyncLangchainCallbackHandler(),
+            *session_callbacks,
+            *self.get_process_callbacks(),
+        ]
+
+    def get_session_callbacks(self) -> List[BaseCallbackHandler]:
+        """
+        Callbacks built once per chat session and reused for each message,
+        they must keep their per-run state by run id.
+
+        This method should be overridden in subclasses if a custom callback
+        is needed.
+        """
+        return []
 
-        return callbacks
+    def get_process_callbacks(self) -> List[BaseCallbackHandler]:
+        """Callbacks shared by every session of the worker process,
+        built on first use. Langfuse sends its events in batches from its
+        own background thread."""
+        if self._process_callbacks is None:
+            self._process_callbacks = []
+            try:
+                if os.getenv("LANGFUSE_SECRET_KEY"):
+                    from langfuse.callback import CallbackHandler
+
+                    self._process_callbacks.append(CallbackHandler())
+            except Exception:
+                pass
+
+        return self._process_callbacks
+
+    async def flush_process_callbacks(self):
+        """Send the events still batched by the process callbacks"""
+        for callback in self._process_callbacks or []:
+            if hasattr(callback, "flush"):
+                await asyncio.to_thread(callback.flush)
 
     async def send_message(self, message: cl.Message, **kwargs):
         """ Send the message to user and record it in memory
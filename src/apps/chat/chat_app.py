@@ -1,3 +1,5 @@
+import asyncio
+import contextlib
 import functools
 import json
 import os
@@ -6,31 +8,38 @@ from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 
 import chainlit as cl
 from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.language_models import FakeListChatModel
 from langchain_core.messages import BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
+from langchain_core.runnables import RunnableConfig
 from langchain_core.runnables import RunnableLambda
-from langchain_openai import ChatOpenAI
 from pydantic import Field
+from pydantic import PrivateAttr
 
 from apps.base_app import BaseChainlitApp
 from apps.handlers import AnswerCallbackHandler
-from constants import LLM_PROFILES
+from apps.handlers import speculative_gate
+from apps.handlers import SpeculativeGate
+from apps.memory import CONTEXT_TOKEN_BUDGET
+from datatypes.llm_profile import LLMProfile
+from libs import admission
+from libs import tracing
 from libs.logging_helper import logger
+from services.llm.registry import llm_registry
+from services.sentinel import client as sentinel_client
 from services.sentinel import sentinel
 
 
-def check_sentinel(args, runnable):
-    """
-    Check sentinel
-    """
+async def validate_last_message(args) -> Tuple[bool, str | None]:
     messages: List[BaseMessage] = args["messages"]
     content_to_check = "\n".join(f"{_.content}" for _ in messages[-1:])
 
-    passed, error_message = sentinel.validate(
+    return await sentinel.avalidate(
         content_to_check,
         guardrails={
             "aws": {},
@@ -43,14 +52,106 @@ def check_sentinel(args, runnable):
         },
     )
 
+
+async def validate_output(text: str) -> Tuple[bool, str | None]:
+    return await sentinel.avalidate(
+        text,
+        guardrails={
+            "aws": {},
+            "lionguard": {},
+            "system-prompt-leakage": {},
+        },
+        additional_params={
+            "messages": [{"content": system_prompt, "role": "system"}]
+        },
+    )
+
+
+def with_upstream_slot(
+    runnable: Runnable, upstream: str, limit: int
+) -> Runnable:
+    """Stream a runnable holding a slot of an upstream, showing the
+    position of the turn in the queue while waiting for it"""
+
+    async def stream(args, config: RunnableConfig):
+        async with admission.upstream_slot(
+            upstream, limit, show_position=True
+        ):
+            async for chunk in runnable.astream(args, config=config):
+                yield chunk
+
+    return RunnableLambda(stream, name=upstream)
+
+
+def get_warning_runnable(error_message: str | None) -> Runnable:
+    return ChatPromptTemplate(messages=[]) | FakeListChatModel(
+        responses=[f"**WARNING**: {error_message}"]
+    )
+
+
+async def check_sentinel(args, runnable):
+    """
+    Check sentinel without blocking the event loop
+    """
+    with tracing.span("sentinel.check") as span:
+        passed, error_message = await validate_last_message(args)
+        span.set(passed=passed)
+
     if not passed:
-        return ChatPromptTemplate(messages=[]) | FakeListChatModel(
-            responses=[f"**WARNING**: {error_message}"]
-        )
+        return get_warning_runnable(error_message)
 
     return runnable
 
 
+async def speculative_check_sentinel(
+    args, runnable: Runnable, config: RunnableConfig
+):
+    """
+    Check sentinel while the LLM already streams its answer.
+
+    Tokens are held back by the answer handler until the check passes.
+    If it fails, the LLM run is cancelled and the warning is shown instead.
+    """
+    gate = SpeculativeGate()
+
+    async def run_llm():
+        speculative_gate.set(gate)
+
+        # Stream so that every chat model emits its tokens to the callbacks
+        output = None
+        async for chunk in runnable.astream(args, config=config):
+            output = chunk if output is None else output + chunk
+        return output
+
+    llm_task = asyncio.create_task(run_llm())
+
+    try:
+        with tracing.span("sentinel.check", speculative=True) as span:
+            passed, error_message = await validate_last_message(args)
+            span.set(passed=passed)
+    except BaseException:
+        gate.close()
+        llm_task.cancel()
+        # Retrieve the outcome so that a failed LLM run is not reported
+        llm_task.add_done_callback(
+            lambda task: task.cancelled() or task.exception()
+        )
+        raise
+
+    if not passed:
+        gate.close()
+        llm_task.cancel()
+        # The LLM run may have failed already, the warning still applies
+        with contextlib.suppress(asyncio.CancelledError, Exception):
+            await llm_task
+
+        return get_warning_runnable(error_message)
+
+    await gate.open()
+
+    return await llm_task
+
+
 system_prompt = """
 You are an expert chatbot in Singapore O-Level Maths, providing clear, accurate, and curriculum-aligned explanations on topics such as Algebra, Geometry, Trigonometry, and Calculus. Engage with students using step-by-step reasoning and practical examples tailored to the Singapore education system. Always ensure that interactions are respectful, unbiased, and in full compliance with community safety and moderation guidelines.
 """  # noqa: E501
@@ -64,6 +165,14 @@ class ChatApp(BaseChainlitApp):
             "Generate Example",
         ]
     )
+    speculative_sentinel: bool = Field(default=False)
+    """Run Sentinel in parallel with the LLM on Sentinel profiles,
+    holding back the answer until the check passes"""
+    output_guardrails: bool = Field(default=False)
+    """Validate the streamed answer with Sentinel on Sentinel profiles"""
+
+    _runnables: Dict[str, Runnable] = PrivateAttr(default_factory=dict)
+    """Runnable of each LLM profile, built once per process"""
 
     async def get_chat_settings(self, user: Optional[cl.User]):
         if not user:
@@ -96,19 +205,12 @@ class ChatApp(BaseChainlitApp):
             check_for_edit=True,
         )
 
-    async def setup_runnable(self):
-        llm_profile = (
-            next(
-                p
-                for p in LLM_PROFILES
-                if p.name == cl.user_session.get("chat_profile")
-            )
-            if cl.user_session.get("chat_profile")
-            else LLM_PROFILES[0]
-        )
-
-        from langchain_core.prompts import ChatPromptTemplate
+    @staticmethod
+    def get_llm_profile() -> LLMProfile:
+        return llm_registry.get_profile(cl.user_session.get("chat_profile"))
 
+    def build_runnable(self, llm_profile: LLMProfile) -> Runnable:
+        """Build the runnable of a profile, shared by all its sessions"""
         prompt = ChatPromptTemplate.from_messages(
             [
                 # ("system", system_prompt),
@@ -116,11 +218,16 @@ class ChatApp(BaseChainlitApp):
             ]
         )
 
-        llm = ChatOpenAI(
-            model=llm_profile.default_llm_config.model,
-            temperature=llm_profile.default_llm_config.temperature,
-            max_tokens=llm_profile.default_llm_config.max_tokens,
-            streaming=True,
+        # The LLM slot is held while the answer streams only, not while
+        # Sentinel checks the input
+        llm = with_upstream_slot(
+            llm_registry.get_llm(llm_profile.name),
+            f"llm:{llm_profile.name}",
+            (
+                llm_profile.max_concurrency
+                if llm_profile.max_concurrency is not None
+                else admission.ADMISSION_LLM_MAX_CONCURRENCY
+            ),
         )
 
         runnable = (prompt | llm).with_config(
@@ -129,29 +236,84 @@ class ChatApp(BaseChainlitApp):
 
         if "sentinel" in llm_profile.name.lower():
             runnable = RunnableLambda(
-                functools.partial(check_sentinel, runnable=runnable)
+                functools.partial(
+                    (
+                        speculative_check_sentinel
+                        if self.speculative_sentinel
+                        else check_sentinel
+                    ),
+                    runnable=runnable,
+                )
             )
 
         runnable.name = llm_profile.name
 
-        cl.user_session.set("runnable", runnable)
+        return runnable
+
+    def get_profile_runnable(self, llm_profile: LLMProfile) -> Runnable:
+        if (runnable := self._runnables.get(llm_profile.name)) is None:
+            runnable = self._runnables[llm_profile.name] = self.build_runnable(
+                llm_profile
+            )
+
+        return runnable
+
+    async def setup_runnable(self):
+        cl.user_session.set(
+            "runnable", self.get_profile_runnable(self.get_llm_profile())
+        )
 
     async def get_runnable_input(self, message: cl.Message):
-        # Limit history to last 5 messages
+        # Limit history to the token budget of the profile,
+        # keeping the system prompt
+        token_budget = (
+            self.get_llm_profile().context_token_budget or CONTEXT_TOKEN_BUDGET
+        )
+        history = await self.aget_chat_history()
+        messages, prompt_tokens = history.window(token_budget)
+
+        logger.info(
+            {
+                "msg": "Prompt window",
+                "messages": len(messages),
+                "history_messages": len(history),
+                "prompt_tokens": prompt_tokens,
+                "token_budget": token_budget,
+            }
+        )
+
         return {
-            "messages": self.memory.chat_memory.messages[-5:],
+            "messages": messages,
         }
 
-    def get_runnable_callbacks(self) -> List[BaseCallbackHandler]:
-        callbacks = super().get_runnable_callbacks()
+    def get_session_callbacks(self) -> List[BaseCallbackHandler]:
+        callbacks = super().get_session_callbacks()
         callbacks.append(
             AnswerCallbackHandler(
-                on_message_complete=self.add_message_to_memory
+                on_message_complete=self.add_message_to_memory,
+                output_validator=(
+                    validate_output
+                    if self.output_guardrails
+                    and "sentinel" in self.get_llm_profile().name.lower()
+                    else None
+                ),
+                flush_interval=self.stream_flush_interval,
+                flush_size=self.stream_flush_size,
             )
         )
 
         return callbacks
 
+    async def on_app_startup(self):
+        for llm_profile in llm_registry.profiles.values():
+            self.get_profile_runnable(llm_profile)
+
+        await llm_registry.warm_up()
+
+    async def on_app_shutdown(self):
+        await sentinel_client.aclose()
+        await llm_registry.aclose()
+
     async def on_action_taken(self, action_name: str, action: cl.Action):
         logger.info(
             {
@@ -185,6 +347,13 @@ init_data = {
     "password_auth": os.getenv("ENABLE_PASSWORD_AUTH") == "true",
     "header_auth": os.getenv("ENABLE_HEADER_AUTH") == "true",
     "data_layer_type": os.getenv("CHAINLIT_DATA_LAYER", "none"),
+    "data_layer_write_behind": os.getenv(
+        "CHAINLIT_DATA_LAYER_WRITE_BEHIND", "true"
+    )
+    == "true",
+    "speculative_sentinel": os.getenv("SENTINEL_SPECULATIVE") == "true",
+    "output_guardrails": os.getenv("SENTINEL_OUTPUT_GUARDRAILS") == "true",
+    "execution_mode": os.getenv("RUNNABLE_EXECUTION_MODE", "lean"),
 }
 
 logger.info(
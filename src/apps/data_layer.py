@@ -0,0 +1,768 @@
+import asyncio
+import base64
+import contextvars
+import functools
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextlib import nullcontext
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from chainlit.data.base import BaseDataLayer
+from chainlit.data.sql_alchemy import SQLAlchemyDataLayer
+from chainlit.data.utils import queue_until_user_message
+from chainlit.types import Feedback
+from chainlit.types import PageInfo
+from chainlit.types import PaginatedResponse
+from chainlit.types import Pagination
+from chainlit.types import ThreadDict
+from chainlit.types import ThreadFilter
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from libs.logging_helper import logger
+
+# Pending writes are flushed every interval (seconds), or as soon as there
+# are DATA_LAYER_FLUSH_SIZE of them
+DATA_LAYER_FLUSH_INTERVAL = float(
+    os.getenv("DATA_LAYER_FLUSH_INTERVAL", "0.5")
+)
+DATA_LAYER_FLUSH_SIZE = int(os.getenv("DATA_LAYER_FLUSH_SIZE", "100"))
+# Writers wait for a flush beyond this many pending writes
+DATA_LAYER_MAX_PENDING = int(os.getenv("DATA_LAYER_MAX_PENDING", "5000"))
+# Per-worker cache of thread list pages and threads, 0 to disable.
+# Entries are dropped on writes through this worker, and expire after
+# the TTL (seconds) for writes through other workers
+THREAD_CACHE_MAX_SIZE = int(os.getenv("THREAD_CACHE_MAX_SIZE", "1000"))
+THREAD_CACHE_TTL = float(os.getenv("THREAD_CACHE_TTL", "30"))
+
+# Composite indexes for listing the threads of a user and the steps of a
+# thread, by creation time
+THREAD_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS "threads_userId_createdAt_idx" '
+    'ON threads ("userId", "createdAt")',
+    'CREATE INDEX IF NOT EXISTS "steps_threadId_createdAt_idx" '
+    'ON steps ("threadId", "createdAt")',
+)
+
+_batch_session: contextvars.ContextVar[Optional[AsyncSession]] = (
+    contextvars.ContextVar("batch_session", default=None)
+)
+
+
+def encode_cursor(thread: ThreadDict) -> str:
+    """Cursor of a thread in a thread list, its (createdAt, id) key"""
+    key = json.dumps([thread["createdAt"], thread["id"]])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, thread_id = json.loads(base64.urlsafe_b64decode(cursor))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid thread list cursor: {cursor}") from e
+
+    return created_at, thread_id
+
+
+def unwrapped(layer: BaseDataLayer, name: str) -> Callable:
+    """
+    Method of a data layer without its `queue_until_user_message` wrapper,
+    which needs the Chainlit context of a session
+    """
+    method = getattr(type(layer), name)
+    return functools.partial(getattr(method, "__wrapped__", method), layer)
+
+
+class BatchSQLAlchemyDataLayer(SQLAlchemyDataLayer):
+    """SQLAlchemy data layer whose statements can share one transaction"""
+
+    async def execute_sql(
+        self, query: str, parameters: dict
+    ) -> List[Dict[str, Any]] | int | None:
+        if (session := _batch_session.get()) is None:
+            return await super().execute_sql(query, parameters)
+
+        # Errors are raised, to roll back the whole batch
+        result = await session.execute(text(query), parameters)
+        if result.returns_rows:
+            return self.clean_result(
+                [dict(row._mapping) for row in result.fetchall()]
+            )
+
+        return result.rowcount
+
+    @asynccontextmanager
+    async def transaction(self):
+        async with self.async_session() as session:
+            async with session.begin():
+                token = _batch_session.set(session)
+                try:
+                    yield
+                finally:
+                    _batch_session.reset(token)
+
+    @queue_until_user_message()
+    async def update_step(self, step_dict):
+        # Same upsert as create_step, without queueing again
+        await unwrapped(self, "create_step")(step_dict)
+
+    async def create_indexes(self):
+        """Add the indexes of `THREAD_INDEXES`, if missing"""
+        async with self.engine.begin() as conn:
+            for statement in THREAD_INDEXES:
+                await conn.execute(text(statement))
+
+    async def list_threads(
+        self, pagination: Pagination, filters: ThreadFilter
+    ) -> PaginatedResponse:
+        """
+        List a page of the threads of a user, newest first.
+
+        Unless searching or filtering on feedback, which needs the steps of
+        every thread, only the page is read, after the (createdAt, id) key
+        held by the cursor, and without the steps of the threads. The key
+        is in the cursor, so that paging goes on if that thread is deleted.
+        """
+        if filters.search or filters.feedback:
+            return await super().list_threads(pagination, filters)
+        if not filters.userId:
+            raise ValueError("userId is required")
+
+        query = """
+            SELECT "id", "createdAt", "name", "userId", "userIdentifier",
+                "tags", "metadata"
+            FROM threads
+            WHERE "userId" = :user_id
+        """
+        parameters: Dict[str, Any] = {
+            "user_id": filters.userId,
+            "limit": pagination.first + 1,
+        }
+        if pagination.cursor:
+            query += """
+                AND ("createdAt" < :cursor_created_at
+                OR ("createdAt" = :cursor_created_at AND "id" < :cursor_id))
+            """
+            (
+                parameters["cursor_created_at"],
+                parameters["cursor_id"],
+            ) = decode_cursor(pagination.cursor)
+        query += ' ORDER BY "createdAt" DESC, "id" DESC LIMIT :limit'
+
+        rows = await self.execute_sql(query=query, parameters=parameters)
+        rows = rows if isinstance(rows, list) else []
+        threads = [
+            ThreadDict(
+                id=row["id"],
+                createdAt=row["createdAt"],
+                name=row["name"],
+                userId=row["userId"],
+                userIdentifier=row["userIdentifier"],
+                tags=row["tags"],
+                metadata=row["metadata"],
+                steps=[],
+                elements=[],
+            )
+            for row in rows[: pagination.first]
+        ]
+
+        return PaginatedResponse(
+            pageInfo=PageInfo(
+                hasNextPage=len(rows) > pagination.first,
+                startCursor=encode_cursor(threads[0]) if threads else None,
+                endCursor=encode_cursor(threads[-1]) if threads else None,
+            ),
+            data=threads,
+        )
+
+
+class WriteBehindDataLayer(BaseDataLayer):
+    """
+    Data layer that takes writes off the request path.
+
+    Step, element and thread writes are queued and returned from at once.
+    Repeated writes of the same step are merged into one, and the queue is
+    flushed by a background task in one transaction per batch, every
+    `flush_interval` or as soon as `flush_size` writes are pending.
+
+    `get_thread` overlays pending writes on what the database returns,
+    other reads that depend on them flush first.
+    """
+
+    def __init__(
+        self,
+        inner: BaseDataLayer,
+        flush_interval: float = DATA_LAYER_FLUSH_INTERVAL,
+        flush_size: int = DATA_LAYER_FLUSH_SIZE,
+        max_pending: int = DATA_LAYER_MAX_PENDING,
+    ):
+        self.inner = inner
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_pending = max_pending
+
+        # Pending writes in order, steps are keyed by id to be merged
+        self._pending: OrderedDict[Any, Tuple[str, Any]] = OrderedDict()
+        # Writes being flushed, still visible to reads
+        self._flushing: List[Tuple[str, Any]] = []
+        self._seq = 0
+        self._flush_lock = asyncio.Lock()
+        self._wake: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._closed = False
+
+        self.writes = 0
+        self.merged = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+
+    def _start(self):
+        if self._flusher is None or self._flusher.done():
+            self._wake = asyncio.Event()
+            # Outside of any session's Chainlit context
+            self._flusher = contextvars.Context().run(
+                asyncio.create_task, self._run()
+            )
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(
+                    self._wake.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(
+                    {"msg": "Failed to flush data layer", "error": str(e)}
+                )
+
+    async def _enqueue(self, key: Any, op: str, payload: Any):
+        if self._closed:
+            # Write through once shut down
+            await self._apply(op, payload)
+            return
+
+        self._start()
+        self.writes += 1
+
+        if key is None:
+            self._seq += 1
+            key = ("seq", self._seq)
+
+        if op == "upsert_step" and (entry := self._pending.get(key)):
+            if entry[0] == "upsert_step":
+                # Later values win, as in consecutive upserts
+                created, step_dict = entry[1]
+                self._pending[key] = (
+                    op,
+                    (
+                        created or payload[0],
+                        {
+                            **step_dict,
+                            **{
+                                k: v
+                                for k, v in payload[1].items()
+                                if v is not None
+                            },
+                        },
+                    ),
+                )
+                self.merged += 1
+                return
+
+            # Re-created after a pending delete
+            del self._pending[key]
+
+        if op == "delete_step":
+            self._pending.pop(key, None)
+
+        self._pending[key] = (op, payload)
+
+        if len(self._pending) >= self.flush_size:
+            self._wake.set()
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+
+    async def _apply(self, op: str, payload: Any):
+        if op == "upsert_step":
+            created, step_dict = payload
+            await unwrapped(
+                self.inner, "create_step" if created else "update_step"
+            )(step_dict)
+        elif op == "delete_step":
+            await unwrapped(self.inner, "delete_step")(payload)
+        elif op == "create_element":
+            await unwrapped(self.inner, "create_element")(payload)
+        elif op == "delete_element":
+            await unwrapped(self.inner, "delete_element")(*payload)
+        elif op == "update_thread":
+            await self.inner.update_thread(**payload)
+
+    async def flush(self):
+        """Write every pending write, in one transaction if possible"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            batch = self._flushing = list(self._pending.values())
+            self._pending.clear()
+            start_time = time.time()
+
+            transaction = getattr(self.inner, "transaction", nullcontext)
+            try:
+                async with transaction():
+                    for op, payload in batch:
+                        await self._apply(op, payload)
+            except Exception as e:
+                # Replay one by one so a bad write does not lose the batch
+                logger.warning(
+                    {
+                        "msg": "Data layer batch failed, writing one by one",
+                        "error": str(e),
+                        "writes": len(batch),
+                    }
+                )
+                for op, payload in batch:
+                    try:
+                        await self._apply(op, payload)
+                    except Exception as e:
+                        self.failures += 1
+                        logger.error(
+                            {
+                                "msg": "Failed to write to data layer",
+                                "op": op,
+                                "error": str(e),
+                            }
+                        )
+
+            self._flushing = []
+            self.flushes += 1
+            self.flushed += len(batch)
+            logger.debug(
+                {
+                    "msg": "Flushed data layer",
+                    "writes": len(batch),
+                    "time_taken": time.time() - start_time,
+                }
+            )
+
+    async def aclose(self):
+        """Stop the background flush and write what is pending"""
+        self._closed = True
+        if self._flusher is not None:
+            self._wake.set()
+            try:
+                await self._flusher
+            except Exception:
+                pass
+            self._flusher = None
+
+        await self.flush()
+        logger.info({"msg": "Data layer drained", **self.stats()})
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "writes": self.writes,
+            "merged": self.merged,
+            "flushes": self.flushes,
+            "flushed": self.flushed,
+            "failures": self.failures,
+        }
+
+    def _pending_writes(self) -> List[Tuple[str, Any]]:
+        return [*self._flushing, *self._pending.values()]
+
+    def _has_pending(self, thread_id: str) -> bool:
+        for op, payload in self._pending_writes():
+            if (
+                op == "upsert_step"
+                and payload[1].get("threadId") == thread_id
+                or op == "update_thread"
+                and payload["thread_id"] == thread_id
+                or op == "create_element"
+                and payload.thread_id == thread_id
+            ):
+                return True
+
+        return False
+
+    async def _flush_for(self, thread_id: str):
+        if self._has_pending(thread_id):
+            await self.flush()
+
+    # Writes
+
+    @queue_until_user_message()
+    async def create_step(self, step_dict):
+        await self._enqueue(
+            ("step", step_dict["id"]), "upsert_step", (True, dict(step_dict))
+        )
+
+    @queue_until_user_message()
+    async def update_step(self, step_dict):
+        await self._enqueue(
+            ("step", step_dict["id"]), "upsert_step", (False, dict(step_dict))
+        )
+
+    @queue_until_user_message()
+    async def delete_step(self, step_id: str):
+        await self._enqueue(("step", step_id), "delete_step", step_id)
+
+    @queue_until_user_message()
+    async def create_element(self, element):
+        await self._enqueue(None, "create_element", element)
+
+    @queue_until_user_message()
+    async def delete_element(
+        self, element_id: str, thread_id: Optional[str] = None
+    ):
+        await self._enqueue(None, "delete_element", (element_id, thread_id))
+
+    async def update_thread(
+        self,
+        thread_id: str,
+        name: Optional[str] = None,
+        user_id: Optional[str] = None,
+        metadata: Optional[Dict] = None,
+        tags: Optional[List[str]] = None,
+    ):
+        await self._enqueue(
+            None,
+            "update_thread",
+            {
+                "thread_id": thread_id,
+                "name": name,
+                "user_id": user_id,
+                "metadata": metadata,
+                "tags": tags,
+            },
+        )
+
+    # Writes that need a result, or that depend on pending writes
+
+    async def upsert_feedback(self, feedback: Feedback) -> str:
+        await self.flush()
+        return await self.inner.upsert_feedback(feedback)
+
+    async def delete_feedback(self, feedback_id: str) -> bool:
+        return await self.inner.delete_feedback(feedback_id)
+
+    async def delete_thread(self, thread_id: str):
+        await self.flush()
+        await self.inner.delete_thread(thread_id)
+
+    # Reads
+
+    async def get_user(self, identifier: str):
+        return await self.inner.get_user(identifier)
+
+    async def create_user(self, user):
+        return await self.inner.create_user(user)
+
+    async def get_element(self, thread_id: str, element_id: str):
+        await self._flush_for(thread_id)
+        return await self.inner.get_element(thread_id, element_id)
+
+    async def get_thread_author(self, thread_id: str) -> str:
+        await self._flush_for(thread_id)
+        return await self.inner.get_thread_author(thread_id)
+
+    async def list_threads(
+        self, pagination: Pagination, filters: ThreadFilter
+    ) -> PaginatedResponse:
+        await self.flush()
+        return await self.inner.list_threads(pagination, filters)
+
+    async def get_thread(self, thread_id: str) -> Optional[ThreadDict]:
+        thread = await self.inner.get_thread(thread_id)
+        return self._overlay(thread_id, thread)
+
+    def _overlay(
+        self, thread_id: str, thread: Optional[ThreadDict]
+    ) -> Optional[ThreadDict]:
+        """Apply the pending writes of a thread to what was read"""
+        steps: Dict[str, Dict] = {
+            step["id"]: step for step in (thread or {}).get("steps", [])
+        }
+        found = thread is not None
+
+        for op, payload in self._pending_writes():
+            if op == "upsert_step" and payload[1].get("threadId") == thread_id:
+                step_dict = payload[1]
+                steps[step_dict["id"]] = {
+                    **steps.get(step_dict["id"], {}),
+                    **step_dict,
+                }
+                found = True
+            elif op == "delete_step":
+                steps.pop(payload, None)
+            elif op == "update_thread" and payload["thread_id"] == thread_id:
+                if thread is None:
+                    thread = ThreadDict(
+                        id=thread_id,
+                        createdAt=None,
+                        name=None,
+                        userId=None,
+                        userIdentifier=None,
+                        tags=None,
+                        metadata=None,
+                        steps=[],
+                        elements=[],
+                    )
+                for key, field in (
+                    ("name", "name"),
+                    ("user_id", "userId"),
+                    ("metadata", "metadata"),
+                    ("tags", "tags"),
+                ):
+                    if payload[key] is not None:
+                        thread[field] = payload[key]
+                found = True
+
+        if not found:
+            return thread
+
+        if thread is None:
+            return None
+
+        thread["steps"] = sorted(
+            steps.values(), key=lambda step: step.get("createdAt") or ""
+        )
+        return thread
+
+    async def build_debug_url(self) -> str:
+        return await self.inner.build_debug_url()
+
+
+class CachedDataLayer(BaseDataLayer):
+    """
+    Data layer with a TTL + LRU cache of thread list pages, threads and
+    thread authors.
+
+    List pages are keyed by user, cursor and page size, and a generation
+    of the user that any write to one of their threads bumps. Writes to a
+    thread drop its cached copy. Searches are not cached.
+    """
+
+    def __init__(
+        self,
+        inner: BaseDataLayer,
+        max_size: int = THREAD_CACHE_MAX_SIZE,
+        ttl: float = THREAD_CACHE_TTL,
+    ):
+        self.inner = inner
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries: OrderedDict[Any, Tuple[Any, float]] = OrderedDict()
+        self._generations: Dict[Optional[str], int] = {}
+        # Owner of the threads seen, to know whose pages a write changes
+        self._owners: Dict[str, Optional[str]] = {}
+        self._thread_writes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _get(self, key: Any) -> Optional[Any]:
+        if (entry := self._entries.get(key)) is not None:
+            if entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            del self._entries[key]
+
+        self.misses += 1
+        return None
+
+    def _set(self, key: Any, value: Any):
+        if self.max_size <= 0:
+            return
+
+        self._entries[key] = (value, time.time() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _remember_owner(self, thread_id: str, user_id: Optional[str]):
+        if len(self._owners) >= self.max_size * 100:
+            self._owners.clear()
+        self._owners[thread_id] = user_id
+
+    def _invalidate_thread(self, thread_id: Optional[str]):
+        """Drop a cached thread, or every thread if it is not known"""
+        self.invalidations += 1
+        self._thread_writes += 1
+        if thread_id is None:
+            self._entries = OrderedDict(
+                (key, entry)
+                for key, entry in self._entries.items()
+                if key[0] != "thread"
+            )
+            return
+
+        self._entries.pop(("thread", thread_id), None)
+
+    def _invalidate_list(self, thread_id: str, user_id: Optional[str]):
+        """Bump the generation of the owner of a thread, or of everyone
+        if the owner is not known"""
+        self.invalidations += 1
+        if user_id is None:
+            user_id = self._owners.get(thread_id)
+        if user_id is None:
+            self._generations[None] = self._generations.get(None, 0) + 1
+        else:
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def _list_key(self, pagination: Pagination, user_id: str) -> Tuple:
+        return (
+            "list",
+            user_id,
+            pagination.cursor,
+            pagination.first,
+            self._generations.get(user_id, 0),
+            self._generations.get(None, 0),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+    # Writes
+
+    @queue_until_user_message()
+    async def create_step(self, step_dict):
+        self._invalidate_thread(step_dict.get("threadId"))
+        await unwrapped(self.inner, "create_step")(step_dict)
+
+    @queue_until_user_message()
+    async def update_step(self, step_dict):
+        self._invalidate_thread(step_dict.get("threadId"))
+        await unwrapped(self.inner, "update_step")(step_dict)
+
+    @queue_until_user_message()
+    async def delete_step(self, step_id: str):
+        # The thread of the step is not known
+        self._invalidate_thread(None)
+        await unwrapped(self.inner, "delete_step")(step_id)
+
+    @queue_until_user_message()
+    async def create_element(self, element):
+        self._invalidate_thread(element.thread_id)
+        await unwrapped(self.inner, "create_element")(element)
+
+    @queue_until_user_message()
+    async def delete_element(
+        self, element_id: str, thread_id: Optional[str] = None
+    ):
+        self._invalidate_thread(thread_id)
+        await unwrapped(self.inner, "delete_element")(element_id, thread_id)
+
+    async def update_thread(
+        self,
+        thread_id: str,
+        name: Optional[str] = None,
+        user_id: Optional[str] = None,
+        metadata: Optional[Dict] = None,
+        tags: Optional[List[str]] = None,
+    ):
+        if user_id is not None:
+            self._remember_owner(thread_id, user_id)
+        self._invalidate_thread(thread_id)
+        self._invalidate_list(thread_id, user_id)
+        await self.inner.update_thread(
+            thread_id,
+            name=name,
+            user_id=user_id,
+            metadata=metadata,
+            tags=tags,
+        )
+
+    async def delete_thread(self, thread_id: str):
+        self._invalidate_thread(thread_id)
+        self._invalidate_list(thread_id, None)
+        self._entries.pop(("author", thread_id), None)
+        await self.inner.delete_thread(thread_id)
+
+    async def upsert_feedback(self, feedback: Feedback) -> str:
+        self._invalidate_thread(feedback.threadId)
+        return await self.inner.upsert_feedback(feedback)
+
+    async def delete_feedback(self, feedback_id: str) -> bool:
+        self._invalidate_thread(None)
+        return await self.inner.delete_feedback(feedback_id)
+
+    # Reads
+
+    async def list_threads(
+        self, pagination: Pagination, filters: ThreadFilter
+    ) -> PaginatedResponse:
+        if filters.search or filters.feedback or not filters.userId:
+            return await self.inner.list_threads(pagination, filters)
+
+        key = self._list_key(pagination, filters.userId)
+        if (page := self._get(key)) is not None:
+            return page
+
+        page = await self.inner.list_threads(pagination, filters)
+        for thread in page.data:
+            self._remember_owner(thread["id"], filters.userId)
+        # Keyed by the generation from before the read, so a write during
+        # the read makes it stale
+        self._set(key, page)
+        return page
+
+    async def get_thread(self, thread_id: str) -> Optional[ThreadDict]:
+        if (thread := self._get(("thread", thread_id))) is None:
+            writes = self._thread_writes
+            thread = await self.inner.get_thread(thread_id)
+            if thread is None:
+                return None
+
+            self._remember_owner(thread_id, thread.get("userId"))
+            # Unless a write may have made it stale during the read
+            if writes == self._thread_writes:
+                self._set(("thread", thread_id), thread)
+
+        # Callers get their own list of steps
+        return ThreadDict(**{**thread, "steps": list(thread["steps"])})
+
+    async def get_thread_author(self, thread_id: str) -> str:
+        if (author := self._get(("author", thread_id))) is not None:
+            return author
+
+        author = await self.inner.get_thread_author(thread_id)
+        self._set(("author", thread_id), author)
+        return author
+
+    async def get_user(self, identifier: str):
+        return await self.inner.get_user(identifier)
+
+    async def create_user(self, user):
+        return await self.inner.create_user(user)
+
+    async def get_element(self, thread_id: str, element_id: str):
+        return await self.inner.get_element(thread_id, element_id)
+
+    async def build_debug_url(self) -> str:
+        return await self.inner.build_debug_url()
@@ -3,8 +3,10 @@ import os
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
 from constants import VERSION
+from libs import metrics
 
 app = FastAPI(docs_url=None, redoc_url=None)
 
@@ -24,6 +26,19 @@ app.add_middleware(
 #     return {"message": "Ok", "v": VERSION}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Metrics of all workers, in the Prometheus text format"""
+    return PlainTextResponse(
+        await metrics.exporter.collect(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+app.router.on_startup.append(metrics.exporter.start)
+app.router.on_shutdown.append(metrics.exporter.stop)
+
+
 if __name__ == "__main__":
     import multiprocessing
     import uvicorn
@@ -1,13 +1,21 @@
+import asyncio
 import os
+import re
+import time
+from collections.abc import Awaitable
 from collections.abc import Callable
+from contextvars import ContextVar
 from typing import Any
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing import Union
 from uuid import UUID
 
 import chainlit as cl
+from chainlit.chat_context import chat_context
 from chainlit.config import config
 from langchain_core.callbacks import AsyncCallbackHandler
 from langchain_core.messages import BaseMessage
@@ -15,15 +23,409 @@ from langchain_core.outputs import ChatGenerationChunk
 from langchain_core.outputs import GenerationChunk
 from langchain_core.outputs import LLMResult
 
+from libs import metrics
+from libs import tracing
+from libs.logging_helper import logger
+
+OUTPUT_GUARDRAIL_MIN_CHARS = int(os.getenv("OUTPUT_GUARDRAIL_MIN_CHARS", "80"))
+OUTPUT_GUARDRAIL_MAX_CHARS = int(
+    os.getenv("OUTPUT_GUARDRAIL_MAX_CHARS", "400")
+)
+OUTPUT_GUARDRAIL_MAX_CONCURRENCY = int(
+    os.getenv("OUTPUT_GUARDRAIL_MAX_CONCURRENCY", "2")
+)
+
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL", "0.03"))
+STREAM_FLUSH_SIZE = int(os.getenv("STREAM_FLUSH_SIZE", "200"))
+
+SENTENCE_END = re.compile(r"[.!?。\n]\s*$")
+
+
+class SpeculativeGate:
+    """
+    Hold back streamed tokens while a guardrail check runs in parallel
+    with the LLM, until the check is decided
+    """
+
+    def __init__(self):
+        self.passed: Optional[bool] = None
+        self._decided = asyncio.Event()
+        self._listeners: List[Callable[[], Awaitable[Any]]] = []
+
+    @property
+    def decided(self) -> bool:
+        return self._decided.is_set()
+
+    def add_listener(self, listener: Callable[[], Awaitable[Any]]):
+        """Register a coroutine to be awaited once the check passes"""
+        self._listeners.append(listener)
+
+    async def open(self):
+        self.passed = True
+        self._decided.set()
+        for listener in self._listeners:
+            await listener()
+
+    def close(self):
+        self.passed = False
+        self._decided.set()
+
+    async def wait(self) -> bool:
+        await self._decided.wait()
+        return bool(self.passed)
+
+
+speculative_gate: ContextVar[Optional[SpeculativeGate]] = ContextVar(
+    "speculative_gate", default=None
+)
+"""Gate of the speculative LLM run in the current context, if any"""
+
+
+class OutputGuardrailError(Exception):
+    """Raised into the LLM run to stop it when its output fails a check"""
+
+
+class OutputGuardrail:
+    """
+    Validate a streamed answer chunk by chunk while it is being streamed.
+
+    Tokens are gathered into chunks that end on a sentence boundary once
+    they reach `min_chars`, or are cut at `max_chars`. Each chunk is checked
+    in the background, with at most `max_concurrency` checks in flight.
+    """
+
+    def __init__(
+        self,
+        validator: Callable[[str], Awaitable[Tuple[bool, str | None]]],
+        min_chars: int = OUTPUT_GUARDRAIL_MIN_CHARS,
+        max_chars: int = OUTPUT_GUARDRAIL_MAX_CHARS,
+        max_concurrency: int = OUTPUT_GUARDRAIL_MAX_CONCURRENCY,
+    ):
+        self.validator = validator
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.error_message: Optional[str] = None
+        self._buffer = ""
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def failed(self) -> bool:
+        return self.error_message is not None
+
+    def feed(self, token: str):
+        self._buffer += token
+
+        if len(self._buffer) >= self.max_chars or (
+            len(self._buffer) >= self.min_chars
+            and SENTENCE_END.search(self._buffer)
+        ):
+            self._submit()
+
+    def _submit(self):
+        if self._buffer.strip() and not self.failed:
+            task = asyncio.create_task(self._check(self._buffer))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        self._buffer = ""
+
+    async def _check(self, text: str):
+        async with self.semaphore:
+            if self.failed:
+                return
+
+            try:
+                passed, error_message = await self.validator(text)
+            except Exception as e:
+                # Do not hide an answer because the check itself errored
+                logger.warning(
+                    {"msg": "Output guardrail check failed", "error": str(e)}
+                )
+                return
+
+            if not passed and not self.failed:
+                self.error_message = error_message or "Output check failed"
+
+    async def finish(self) -> bool:
+        """Check the remaining text and wait for every pending check,
+        returns whether the whole answer passed"""
+        self._submit()
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+        return not self.failed
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+
+class AnswerStream:
+    """State of one streamed answer, from the start of the LLM run to
+    its end"""
+
+    def __init__(
+        self,
+        message: cl.Message,
+        output_guardrail: Optional[OutputGuardrail],
+        gate: Optional[SpeculativeGate],
+        flush_interval: float,
+        flush_size: int,
+        span: tracing.Span,
+    ):
+        self.message = message
+        self.output_guardrail = output_guardrail
+        self.gate = gate
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.span = span
+        self.pending_tokens: List[str] = []
+        self.pending_size = 0
+        self.last_emit = 0.0
+        self.flush_timer: Optional[asyncio.TimerHandle] = None
+        self.flush_tasks: Set[asyncio.Task] = set()
+        self.held_tokens: List[str] = []
+        self.lock = asyncio.Lock()
+        self.start = time.monotonic()
+        self.first_token_at = 0.0
+        self.token_count = 0
+        self.emit_count = 0
+        self.emit_time = 0.0
+
+        if self.gate is not None:
+            self.gate.add_listener(self.release_held_tokens)
+
+    async def on_token(self, token: str):
+        self.token_count += 1
+        if self.token_count == 1:
+            self.first_token_at = time.monotonic()
+            metrics.TIME_TO_FIRST_TOKEN.observe(
+                self.first_token_at - self.start
+            )
+            self.span.add_event("first_token")
+
+        if self.output_guardrail is not None:
+            if self.output_guardrail.failed:
+                raise OutputGuardrailError(self.output_guardrail.error_message)
+
+            self.output_guardrail.feed(token)
+
+        if self.gate is not None and not self.gate.decided:
+            self.held_tokens.append(token)
+            return
+
+        async with self.lock:
+            await self.stream_held_tokens()
+            await self.stream_token(token)
+
+    async def stream_token(self, token: str):
+        """Queue a token to be emitted, must be called holding the lock.
+
+        The first token is emitted right away, later ones are coalesced
+        until `flush_interval` has passed or `flush_size` is reached."""
+        self.pending_tokens.append(token)
+        self.pending_size += len(token)
+
+        if (
+            not self.message.content
+            or self.pending_size >= self.flush_size
+            or time.monotonic() - self.last_emit >= self.flush_interval
+        ):
+            await self.emit_pending_tokens()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(
+                self.flush_interval, self.schedule_flush
+            )
+
+    async def emit_pending_tokens(self):
+        """Emit queued tokens at once, must be called holding the lock"""
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        if not self.pending_tokens:
+            return
+
+        text = "".join(self.pending_tokens)
+        self.pending_tokens = []
+        self.pending_size = 0
+
+        if not self.message.content:
+            # await cl.user_session.get("waiting_message").remove()
+
+            await self.message.send()
+
+        start = time.monotonic()
+        await self.message.stream_token(text)
+        self.last_emit = time.monotonic()
+        self.emit_count += 1
+        self.emit_time += self.last_emit - start
+
+    def schedule_flush(self):
+        self.flush_timer = None
+        task = asyncio.create_task(self.flush())
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush(self):
+        async with self.lock:
+            await self.emit_pending_tokens()
+
+    def drop_pending_tokens(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+        self.held_tokens = []
+        self.pending_tokens = []
+        self.pending_size = 0
+
+    async def stream_held_tokens(self):
+        if self.held_tokens:
+            held_tokens, self.held_tokens = self.held_tokens, []
+            await self.stream_token("".join(held_tokens))
+
+    async def release_held_tokens(self):
+        """Forward tokens held back by the speculative gate"""
+        async with self.lock:
+            await self.stream_held_tokens()
+
+    async def finish(self) -> bool:
+        """Emit the rest of the answer, returns whether it should be
+        kept"""
+        if self.token_count > 1 and (
+            elapsed := time.monotonic() - self.first_token_at
+        ):
+            metrics.TOKENS_PER_SECOND.observe((self.token_count - 1) / elapsed)
+
+        if self.gate is not None:
+            if not await self.gate.wait():
+                # The guardrail check failed, drop the speculative answer
+                return False
+
+            async with self.lock:
+                await self.stream_held_tokens()
+
+        if (
+            self.output_guardrail is not None
+            and not await self.output_guardrail.finish()
+        ):
+            return await self.replace_failed_answer()
+
+        async with self.lock:
+            await self.emit_pending_tokens()
+
+        if not self.shown:
+            return False
+
+        await self.message.update()
+        return True
+
+    async def fail(self, error: BaseException) -> bool:
+        """Emit what was streamed before the error, returns whether the
+        answer should be kept"""
+        if self.output_guardrail is not None:
+            self.output_guardrail.cancel()
+            if isinstance(error, OutputGuardrailError):
+                return await self.replace_failed_answer()
+
+        if self.gate is not None and not self.gate.passed:
+            # Nothing was shown, the input check was not passed yet
+            self.drop_pending_tokens()
+            return False
+
+        async with self.lock:
+            await self.emit_pending_tokens()
+
+        if isinstance(error, asyncio.CancelledError) and self.shown:
+            # Cancelled by a new message or the stop button, keep what was
+            # shown in the data layer and in memory
+            await self.message.update()
+            return True
+
+        return False
+
+    @property
+    def shown(self) -> bool:
+        """Whether the answer was sent and not removed since, by an edit
+        of an earlier message"""
+        return bool(self.message.content) and any(
+            message is self.message for message in chat_context.get()
+        )
+
+    async def replace_failed_answer(self) -> bool:
+        """Replace a streamed answer that failed the output guardrail"""
+        if self.output_guardrail is None:
+            return False
+
+        if self.gate is not None and not await self.gate.wait():
+            # Nothing was shown, the input check reports its own warning
+            return False
+
+        self.drop_pending_tokens()
+        sent = bool(self.message.content)
+        self.message.content = (
+            f"**WARNING**: {self.output_guardrail.error_message}"
+        )
+        if sent:
+            await self.message.update()
+        else:
+            await self.message.send()
+
+        return True
+
+    def end_span(self, error: Optional[BaseException] = None):
+        self.span.set(
+            tokens=self.token_count,
+            emits=self.emit_count,
+            emit_time=self.emit_time,
+        )
+        self.span.end(error)
+
 
 class AnswerCallbackHandler(AsyncCallbackHandler):
-    message: cl.Message
+    """
+    Stream chat model answers to the UI.
+
+    One handler serves every run of a session: the state of each answer
+    is kept per LLM run, in an `AnswerStream`.
+    """
+
     elements: List[cl.element.Element] = []
     on_message_complete: Callable[[cl.Message], Any] = lambda message: None
 
-    def __init__(self, on_message_complete: Callable[[cl.Message], Any]):
+    def __init__(
+        self,
+        on_message_complete: Callable[[cl.Message], Any],
+        output_validator: Optional[
+            Callable[[str], Awaitable[Tuple[bool, str | None]]]
+        ] = None,
+        flush_interval: float = STREAM_FLUSH_INTERVAL,
+        flush_size: int = STREAM_FLUSH_SIZE,
+    ):
+        """
+        :param on_message_complete: Called with the final answer message
+        :param output_validator: Optional check of the streamed answer
+        :param flush_interval: Seconds to coalesce tokens into one emit,
+            0 to emit every token
+        :param flush_size: Emit as soon as this many characters are pending
+        """
         super().__init__()
         self.on_message_complete = on_message_complete
+        self.output_validator = output_validator
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.streams: Dict[UUID, AnswerStream] = {}
+
+    @property  # type: ignore[override]
+    def raise_error(self) -> bool:
+        """Only let the output guardrail error propagate, to stop the run"""
+        return any(
+            stream.output_guardrail is not None
+            and stream.output_guardrail.failed
+            for stream in self.streams.values()
+        )
 
     async def on_chat_model_start(
         self,
@@ -36,16 +438,30 @@ class AnswerCallbackHandler(AsyncCallbackHandler):
         metadata: Optional[Dict[str, Any]] = None,
         **kwargs: Any,
     ) -> Any:
-        self.message = cl.Message(
-            content="",
-            author=(
-                metadata["run_name"]
-                if os.getenv("LOG_LEVEL") == "DEBUG"
-                and metadata is not None
-                and "run_name" in metadata
-                else config.ui.name
+        self.streams[run_id] = AnswerStream(
+            message=cl.Message(
+                content="",
+                author=(
+                    metadata["run_name"]
+                    if os.getenv("LOG_LEVEL") == "DEBUG"
+                    and metadata is not None
+                    and "run_name" in metadata
+                    else config.ui.name
+                ),
+                elements=self.elements or [],
+            ),
+            output_guardrail=(
+                OutputGuardrail(self.output_validator)
+                if self.output_validator
+                else None
+            ),
+            gate=speculative_gate.get(),
+            flush_interval=self.flush_interval,
+            flush_size=self.flush_size,
+            span=tracing.start_span(
+                "llm.stream",
+                model=(metadata or {}).get("ls_model_name", ""),
             ),
-            elements=self.elements or [],
         )
 
     async def on_llm_new_token(
@@ -57,12 +473,8 @@ class AnswerCallbackHandler(AsyncCallbackHandler):
         parent_run_id: Optional[UUID] = None,
         **kwargs: Any,
     ) -> Any:
-        if not self.message.content:
-            # await cl.user_session.get("waiting_message").remove()
-
-            await self.message.send()
-
-        await self.message.stream_token(token)
+        if (stream := self.streams.get(run_id)) is not None:
+            await stream.on_token(token)
 
     async def on_llm_end(
         self,
@@ -73,5 +485,28 @@ class AnswerCallbackHandler(AsyncCallbackHandler):
         tags: Optional[List[str]] = None,
         **kwargs: Any,
     ) -> None:
-        await self.message.update()
-        await self.on_message_complete(self.message)
+        if (stream := self.streams.get(run_id)) is None:
+            return
+
+        try:
+            if await stream.finish():
+                await self.on_message_complete(stream.message)
+        finally:
+            del self.streams[run_id]
+            stream.end_span()
+
+    async def on_llm_error(
+        self,
+        error: BaseException,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        tags: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> None:
+        if (stream := self.streams.pop(run_id, None)) is None:
+            return
+
+        stream.end_span(error)
+        if await stream.fail(error):
+            await self.on_message_complete(stream.message)
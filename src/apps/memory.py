@@ -0,0 +1,572 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage
+from langchain_core.messages import BaseMessage
+from langchain_core.messages import HumanMessage
+from langchain_core.messages import messages_from_dict
+from langchain_core.messages import SystemMessage
+
+from libs.logging_helper import logger
+
+# Default prompt size, in tokens, for profiles without their own budget
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000"))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+TOKENIZER_LOAD_TIMEOUT = float(os.getenv("TOKENIZER_LOAD_TIMEOUT", "10"))
+
+# Older messages of a resumed chat are paged into memory this many at a
+# time, when the prompt window needs them
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+
+# Bounds of the conversation memory kept in RAM per worker, idle or excess
+# sessions are spilled to a local SQLite file and reloaded on next access
+SESSION_MEMORY_MAX_SESSIONS = int(
+    os.getenv("SESSION_MEMORY_MAX_SESSIONS", "1000")
+)
+SESSION_MEMORY_MAX_MESSAGES = int(
+    os.getenv("SESSION_MEMORY_MAX_MESSAGES", "50000")
+)
+SESSION_MEMORY_IDLE_TIMEOUT = float(
+    os.getenv("SESSION_MEMORY_IDLE_TIMEOUT", "600")
+)
+# Defaults to a file per worker process in the temp directory
+SESSION_MEMORY_DB_PATH = os.getenv("SESSION_MEMORY_DB_PATH")
+
+MESSAGE_TOKEN_OVERHEAD = 4
+"""Tokens added by the chat format around each message"""
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+_token_counter: Callable[[str], int] = estimate_tokens
+"""Counts tokens with the tokenizer once it is loaded"""
+
+
+def load_token_counter() -> Callable[[str], int]:
+    """Load the tiktoken encoding, which may download it, or fall back to
+    estimating token counts if it cannot be loaded"""
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        logger.warning(
+            {
+                "msg": "Tokenizer unavailable, estimating token counts",
+                "error": str(e),
+            }
+        )
+        return estimate_tokens
+
+
+async def load_tokenizer():
+    """
+    Load the tokenizer in a thread when the server starts.
+
+    Token counts are estimated until it is loaded: startup waits for it
+    up to `TOKENIZER_LOAD_TIMEOUT` seconds, then goes on while it keeps
+    loading, so that an offline worker does not stall every session.
+    """
+
+    def set_token_counter(task: asyncio.Future):
+        global _token_counter
+
+        if not task.cancelled():
+            _token_counter = task.result()
+
+    task = asyncio.ensure_future(asyncio.to_thread(load_token_counter))
+    task.add_done_callback(set_token_counter)
+
+    _, pending = await asyncio.wait({task}, timeout=TOKENIZER_LOAD_TIMEOUT)
+    if pending:
+        logger.warning(
+            {
+                "msg": "Tokenizer still loading, estimating token counts",
+                "encoding": TOKENIZER_ENCODING,
+            }
+        )
+
+
+def count_tokens(content: str) -> int:
+    return _token_counter(content) + MESSAGE_TOKEN_OVERHEAD
+
+
+MESSAGE_TYPES = {
+    "human": HumanMessage,
+    "ai": AIMessage,
+    "system": SystemMessage,
+}
+
+Record = Tuple[str, str, Dict[str, Any], int]
+"""Compact form of a message: type, content, additional kwargs, tokens"""
+PendingRecord = Tuple[str, str, Dict[str, Any]]
+"""A record not paged in yet, so not tokenized"""
+
+
+def to_pending_record(message: BaseMessage) -> PendingRecord:
+    content = (
+        message.content
+        if isinstance(message.content, str)
+        else json.dumps(message.content)
+    )
+    return message.type, content, message.additional_kwargs
+
+
+def to_record(message: BaseMessage) -> Record:
+    message_type, content, kwargs = to_pending_record(message)
+    return message_type, content, kwargs, count_tokens(content)
+
+
+def from_record(record: Record) -> BaseMessage:
+    message_type, content, kwargs, _ = record
+    if message_class := MESSAGE_TYPES.get(message_type):
+        return message_class(content=content, additional_kwargs=kwargs)
+
+    return messages_from_dict(
+        [
+            {
+                "type": message_type,
+                "data": {"content": content, "additional_kwargs": kwargs},
+            }
+        ]
+    )[0]
+
+
+def get_message_id(message: BaseMessage) -> Optional[str]:
+    """Chainlit message id of a message in memory, if any"""
+    return message.additional_kwargs.get("id")
+
+
+class IndexedChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history kept as compact records, with an index of Chainlit
+    message ids.
+
+    Records are kept in an append-only list, so finding an edited message,
+    truncating the history after it and reading the tail take constant time
+    instead of a scan of the whole history. LangChain messages are only
+    built for what is read, e.g. the prompt window.
+
+    The token count of each message is computed once, when it is added,
+    so that the prompt window can be chosen without re-tokenizing.
+
+    Older messages can be left pending, e.g. when resuming a long chat,
+    and are paged in only when the prompt window or an edit reaches them.
+    Leading system messages are never left pending, as every prompt
+    window starts with them.
+    """
+
+    def __init__(
+        self,
+        messages: Iterable[BaseMessage] = (),
+        records: Iterable[Record] = (),
+        older: Iterable[PendingRecord] = (),
+    ):
+        pending: List[PendingRecord] = [tuple(r) for r in older]
+        pinned = 0
+        while pinned < len(pending) and pending[pinned][0] == "system":
+            pinned += 1
+
+        self.records: List[Record] = [
+            *(
+                (message_type, content, kwargs, count_tokens(content))
+                for message_type, content, kwargs in pending[:pinned]
+            ),
+            *(tuple(record) for record in records),
+            *(to_record(message) for message in messages),
+        ]
+        self.older: List[PendingRecord] = pending[pinned:]
+        """Messages after the leading system messages and before the
+        others, not paged in yet, oldest first"""
+        self._older_ids = {
+            message_id for r in self.older if (message_id := r[2].get("id"))
+        }
+        """Chainlit message ids of the older messages"""
+        self._index: Dict[str, int] = {}
+        """Position of each record, by Chainlit message id"""
+        self._reindex()
+
+    def _pinned(self) -> int:
+        """Number of leading system records"""
+        pinned = 0
+        while (
+            pinned < len(self.records) and self.records[pinned][0] == "system"
+        ):
+            pinned += 1
+
+        return pinned
+
+    def _reindex(self):
+        self._index = {
+            message_id: i
+            for i, record in enumerate(self.records)
+            if (message_id := record[2].get("id"))
+        }
+
+    def page_in(self, count: Optional[int] = HISTORY_PAGE_SIZE) -> int:
+        """Page in the latest `count` older messages, or all of them if
+        `count` is None, and return how many were paged in"""
+        if not self.older:
+            return 0
+
+        split = 0 if count is None else max(len(self.older) - count, 0)
+        page = self.older[split:]
+        del self.older[split:]
+        for _, _, kwargs in page:
+            self._older_ids.discard(kwargs.get("id"))
+
+        pinned = self._pinned()
+        self.records[pinned:pinned] = [
+            (message_type, content, kwargs, count_tokens(content))
+            for message_type, content, kwargs in page
+        ]
+        self._reindex()
+        return len(page)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return [from_record(record) for record in self.records]
+
+    @property
+    def token_count(self) -> int:
+        return sum(record[3] for record in self.records)
+
+    def add_message(self, message: BaseMessage) -> None:
+        if message_id := get_message_id(message):
+            self._index[message_id] = len(self.records)
+
+        self.records.append(to_record(message))
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        for message in messages:
+            self.add_message(message)
+
+    def index_of(self, message_id: Optional[str]) -> Optional[int]:
+        if not message_id:
+            return None
+
+        if message_id not in self._index and message_id in self._older_ids:
+            # An older message was edited
+            self.page_in(None)
+
+        return self._index.get(message_id)
+
+    def truncate(self, index: int) -> None:
+        """Remove the message at `index` and every message after it"""
+        for record in self.records[index:]:
+            if message_id := record[2].get("id"):
+                self._index.pop(message_id, None)
+
+        del self.records[index:]
+
+    @property
+    def last_message(self) -> Optional[BaseMessage]:
+        return from_record(self.records[-1]) if self.records else None
+
+    def pop(self) -> BaseMessage:
+        """Remove and return the last message"""
+        record = self.records.pop()
+        if message_id := record[2].get("id"):
+            self._index.pop(message_id, None)
+
+        return from_record(record)
+
+    def tail(self, n: int) -> List[BaseMessage]:
+        """The last `n` messages"""
+        return [from_record(r) for r in self.records[-n:]] if n > 0 else []
+
+    def window(self, token_budget: int) -> Tuple[List[BaseMessage], int]:
+        """
+        Pick the prompt messages for a token budget.
+
+        Leading system messages are always kept, followed by the longest
+        run of latest messages that fits in the remaining budget. The last
+        message is kept even if it does not fit on its own.
+
+        Returns the messages and their token count.
+        """
+        while True:
+            messages, tokens, complete = self._window(token_budget)
+            if complete or not self.page_in():
+                return messages, tokens
+
+    def _window(
+        self, token_budget: int
+    ) -> Tuple[List[BaseMessage], int, bool]:
+        records = self.records
+        pinned = self._pinned()
+
+        tokens = sum(record[3] for record in records[:pinned])
+        start = len(records)
+        while start > pinned and (
+            start == len(records)
+            or tokens + records[start - 1][3] <= token_budget
+        ):
+            start -= 1
+            tokens += records[start][3]
+
+        return (
+            [from_record(record) for record in records[:pinned]]
+            + [from_record(record) for record in records[start:]],
+            tokens,
+            # Otherwise the budget may have room for older messages
+            start > pinned,
+        )
+
+    def clear(self) -> None:
+        self.records = []
+        self.older = []
+        self._older_ids = set()
+        self._index = {}
+
+
+class SessionMemoryStore:
+    """
+    Conversation memory of the sessions of this worker.
+
+    The most recently used sessions are kept in RAM, least recently used
+    first. Sessions idle for longer than `idle_timeout`, or beyond the
+    session and message caps, are written to a local SQLite file by
+    `spill` and loaded back on their next access.
+
+    The number of messages in RAM is kept as a running total, counting
+    each session as of its last access.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = SESSION_MEMORY_MAX_SESSIONS,
+        max_messages: int = SESSION_MEMORY_MAX_MESSAGES,
+        idle_timeout: float = SESSION_MEMORY_IDLE_TIMEOUT,
+        db_path: Optional[str] = SESSION_MEMORY_DB_PATH,
+    ):
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.db_path = db_path or os.path.join(
+            tempfile.gettempdir(), f"session_memory_{os.getpid()}.sqlite"
+        )
+        # A file of our own is removed on close
+        self._owns_db = not db_path
+
+        self._hot: OrderedDict[
+            str, Tuple[IndexedChatMessageHistory, float, int]
+        ] = OrderedDict()
+        """History, last use and message count of each session in RAM"""
+        self.hot_messages = 0
+        # Sessions being written to disk, still readable until done
+        self._spilling: Dict[str, IndexedChatMessageHistory] = {}
+        self._spill_lock = asyncio.Lock()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+        self.spills = 0
+        self.rehydrations = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_memory ("
+                "session_id TEXT PRIMARY KEY, records TEXT NOT NULL, "
+                "updated_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+        return self._conn
+
+    def _read(self, session_id: str) -> Optional[IndexedChatMessageHistory]:
+        with self._lock:
+            if self._conn is None:
+                return None
+            row = self._conn.execute(
+                "SELECT records FROM session_memory WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        data = json.loads(row[0])
+        return IndexedChatMessageHistory(
+            records=data["records"], older=data["older"]
+        )
+
+    def _write(self, sessions: Dict[str, IndexedChatMessageHistory]):
+        rows = [
+            (
+                session_id,
+                json.dumps(
+                    {"records": history.records, "older": history.older}
+                ),
+                time.time(),
+            )
+            for session_id, history in sessions.items()
+        ]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO session_memory VALUES (?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+
+    def _delete(self, session_id: str):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.execute(
+                    "DELETE FROM session_memory WHERE session_id = ?",
+                    (session_id,),
+                )
+                self._conn.commit()
+
+    def _touch(
+        self, session_id: str, history: IndexedChatMessageHistory
+    ) -> IndexedChatMessageHistory:
+        self._evict(session_id)
+        messages = len(history)
+        self._hot[session_id] = (history, time.monotonic(), messages)
+        self.hot_messages += messages
+        return history
+
+    def _evict(self, session_id: str):
+        if (entry := self._hot.pop(session_id, None)) is not None:
+            self.hot_messages -= entry[2]
+
+    def get_cached(
+        self, session_id: str
+    ) -> Optional[IndexedChatMessageHistory]:
+        """Memory of the session if it is in RAM, without reading the disk"""
+        if (entry := self._hot.get(session_id)) is not None:
+            return self._touch(session_id, entry[0])
+
+        if (history := self._spilling.get(session_id)) is not None:
+            return self._touch(session_id, history)
+
+        return None
+
+    async def aget(
+        self, session_id: str
+    ) -> Optional[IndexedChatMessageHistory]:
+        """Memory of the session, loading it from disk if spilled"""
+        if (history := self.get_cached(session_id)) is not None:
+            return history
+
+        history = await asyncio.to_thread(self._read, session_id)
+        # The session may have been set while reading
+        if (cached := self.get_cached(session_id)) is not None:
+            return cached
+
+        if history is not None:
+            self.rehydrations += 1
+            return self._touch(session_id, history)
+
+        return None
+
+    def set(self, session_id: str, history: IndexedChatMessageHistory):
+        self._spilling.pop(session_id, None)
+        self._touch(session_id, history)
+
+    def discard(self, session_id: str):
+        self._evict(session_id)
+        self._spilling.pop(session_id, None)
+        self._delete(session_id)
+
+    async def spill(self):
+        """Move idle sessions, and sessions beyond the caps, to disk"""
+        if self._spill_lock.locked():
+            return
+
+        async with self._spill_lock:
+            now = time.monotonic()
+            hot_messages = self.hot_messages
+            victims: Dict[str, IndexedChatMessageHistory] = {}
+
+            for session_id, (
+                history,
+                last_used,
+                messages,
+            ) in self._hot.items():
+                if not (
+                    now - last_used > self.idle_timeout
+                    or len(self._hot) - len(victims) > self.max_sessions
+                    or hot_messages > self.max_messages
+                ):
+                    # Sessions are ordered by last use
+                    break
+                victims[session_id] = history
+                hot_messages -= messages
+
+            if not victims:
+                return
+
+            for session_id in victims:
+                self._evict(session_id)
+            self._spilling.update(victims)
+
+            try:
+                await asyncio.to_thread(self._write, victims)
+                self.spills += len(victims)
+            except Exception as e:
+                # Keep them in RAM rather than losing them
+                for session_id, history in victims.items():
+                    if session_id in self._spilling:
+                        self._touch(session_id, history)
+                logger.error(
+                    {"msg": "Failed to spill session memory", "error": str(e)}
+                )
+            finally:
+                for session_id in victims:
+                    self._spilling.pop(session_id, None)
+
+            logger.info(
+                {
+                    "msg": "Spilled session memory",
+                    "sessions": len(victims),
+                    **self.stats(),
+                }
+            )
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        if self._owns_db:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.db_path + suffix):
+                    os.remove(self.db_path + suffix)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hot_sessions": len(self._hot),
+            "hot_messages": self.hot_messages,
+            "spills": self.spills,
+            "rehydrations": self.rehydrations,
+        }
+
+
+session_memory = SessionMemoryStore()
@@ -10,3 +10,5 @@ class LLMProfile(BaseModel):
     description: str
     icon: Optional[str] = None
     default_llm_config: LLMConfig
+    context_token_budget: Optional[int] = None
+    max_concurrency: Optional[int] = None
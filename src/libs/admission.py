@@ -0,0 +1,256 @@
+"""
+Admission control of the calls of chat turns, per upstream (an LLM
+profile, Sentinel).
+
+Each upstream has a number of slots per worker, held for the duration of
+one call. Calls over the limit wait in a bounded queue served round-robin
+across users, so that one user sending many messages does not hold back
+the others. Once the queue is full, or a call waited too long, it is
+rejected.
+"""
+
+import asyncio
+import os
+import time
+from collections import deque
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Optional
+
+from libs import metrics
+
+# Default slots per worker, 0 for no limit
+ADMISSION_LLM_MAX_CONCURRENCY = int(
+    os.getenv("ADMISSION_LLM_MAX_CONCURRENCY", "32")
+)
+ADMISSION_SENTINEL_MAX_CONCURRENCY = int(
+    os.getenv("ADMISSION_SENTINEL_MAX_CONCURRENCY", "32")
+)
+# Turns waiting per upstream, further turns are rejected
+ADMISSION_MAX_WAITING = int(os.getenv("ADMISSION_MAX_WAITING", "100"))
+# Seconds a turn may wait for a slot before it is rejected
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "60"))
+# Seconds between updates of the queue position of a waiting turn
+ADMISSION_POSITION_INTERVAL = float(
+    os.getenv("ADMISSION_POSITION_INTERVAL", "1")
+)
+
+
+class AdmissionRejected(Exception):
+    """The turn was not admitted, the upstream is overloaded"""
+
+    def __init__(self, upstream: str, reason: str):
+        super().__init__(f"{upstream}: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+
+
+class FairLimiter:
+    """Limit the turns using an upstream at once, queueing the others
+    round-robin per user"""
+
+    def __init__(
+        self,
+        upstream: str,
+        limit: int,
+        max_waiting: int = ADMISSION_MAX_WAITING,
+        max_wait: float = ADMISSION_MAX_WAIT,
+        position_interval: float = ADMISSION_POSITION_INTERVAL,
+    ):
+        self.upstream = upstream
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.position_interval = position_interval
+        self.active = 0
+        self.waiting = 0
+        # Waiters of each user, users in the order they are served
+        self._queues: OrderedDict[str, Deque[asyncio.Future]] = OrderedDict()
+
+    def position(self, user: str, waiter: asyncio.Future) -> int:
+        """Turns served before `waiter`, plus one"""
+        index = self._queues[user].index(waiter)
+        position = 1
+        ahead = True
+        for other, queue in self._queues.items():
+            if other == user:
+                ahead = False
+            position += min(len(queue), index)
+            if ahead and len(queue) > index:
+                position += 1
+
+        return position
+
+    def _update_metrics(self):
+        metrics.ADMISSION_ACTIVE.set(self.active, upstream=self.upstream)
+        metrics.ADMISSION_QUEUE_DEPTH.set(self.waiting, upstream=self.upstream)
+
+    def _reject(self, reason: str):
+        metrics.ADMISSION_REJECTED.inc(upstream=self.upstream, reason=reason)
+        raise AdmissionRejected(self.upstream, reason)
+
+    def _remove(self, user: str, waiter: asyncio.Future):
+        queue = self._queues[user]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[user]
+        self.waiting -= 1
+
+    async def acquire(
+        self,
+        user: str,
+        on_position: Optional[Callable[[int], Awaitable[Any]]] = None,
+    ):
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self._update_metrics()
+            return
+
+        if self.waiting >= self.max_waiting:
+            self._reject("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append(waiter)
+        self.waiting += 1
+        self._update_metrics()
+
+        start = time.monotonic()
+        position = 0
+        try:
+            while not waiter.done():
+                if time.monotonic() - start >= self.max_wait:
+                    self._remove(user, waiter)
+                    self._reject("timeout")
+
+                if (
+                    on_position is not None
+                    and (new_position := self.position(user, waiter))
+                    != position
+                ):
+                    position = new_position
+                    await on_position(position)
+
+                await asyncio.wait(
+                    [waiter],
+                    timeout=min(
+                        self.position_interval,
+                        max(self.max_wait - (time.monotonic() - start), 0),
+                    ),
+                )
+        except AdmissionRejected:
+            raise
+        except BaseException:
+            if waiter.done():
+                # Admitted meanwhile, hand the slot over
+                self.release()
+            else:
+                waiter.cancel()
+                self._remove(user, waiter)
+            raise
+        finally:
+            metrics.ADMISSION_WAIT.observe(
+                time.monotonic() - start, upstream=self.upstream
+            )
+            self._update_metrics()
+
+    def _admit_next(self):
+        """Hand a slot to the next user in turn, who goes to the back of
+        the line"""
+        user, queue = next(iter(self._queues.items()))
+        waiter = queue.popleft()
+        self.waiting -= 1
+        if queue:
+            self._queues.move_to_end(user)
+        else:
+            del self._queues[user]
+        waiter.set_result(None)
+
+    def release(self):
+        if self._queues and self.active <= self.limit:
+            self._admit_next()
+        else:
+            self.active -= 1
+
+        self._update_metrics()
+
+    def set_limit(self, limit: int):
+        """Change the number of slots, admitting waiting turns if it grows,
+        or letting active ones drain if it shrinks"""
+        self.limit = limit
+        while self._queues and self.active < self.limit:
+            self.active += 1
+            self._admit_next()
+
+        self._update_metrics()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "users_waiting": len(self._queues),
+        }
+
+
+_limiters: Dict[str, FairLimiter] = {}
+
+admission_user: ContextVar[str] = ContextVar("admission_user", default="")
+"""User the upstream calls of the current turn queue as"""
+queue_feedback: ContextVar[
+    Optional[Callable[[Optional[int]], Awaitable[Any]]]
+] = ContextVar("queue_feedback", default=None)
+"""Shows the position of the current turn in a queue, or None once it is
+admitted"""
+
+
+def get_limiter(upstream: str, limit: int) -> FairLimiter:
+    """The limiter of an upstream in this worker, created on first use,
+    with its limit updated if it changed since"""
+    if (limiter := _limiters.get(upstream)) is None:
+        limiter = _limiters[upstream] = FairLimiter(upstream, limit)
+    elif limiter.limit != limit:
+        limiter.set_limit(limit)
+
+    return limiter
+
+
+@asynccontextmanager
+async def upstream_slot(
+    upstream: str, limit: int, show_position: bool = False
+) -> AsyncIterator[None]:
+    """
+    Hold a slot of an upstream for one call of the current turn, 0 for no
+    limit.
+
+    With `show_position`, the position of the turn in the queue is shown
+    through `queue_feedback` while it waits.
+    """
+    if limit <= 0:
+        yield
+        return
+
+    limiter = get_limiter(upstream, limit)
+    on_position = queue_feedback.get() if show_position else None
+    try:
+        await limiter.acquire(admission_user.get(), on_position)
+    finally:
+        if on_position is not None:
+            await on_position(None)
+
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    return {
+        upstream: limiter.stats() for upstream, limiter in _limiters.items()
+    }
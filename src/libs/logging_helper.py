@@ -1,37 +1,93 @@
+import atexit
 import json
 import logging
 import os
+import queue
+import random
 import sys
+import threading
+import time
 import traceback
 from datetime import datetime
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from typing import Dict
+from typing import Optional
+from typing import Tuple
 
 from pydantic.v1.json import pydantic_encoder
 
+from constants import LOG_LEVEL
 from constants import PRODUCT
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 __all__ = ["logger"]
 
+# Format and write logs on a background thread, off the event loop
+LOG_ASYNC = os.getenv("LOG_ASYNC", "true") == "true"
+# Records waiting to be written, further records are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Records per second to keep per message below WARNING, e.g.
+# '{"Streaming event": 20}', other messages are not limited
+LOG_RATE_LIMITS: Dict[str, float] = json.loads(
+    os.getenv("LOG_RATE_LIMITS", "{}")
+)
+# Fraction of records to keep per message below WARNING, e.g.
+# '{"Streaming event": 0.01}'
+LOG_SAMPLE_RATES: Dict[str, float] = json.loads(
+    os.getenv("LOG_SAMPLE_RATES", "{}")
+)
+
+
+def dumps(obj) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj,
+                default=pydantic_encoder,
+                option=orjson.OPT_NON_STR_KEYS,
+            ).decode("utf-8")
+        except TypeError:
+            pass
+
+    return json.dumps(obj, default=pydantic_encoder)
+
+
+def get_error_trace(record: logging.LogRecord) -> str:
+    """Traceback of an error record, captured when it was logged"""
+    if (error_trace := record.__dict__.get("error_trace")) is not None:
+        return error_trace
+
+    return traceback.format_exc()
+
+
+def get_time(record: logging.LogRecord) -> str:
+    return datetime.utcfromtimestamp(record.created).isoformat(
+        sep=" ", timespec="milliseconds"
+    )
+
 
 class JSONFormatter(logging.Formatter):
     def format(self, record):
-        record.msg = json.dumps(
+        record.msg = dumps(
             {
                 "process": f"{record.process} {record.processName}",
-                "time": datetime.utcnow().isoformat(
-                    sep=" ", timespec="milliseconds"
-                ),
+                "time": get_time(record),
                 "level": record.levelname,
                 "file": record.filename,
                 "line": record.lineno,
                 "func": record.funcName,
                 "msg": record.msg,
                 **(
-                    {"error_trace": traceback.format_exc()}
+                    {"error_trace": get_error_trace(record)}
                     if record.levelname == "ERROR"
                     else {}
                 ),
-            },
-            default=pydantic_encoder,
+            }
         )
         return super().format(record)
 
@@ -39,19 +95,19 @@ class JSONFormatter(logging.Formatter):
 class JSONMessageFormatter(logging.Formatter):
     def format(self, record):
         record.msg = "{} | {} | {} | {} | {} | {} | {} {}".format(
-            datetime.utcnow().isoformat(sep=" ", timespec="milliseconds"),
+            get_time(record),
             f"{record.process} {record.processName}",
             record.levelname,
             record.filename,
             record.lineno,
             record.funcName,
             (
-                json.dumps(record.msg, default=pydantic_encoder)
+                dumps(record.msg)
                 if isinstance(record.msg, dict)
                 else record.msg
             ),
             (
-                f"\n{traceback.format_exc()}"
+                f"\n{get_error_trace(record)}"
                 if record.levelname == "ERROR"
                 else ""
             ),
@@ -59,16 +115,174 @@ class JSONMessageFormatter(logging.Formatter):
         return super().format(record)
 
 
+def get_key(record: logging.LogRecord) -> str:
+    """
+    Key to rate limit and sample a record by: the `log_key` given in its
+    `extra`, its "msg", or else where it was logged from.
+
+    A lazy message is resolved to find its "msg", unless it has a
+    `log_key`, which keeps it unresolved if the record is dropped.
+    """
+    if (key := record.__dict__.get("log_key")) is not None:
+        return key
+
+    if callable(record.msg):
+        record.msg = record.msg()
+    if isinstance(record.msg, dict) and "msg" in record.msg:
+        return str(record.msg["msg"])
+
+    return f"{record.filename}:{record.lineno}"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Sample and rate limit high-volume records below WARNING, for the keys
+    given only.
+
+    Each rate limited key has a token bucket of its rate in records per
+    second. The next record let through for a key carries how many were
+    dropped before it.
+    """
+
+    def __init__(
+        self, rate_limits: Dict[str, float], sample_rates: Dict[str, float]
+    ):
+        super().__init__()
+        self.rate_limits = rate_limits
+        self.sample_rates = sample_rates
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._dropped: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not (
+            self.rate_limits or self.sample_rates
+        ):
+            return True
+
+        key = get_key(record)
+        sample_rate = self.sample_rates.get(key)
+        rate = self.rate_limits.get(key, 0)
+        if sample_rate is None and rate <= 0:
+            return True
+
+        with self._lock:
+            if sample_rate is not None and random.random() >= sample_rate:
+                return self._drop(key)
+
+            if rate > 0:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(key, (rate, now))
+                tokens = min(rate, tokens + (now - last) * rate)
+                if tokens < 1:
+                    self._buckets[key] = (tokens, now)
+                    return self._drop(key)
+                self._buckets[key] = (tokens - 1, now)
+
+            if dropped := self._dropped.pop(key, 0):
+                record.dropped = dropped
+
+        return True
+
+    def _drop(self, key: str) -> bool:
+        """Count a dropped record, with the lock held"""
+        self._dropped[key] = self._dropped.get(key, 0) + 1
+        return False
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Queue records for a `QueueListener` to format and write.
+
+    Only what depends on the calling thread is resolved here: lazy
+    messages, given as a callable returning the message, the current
+    traceback of error records and `%` arguments.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if callable(record.msg):
+            record.msg = record.msg()
+        if isinstance(record.msg, dict):
+            # The caller may change the dict once it returns
+            record.msg = dict(record.msg)
+            if dropped := record.__dict__.pop("dropped", None):
+                record.msg["dropped"] = dropped
+        elif record.args:
+            record.msg = record.getMessage()
+            record.args = None
+
+        if record.levelname == "ERROR":
+            record.error_trace = traceback.format_exc()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LazyMessageFilter(logging.Filter):
+    """Resolve lazy messages when logging synchronously"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if callable(record.msg):
+            record.msg = record.msg()
+        if isinstance(record.msg, dict) and (
+            dropped := record.__dict__.pop("dropped", None)
+        ):
+            record.msg = {**record.msg, "dropped": dropped}
+
+        return True
+
+
 stdout_log = logging.StreamHandler(sys.stdout)
 if os.getenv("LOG_FORMAT") == "json":
     stdout_log.setFormatter(JSONFormatter())
 else:
     stdout_log.setFormatter(JSONMessageFormatter())
 
-logging.basicConfig(force=True, handlers=[stdout_log])
+listener: Optional[QueueListener] = None
+
+if LOG_ASYNC:
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = LogQueueHandler(log_queue)
+
+    listener = QueueListener(log_queue, stdout_log)
+    listener.start()
+
+    logging.basicConfig(force=True, handlers=[queue_handler])
+else:
+    stdout_log.addFilter(LazyMessageFilter())
+
+    logging.basicConfig(force=True, handlers=[stdout_log])
+
+
+def stop_logging():
+    """Write the queued records and stop the background writer"""
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop_logging)
 
 logger = logging.getLogger(PRODUCT)
+# Only records of the app are limited, not those of libraries
+logger.addFilter(RateLimitFilter(LOG_RATE_LIMITS, LOG_SAMPLE_RATES))
 
 # Configure log levels (what to filter to outputs).
-logger.setLevel(os.getenv("LOG_LEVEL", "DEBUG"))
-# logging.getLogger("openai").setLevel(os.getenv("LOG_LEVEL", "DEBUG"))
+logger.setLevel(LOG_LEVEL)
+# logging.getLogger("openai").setLevel(LOG_LEVEL)
@@ -0,0 +1,368 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Each worker process records into its own registry. With several workers,
+set METRICS_MULTIPROC_DIR to a directory shared by them: every worker
+writes a snapshot of its registry there periodically, and `/metrics`
+merges the live registry of the worker serving it with the snapshots of
+the other live workers.
+"""
+
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+from libs.logging_helper import logger
+
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR")
+METRICS_SNAPSHOT_INTERVAL = float(os.getenv("METRICS_SNAPSHOT_INTERVAL", "5"))
+
+LATENCY_BUCKETS = (
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Sequence[str] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "type": self.type,
+            "help": self.documentation,
+            "labelnames": self.labelnames,
+            "samples": [
+                [list(key), value] for key, value in list(self._values.items())
+            ],
+        }
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Histogram whose samples are [count per bucket..., sum, count]"""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if (sample := self._values.get(key)) is None:
+            # One bucket per bound, then +Inf
+            sample = self._values[key] = [0] * (len(self.buckets) + 1) + [
+                0.0,
+                0,
+            ]
+
+        sample[bisect_left(self.buckets, value)] += 1
+        sample[-2] += value
+        sample[-1] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **super().snapshot(),
+            "buckets": self.buckets,
+            "samples": [
+                [list(key), list(value)]
+                for key, value in list(self._values.items())
+            ],
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: metric.snapshot() for name, metric in self.metrics.items()
+        }
+
+
+def merge(snapshots: List[Dict[str, Dict[str, Any]]]) -> Dict[str, Any]:
+    """Sum the samples of the same metric and labels across snapshots"""
+    merged: Dict[str, Dict[str, Any]] = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for labels, value in metric["samples"]:
+                key = tuple(labels)
+                if (current := target["samples"].get(key)) is None:
+                    target["samples"][key] = value
+                elif isinstance(value, list):
+                    target["samples"][key] = [
+                        a + b for a, b in zip(current, value)
+                    ]
+                else:
+                    target["samples"][key] = current + value
+
+    return merged
+
+
+def _labels(names: Sequence[str], values: Sequence[str], **extra) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+
+    return (
+        "{"
+        + ",".join(
+            '{}="{}"'.format(
+                name,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for name, value in pairs
+        )
+        + "}"
+    )
+
+
+def render(merged: Dict[str, Dict[str, Any]]) -> str:
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric["labelnames"]
+
+        for labels, value in metric["samples"].items():
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(labelnames, labels)} {value}")
+                continue
+
+            cumulative = 0
+            for bound, count in zip([*metric["buckets"], "+Inf"], value[:-2]):
+                cumulative += count
+                lines.append(
+                    f"{name}_bucket"
+                    f"{_labels(labelnames, labels, le=bound)} {cumulative}"
+                )
+            lines.append(
+                f"{name}_sum{_labels(labelnames, labels)} {value[-2]}"
+            )
+            lines.append(
+                f"{name}_count{_labels(labelnames, labels)} {value[-1]}"
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+class MultiProcessExporter:
+    """Share the registry of this worker with the other workers through
+    snapshot files in `directory`"""
+
+    def __init__(
+        self,
+        registry: Registry,
+        directory: Optional[str] = METRICS_MULTIPROC_DIR,
+        interval: float = METRICS_SNAPSHOT_INTERVAL,
+    ):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"{os.getpid()}.json")
+
+    def _write(self, snapshot: Dict[str, Any]):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self._write, self.registry.snapshot())
+            except Exception as e:
+                logger.warning(
+                    {
+                        "msg": "Failed to write metrics snapshot",
+                        "error": str(e),
+                    }
+                )
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self.directory and self._task is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _read_others(self) -> List[Dict[str, Any]]:
+        snapshots = []
+        for file_name in os.listdir(self.directory):
+            pid, ext = os.path.splitext(file_name)
+            if ext != ".json" or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+
+            path = os.path.join(self.directory, file_name)
+            try:
+                # Skip workers that are gone
+                os.kill(int(pid), 0)
+                if time.time() - os.path.getmtime(path) > 3 * self.interval:
+                    continue
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+        return snapshots
+
+    async def collect(self) -> str:
+        snapshots = [self.registry.snapshot()]
+        if self.directory:
+            snapshots += await asyncio.to_thread(self._read_others)
+
+        return render(merge(snapshots))
+
+
+registry = Registry()
+exporter = MultiProcessExporter(registry)
+
+SENTINEL_LATENCY = registry.histogram(
+    "sentinel_request_seconds",
+    "Latency of Sentinel validate calls that reach the API, per guardrail",
+    ["guardrail"],
+)
+SENTINEL_CACHE_HITS = registry.counter(
+    "sentinel_cache_hits_total", "Sentinel calls served from the cache"
+)
+SENTINEL_CIRCUIT_OPEN = registry.gauge(
+    "sentinel_circuit_open",
+    "1 from the time the Sentinel circuit opens until a call succeeds again",
+)
+SENTINEL_CIRCUIT_REJECTED = registry.counter(
+    "sentinel_circuit_rejected_total",
+    "Sentinel calls failed fast because the circuit was open",
+)
+RETRIES = registry.counter(
+    "upstream_retries_total", "Retried upstream calls", ["upstream"]
+)
+TIME_TO_FIRST_TOKEN = registry.histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from the start of an LLM call to its first streamed token",
+)
+TOKENS_PER_SECOND = registry.histogram(
+    "llm_tokens_per_second",
+    "Streaming rate of LLM answers, after the first token",
+    buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 400),
+)
+TURN_LATENCY = registry.histogram(
+    "chat_turn_seconds", "Time to handle a user message, end to end"
+)
+SESSION_MEMORY_MESSAGES = registry.histogram(
+    "session_memory_messages",
+    "Messages in the memory of a session, after each turn",
+    buckets=(2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+ACTIVE_SESSIONS = registry.gauge(
+    "chat_active_sessions", "Chat sessions started and not ended yet"
+)
+ADMISSION_ACTIVE = registry.gauge(
+    "admission_active", "Calls holding a slot of an upstream", ["upstream"]
+)
+ADMISSION_QUEUE_DEPTH = registry.gauge(
+    "admission_queue_depth",
+    "Calls waiting for a slot of an upstream",
+    ["upstream"],
+)
+ADMISSION_WAIT = registry.histogram(
+    "admission_wait_seconds",
+    "Time calls waited for a slot of an upstream, admitted or not",
+    ["upstream"],
+)
+ADMISSION_REJECTED = registry.counter(
+    "admission_rejected_total",
+    "Calls shed because the queue of an upstream was full or too slow",
+    ["upstream", "reason"],
+)
+RATE_LIMITED = registry.counter(
+    "rate_limited_total",
+    "Messages rejected by the per-user rate limit",
+    ["role"],
+)
+TURNS_CANCELLED = registry.counter(
+    "chat_turns_cancelled_total",
+    "Turns cancelled by a newer or edited message, or the stop button",
+)
@@ -0,0 +1,173 @@
+"""
+Per-user rate limiting of chat messages with token buckets.
+
+Each user has a bucket of `burst` messages, refilled at `per_minute`
+messages per minute, with limits set per role. Buckets are kept in memory
+per worker, or in a SQLite file shared by the workers of a host when
+RATE_LIMIT_DB_PATH is set.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from libs import metrics
+
+# Limits per role, roles not listed use "default", "per_minute": 0 for no
+# limit
+RATE_LIMITS: Dict[str, Dict[str, float]] = json.loads(
+    os.getenv(
+        "RATE_LIMITS",
+        '{"default": {"per_minute": 20, "burst": 10},'
+        ' "pwd_bypass_usr": {"per_minute": 0}}',
+    )
+)
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH")
+# Buckets kept in memory per worker, least recently used ones are dropped
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+
+def refill(
+    tokens: float,
+    updated_at: float,
+    now: float,
+    capacity: float,
+    rate: float,
+) -> Tuple[float, float]:
+    """Take one token from a bucket, returns the tokens left and the
+    seconds to wait for one if there was none"""
+    tokens = min(capacity, tokens + (now - updated_at) * rate)
+    if tokens < 1:
+        return tokens, (1 - tokens) / rate
+
+    return tokens - 1, 0.0
+
+
+class MemoryBucketStore:
+    """Buckets of this worker only"""
+
+    blocking = False
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        now = time.time()
+        tokens, updated_at = self._buckets.pop(key, (capacity, now))
+        tokens, retry_after = refill(tokens, updated_at, now, capacity, rate)
+
+        self._buckets[key] = (tokens, now)
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+
+        return retry_after
+
+
+class SQLiteBucketStore:
+    """Buckets shared by the workers using the same SQLite file"""
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, "
+                "updated_at REAL NOT NULL)"
+            )
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        with self._lock:
+            # Lock the database for the read and the write
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute(
+                    "SELECT tokens, updated_at FROM rate_limit WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                tokens, retry_after = refill(
+                    *(row or (capacity, now)), now, capacity, rate
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO rate_limit VALUES (?, ?, ?)",
+                    (key, tokens, now),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                # Buckets idle for a day are full, as good as missing
+                self._conn.execute(
+                    "DELETE FROM rate_limit WHERE updated_at < ?",
+                    (now - 86400,),
+                )
+
+        return retry_after
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        limits: Dict[str, Dict[str, float]] = RATE_LIMITS,
+        store: Optional[Union[MemoryBucketStore, SQLiteBucketStore]] = None,
+    ):
+        """
+        :param limits: Limits per role, see RATE_LIMITS
+        :param store: Where buckets are kept, by default in a SQLite file
+            if RATE_LIMIT_DB_PATH is set, otherwise in memory
+        """
+        self.limits = limits
+        if store is None:
+            store = (
+                SQLiteBucketStore(RATE_LIMIT_DB_PATH)
+                if RATE_LIMIT_DB_PATH
+                else MemoryBucketStore()
+            )
+        self.store = store
+
+    def get_limit(self, role: str) -> Optional[Tuple[float, float]]:
+        """Capacity and refill rate per second of a role, None for no
+        limit"""
+        limit = self.limits.get(role, self.limits.get("default", {}))
+        if not (per_minute := limit.get("per_minute", 0)):
+            return None
+
+        return max(limit.get("burst", per_minute), 1), per_minute / 60
+
+    async def check(self, key: str, role: str) -> float:
+        """Count a message of a user, returns 0 if it is allowed,
+        otherwise the seconds to wait before the next one"""
+        if (limit := self.get_limit(role)) is None:
+            return 0.0
+
+        if self.store.blocking:
+            retry_after = await asyncio.to_thread(self.store.take, key, *limit)
+        else:
+            retry_after = self.store.take(key, *limit)
+
+        if retry_after:
+            metrics.RATE_LIMITED.inc(role=role)
+
+        return retry_after
+
+
+rate_limiter = RateLimiter()
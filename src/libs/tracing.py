@@ -0,0 +1,375 @@
+"""
+Lightweight tracing of chat turns.
+
+Each user message starts a trace, the turn, whose id is the trace id. Spans
+opened while handling it become its children through a context variable,
+so they follow the turn into tasks and LangChain callbacks.
+
+Ended spans are queued and exported in batches by a background thread, to
+stdout as JSON lines, to a file in the OTLP/JSON format, or kept in memory
+for tests. Set TRACING_EXPORTER, or call `set_exporter`.
+"""
+
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from constants import PRODUCT
+from libs.logging_helper import dumps
+from libs.logging_helper import logger
+
+# none, stdout, otlp_file or memory
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none")
+TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+TRACING_BATCH_SIZE = int(os.getenv("TRACING_BATCH_SIZE", "512"))
+TRACING_FLUSH_INTERVAL = float(os.getenv("TRACING_FLUSH_INTERVAL", "1"))
+# Ended spans waiting to be exported, further spans are dropped
+TRACING_QUEUE_SIZE = int(os.getenv("TRACING_QUEUE_SIZE", "10000"))
+
+
+class Span:
+    __slots__ = (
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "name",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "events",
+        "error",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+    ):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.events: List[Dict[str, Any]] = []
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name: str, **attributes):
+        self.events.append(
+            {"name": name, "time_ns": time.time_ns(), "attributes": attributes}
+        )
+
+    def end(self, error: Optional[BaseException] = None):
+        if self.end_ns is not None:
+            return
+
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        if processor is not None:
+            processor.on_end(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "events": self.events,
+            **({"error": self.error} if self.error else {}),
+        }
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar(
+    "current_span", default=None
+)
+
+
+def get_trace_id() -> Optional[str]:
+    """Id of the current turn, if any"""
+    if (span := current_span.get()) is not None:
+        return span.trace_id
+
+    return None
+
+
+def start_span(name: str, /, new_trace: bool = False, **attributes) -> Span:
+    """Start a child of the current span, without making it current.
+
+    For spans ended from another callback than the one starting them,
+    otherwise use `span`."""
+    parent = None if new_trace else current_span.get()
+    if parent is None:
+        return Span(name, f"{random.getrandbits(128):032x}", None, attributes)
+
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+@contextmanager
+def span(
+    name: str, /, new_trace: bool = False, **attributes
+) -> Iterator[Span]:
+    """Start a span, current until the block exits"""
+    s = start_span(name, new_trace=new_trace, **attributes)
+    token = current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.end(error=e)
+        raise
+    finally:
+        current_span.reset(token)
+        s.end()
+
+
+def add_event(name: str, **attributes):
+    """Add an event to the current span, if any"""
+    if (s := current_span.get()) is not None:
+        s.add_event(name, **attributes)
+
+
+class SpanExporter:
+    def export(self, spans: List[Span]):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class ConsoleSpanExporter(SpanExporter):
+    """One JSON line per span on stdout"""
+
+    def export(self, spans: List[Span]):
+        sys.stdout.write(
+            "".join(
+                dumps({"msg": "Span", **span.to_dict()}) + "\n"
+                for span in spans
+            )
+        )
+        sys.stdout.flush()
+
+
+def to_otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+
+    return {"stringValue": str(value)}
+
+
+def to_otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {"key": key, "value": to_otlp_value(value)}
+        for key, value in attributes.items()
+    ]
+
+
+class OTLPFileSpanExporter(SpanExporter):
+    """
+    One OTLP/JSON `ExportTraceServiceRequest` per line and batch, as read
+    by the OpenTelemetry collector `otlpjsonfile` receiver
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "a")
+
+    @staticmethod
+    def to_otlp(span: Span) -> Dict[str, Any]:
+        return {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "parentSpanId": span.parent_id or "",
+            "name": span.name,
+            # Internal
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": to_otlp_attributes(span.attributes),
+            "events": [
+                {
+                    "name": event["name"],
+                    "timeUnixNano": str(event["time_ns"]),
+                    "attributes": to_otlp_attributes(event["attributes"]),
+                }
+                for event in span.events
+            ],
+            # Error or OK
+            "status": (
+                {"code": 2, "message": span.error}
+                if span.error
+                else {"code": 1}
+            ),
+        }
+
+    def export(self, spans: List[Span]):
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": to_otlp_attributes(
+                            {"service.name": PRODUCT}
+                        )
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [self.to_otlp(span) for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        self.file.write(json.dumps(request) + "\n")
+        self.file.flush()
+
+    def shutdown(self):
+        self.file.close()
+
+
+class InMemorySpanExporter(SpanExporter):
+    def __init__(self):
+        self.spans: List[Span] = []
+
+    def export(self, spans: List[Span]):
+        self.spans.extend(spans)
+
+    def clear(self):
+        self.spans = []
+
+
+class BatchSpanProcessor:
+    """Export ended spans in batches from a background thread, every
+    `interval` seconds or once `batch_size` spans are queued"""
+
+    def __init__(
+        self,
+        exporter: SpanExporter,
+        batch_size: int = TRACING_BATCH_SIZE,
+        interval: float = TRACING_FLUSH_INTERVAL,
+        queue_size: int = TRACING_QUEUE_SIZE,
+    ):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self._thread = threading.Thread(
+            target=self._run, name="span-exporter", daemon=True
+        )
+        self._thread.start()
+
+    def on_end(self, span: Span):
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _export(self, batch: List[Span]):
+        if not batch:
+            return
+
+        try:
+            self.exporter.export(batch)
+        except Exception as e:
+            logger.warning({"msg": "Failed to export spans", "error": str(e)})
+
+    def _run(self):
+        batch: List[Span] = []
+        deadline = time.monotonic() + self.interval
+
+        while True:
+            try:
+                item = self.queue.get(
+                    timeout=max(deadline - time.monotonic(), 0)
+                )
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, Span):
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+
+            self._export(batch)
+            batch = []
+            deadline = time.monotonic() + self.interval
+
+            # Flush or shutdown requests
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is not None:
+                return
+
+    def force_flush(self, timeout: Optional[float] = None) -> bool:
+        """Export the queued spans, for tests and before exiting"""
+        flushed = threading.Event()
+        self.queue.put(flushed)
+        return flushed.wait(timeout)
+
+    def shutdown(self):
+        self.queue.put(self.shutdown)
+        self._thread.join()
+        self.exporter.shutdown()
+
+
+def get_exporter(name: str) -> Optional[SpanExporter]:
+    if name == "stdout":
+        return ConsoleSpanExporter()
+    if name == "otlp_file":
+        return OTLPFileSpanExporter(TRACING_FILE)
+    if name == "memory":
+        return InMemorySpanExporter()
+
+    return None
+
+
+processor: Optional[BatchSpanProcessor] = None
+
+
+def set_exporter(exporter: Optional[SpanExporter]):
+    """Export spans to `exporter` from now on, None to stop tracing"""
+    global processor
+
+    previous, processor = processor, (
+        BatchSpanProcessor(exporter) if exporter is not None else None
+    )
+    if previous is not None:
+        previous.shutdown()
+
+
+set_exporter(get_exporter(TRACING_EXPORTER))
+
+
+def stop_tracing():
+    set_exporter(None)
+
+
+atexit.register(stop_tracing)
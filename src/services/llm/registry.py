@@ -0,0 +1,161 @@
+import asyncio
+import os
+import time
+import weakref
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import httpx
+from langchain_openai import ChatOpenAI
+from openai import DefaultAsyncHttpxClient
+
+from constants import LLM_PROFILES
+from datatypes.llm_profile import LLMProfile
+from libs.logging_helper import logger
+
+# Connection pool shared by the LLM clients of every profile, per event loop
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "1000"))
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "100"))
+LLM_POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+# Pre-connect to the LLM endpoints when the server starts
+LLM_WARM_UP = os.getenv("LLM_WARM_UP", "true") == "true"
+
+
+class LoopLocalTransport(httpx.AsyncBaseTransport):
+    """
+    Transport keeping one connection pool per event loop.
+
+    httpx connections are bound to the event loop that opened them, and
+    the shared LLM clients are also used from loops other than the one of
+    the server, such as the ones of sync callers.
+    """
+
+    def __init__(self, limits: httpx.Limits):
+        self.limits = limits
+        self._transports: weakref.WeakKeyDictionary = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def get_transport(self) -> httpx.AsyncHTTPTransport:
+        """Return the connection pool of the running event loop"""
+        loop = asyncio.get_running_loop()
+
+        if (transport := self._transports.get(loop)) is None:
+            transport = self._transports[loop] = httpx.AsyncHTTPTransport(
+                limits=self.limits
+            )
+
+        return transport
+
+    async def handle_async_request(
+        self, request: httpx.Request
+    ) -> httpx.Response:
+        return await self.get_transport().handle_async_request(request)
+
+    async def aclose(self):
+        """Close the connection pool of the running event loop, if any"""
+        transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+class LLMRegistry:
+    """
+    Process-wide registry of LLM profiles.
+
+    Profiles are indexed by name, and each profile gets one LLM client,
+    built on first use, that all chat sessions share. The clients share
+    one keep-alive connection pool per event loop.
+    """
+
+    def __init__(self, profiles: List[LLMProfile]):
+        self.profiles: Dict[str, LLMProfile] = {p.name: p for p in profiles}
+        self.default_profile: Optional[LLMProfile] = (
+            profiles[0] if profiles else None
+        )
+        self._llms: Dict[str, ChatOpenAI] = {}
+        self._http_async_client: Optional[httpx.AsyncClient] = None
+
+    def get_profile(self, name: Optional[str] = None) -> LLMProfile:
+        """Get a profile by name, or the default one if no name is given"""
+        profile = self.profiles.get(name) if name else self.default_profile
+        if profile is None:
+            raise ValueError(f"Unknown LLM profile: {name}")
+
+        return profile
+
+    @property
+    def http_async_client(self) -> httpx.AsyncClient:
+        if self._http_async_client is None:
+            # Keeps the timeout and redirect defaults of the OpenAI SDK
+            self._http_async_client = DefaultAsyncHttpxClient(
+                transport=LoopLocalTransport(
+                    httpx.Limits(
+                        max_connections=LLM_POOL_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+                        keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY,
+                    )
+                ),
+            )
+
+        return self._http_async_client
+
+    def get_llm(self, name: Optional[str] = None) -> ChatOpenAI:
+        """Get the shared LLM client of a profile"""
+        profile = self.get_profile(name)
+
+        if (llm := self._llms.get(profile.name)) is None:
+            llm = self._llms[profile.name] = ChatOpenAI(
+                model=profile.default_llm_config.model,
+                temperature=profile.default_llm_config.temperature,
+                max_tokens=profile.default_llm_config.max_tokens,
+                streaming=True,
+                http_async_client=self.http_async_client,
+            )
+
+        return llm
+
+    async def warm_up(self):
+        """Build every client and open a connection to each LLM endpoint"""
+        start = time.time()
+        llms = [self.get_llm(name) for name in self.profiles]
+
+        if LLM_WARM_UP:
+            endpoints = {
+                str(llm.root_async_client.base_url): llm for llm in llms
+            }
+            results = await asyncio.gather(
+                *(
+                    llm.root_async_client.with_options(
+                        max_retries=0, timeout=5
+                    ).models.list()
+                    for llm in endpoints.values()
+                ),
+                return_exceptions=True,
+            )
+            for endpoint, result in zip(endpoints, results):
+                if isinstance(result, Exception):
+                    logger.warning(
+                        {
+                            "msg": "Failed to warm up LLM endpoint",
+                            "endpoint": endpoint,
+                            "error": str(result),
+                        }
+                    )
+
+        logger.info(
+            {
+                "msg": "LLM registry ready",
+                "profiles": list(self.profiles),
+                "time_taken": time.time() - start,
+            }
+        )
+
+    async def aclose(self):
+        if self._http_async_client is not None:
+            await self._http_async_client.aclose()
+            self._http_async_client = None
+
+
+llm_registry = LLMRegistry(LLM_PROFILES)
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import json
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import Union
+
+import httpx
+
+from services.sentinel.client import SentinelAPIError
+
+BatchResult = Union[dict, BaseException]
+BatchTransport = Callable[[List[dict]], Awaitable[List[BatchResult]]]
+"""Send a batch of validate payloads, returning one result or exception
+per payload, in the same order"""
+
+
+class FanOutTransport:
+    """Send each payload of a batch as its own request, concurrently.
+    Used when the server has no batch endpoint."""
+
+    def __init__(self, send_one: Callable[[dict], Awaitable[dict]]):
+        self.send_one = send_one
+
+    async def __call__(self, payloads: List[dict]) -> List[BatchResult]:
+        return await asyncio.gather(
+            *(self.send_one(payload) for payload in payloads),
+            return_exceptions=True,
+        )
+
+
+class HttpBatchTransport:
+    """
+    Send a batch to a batch validate endpoint.
+
+    Payloads sharing the same guardrails and additional params are grouped,
+    so that params such as the system prompt are sent once per group:
+
+        request:  {"texts": [...], "guardrails": {...}, **additional_params}
+        response: {"results": [{"results": {...}}, ...]}
+    """
+
+    def __init__(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        get_client: Callable[[], httpx.AsyncClient],
+    ):
+        self.url = url
+        self.headers = headers
+        self.get_client = get_client
+
+    async def __call__(self, payloads: List[dict]) -> List[BatchResult]:
+        groups: Dict[str, List[int]] = {}
+        for i, payload in enumerate(payloads):
+            shared = {k: v for k, v in payload.items() if k != "text"}
+            key = hashlib.sha256(
+                json.dumps(shared, sort_keys=True).encode("utf-8")
+            ).hexdigest()
+            groups.setdefault(key, []).append(i)
+
+        results: List[BatchResult] = [None] * len(payloads)  # type: ignore
+        group_results = await asyncio.gather(
+            *(
+                self._send_group([payloads[i] for i in indexes])
+                for indexes in groups.values()
+            ),
+            return_exceptions=True,
+        )
+        for indexes, group_result in zip(groups.values(), group_results):
+            for n, i in enumerate(indexes):
+                results[i] = (
+                    group_result
+                    if isinstance(group_result, BaseException)
+                    else group_result[n]
+                )
+
+        return results
+
+    async def _send_group(self, payloads: List[dict]) -> List[dict]:
+        body = {k: v for k, v in payloads[0].items() if k != "text"}
+        body["texts"] = [payload["text"] for payload in payloads]
+
+        response = await self.get_client().post(
+            self.url, headers=self.headers, content=json.dumps(body)
+        )
+        if response.status_code != 200:
+            raise SentinelAPIError(
+                f"Sentinel batch API responds with code "
+                f"{response.status_code}: {response.text}",
+                response.status_code,
+            )
+
+        results = response.json()["results"]
+        if len(results) != len(payloads):
+            raise Exception(
+                f"Sentinel batch API returned {len(results)} results "
+                f"for {len(payloads)} texts"
+            )
+
+        return results
+
+
+class BatchDispatcher:
+    """
+    Gather concurrent validate calls into batches.
+
+    A batch is sent when `max_batch_size` calls are waiting, or `window`
+    seconds after its first call, whichever comes first. Each caller gets
+    its own result or exception. A dispatcher must only be used from one
+    event loop.
+    """
+
+    def __init__(
+        self,
+        transport: BatchTransport,
+        window: float = 0.005,
+        max_batch_size: int = 32,
+    ):
+        self.transport = transport
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.requests = 0
+        self.batches = 0
+        self.max_seen_batch_size = 0
+
+    async def submit(self, payload: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((payload, future))
+        self.requests += 1
+
+        if len(self._pending) >= self.max_batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self.flush)
+
+        return await future
+
+    def flush(self):
+        """Send the pending calls now"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        self.batches += 1
+        self.max_seen_batch_size = max(self.max_seen_batch_size, len(batch))
+
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[dict, asyncio.Future]]):
+        results: List[Any]
+        try:
+            results = await self.transport([payload for payload, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                # The caller went away
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "max_batch_size": self.max_seen_batch_size,
+            "pending": len(self._pending),
+        }
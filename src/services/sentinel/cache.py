@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+# Result cache settings, set SENTINEL_CACHE_MAX_SIZE=0 to disable
+SENTINEL_CACHE_MAX_SIZE = int(os.getenv("SENTINEL_CACHE_MAX_SIZE", "1024"))
+SENTINEL_CACHE_TTL = float(os.getenv("SENTINEL_CACHE_TTL", "3600"))
+# Optional on-disk tier that survives restarts
+SENTINEL_CACHE_DB_PATH = os.getenv("SENTINEL_CACHE_DB_PATH")
+SENTINEL_CACHE_DB_MAX_ROWS = int(
+    os.getenv("SENTINEL_CACHE_DB_MAX_ROWS", "100000")
+)
+
+
+def make_key(
+    text: str, guardrails: dict, additional_params: dict | None
+) -> str:
+    """
+    Build the cache key of a validate request from the normalized text,
+    the guardrail set and a hash of the additional params
+    """
+    params_hash = hashlib.sha256(
+        json.dumps(additional_params or {}, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+    return hashlib.sha256(
+        json.dumps(
+            {
+                "text": " ".join(text.split()),
+                "guardrails": guardrails,
+                "params": params_hash,
+            },
+            sort_keys=True,
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+class DiskCache:
+    """SQLite-backed cache tier with TTL and a bounded number of rows"""
+
+    def __init__(self, path: str, max_rows: int):
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sentinel_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM sentinel_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: str, value: Any, expires_at: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sentinel_cache VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at),
+            )
+            self._conn.commit()
+
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                self._prune()
+
+    def _prune(self):
+        self._conn.execute(
+            "DELETE FROM sentinel_cache WHERE expires_at <= ?", (time.time(),)
+        )
+        self._conn.execute(
+            "DELETE FROM sentinel_cache WHERE key IN ("
+            "SELECT key FROM sentinel_cache ORDER BY expires_at DESC "
+            "LIMIT -1 OFFSET ?)",
+            (self.max_rows,),
+        )
+        self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM sentinel_cache")
+            self._conn.commit()
+
+
+class SentinelCache:
+    """
+    In-memory TTL + LRU cache of Sentinel results,
+    optionally backed by a `DiskCache`
+    """
+
+    def __init__(
+        self,
+        max_size: int = SENTINEL_CACHE_MAX_SIZE,
+        ttl: float = SENTINEL_CACHE_TTL,
+        db_path: str | None = SENTINEL_CACHE_DB_PATH,
+        db_max_rows: int = SENTINEL_CACHE_DB_MAX_ROWS,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk = (
+            DiskCache(db_path, db_max_rows)
+            if db_path and max_size > 0
+            else None
+        )
+        self._entries: OrderedDict[str, Tuple[Any, float]] = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Look up the in-memory tier only"""
+        if (entry := self._entries.get(key)) is not None:
+            if entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            del self._entries[key]
+
+        return None
+
+    def set(self, key: str, value: Any, expires_at: float | None = None):
+        """Store into the in-memory tier only"""
+        self._entries[key] = (value, expires_at or time.time() + self.ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def aget(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+
+        if (value := self.get(key)) is not None:
+            return value
+
+        if self.disk is not None and (
+            entry := await asyncio.to_thread(self.disk.get, key)
+        ):
+            self.set(key, entry[0], expires_at=entry[1])
+            self.disk_hits += 1
+            return entry[0]
+
+        self.misses += 1
+        return None
+
+    async def aset(self, key: str, value: Any):
+        if not self.enabled:
+            return
+
+        expires_at = time.time() + self.ttl
+        self.set(key, value, expires_at=expires_at)
+
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.set, key, value, expires_at)
+
+    def clear(self):
+        self._entries.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
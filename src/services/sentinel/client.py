@@ -0,0 +1,94 @@
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any
+from typing import Coroutine
+from typing import Optional
+from typing import TypeVar
+
+import httpx
+
+# Connection pool settings, shared by every Sentinel call in the process
+SENTINEL_POOL_MAX_CONNECTIONS = int(
+    os.getenv("SENTINEL_POOL_MAX_CONNECTIONS", "100")
+)
+SENTINEL_POOL_MAX_KEEPALIVE = int(
+    os.getenv("SENTINEL_POOL_MAX_KEEPALIVE", "20")
+)
+SENTINEL_POOL_KEEPALIVE_EXPIRY = float(
+    os.getenv("SENTINEL_POOL_KEEPALIVE_EXPIRY", "30")
+)
+SENTINEL_CONNECT_TIMEOUT = float(os.getenv("SENTINEL_CONNECT_TIMEOUT", "5"))
+SENTINEL_READ_TIMEOUT = float(os.getenv("SENTINEL_READ_TIMEOUT", "30"))
+SENTINEL_POOL_TIMEOUT = float(os.getenv("SENTINEL_POOL_TIMEOUT", "10"))
+
+T = TypeVar("T")
+
+
+class SentinelAPIError(Exception):
+    """Sentinel responded with an error status code"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# httpx connections are bound to the event loop that opened them,
+# so keep one pooled client per loop
+_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+_sync_loop: Optional[asyncio.AbstractEventLoop] = None
+_sync_loop_lock = threading.Lock()
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the keep-alive client pool for the running event loop"""
+    loop = asyncio.get_running_loop()
+
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=SENTINEL_POOL_MAX_CONNECTIONS,
+                max_keepalive_connections=SENTINEL_POOL_MAX_KEEPALIVE,
+                keepalive_expiry=SENTINEL_POOL_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                SENTINEL_READ_TIMEOUT,
+                connect=SENTINEL_CONNECT_TIMEOUT,
+                pool=SENTINEL_POOL_TIMEOUT,
+            ),
+        )
+        _clients[loop] = client
+
+    return client
+
+
+async def aclose():
+    """Close the client pool of the running event loop, if any"""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    """
+    Run a coroutine to completion from synchronous code.
+
+    The coroutine runs on a long-lived background loop so that sync callers
+    also get a reused connection pool, and so that this works even when
+    called from a thread that already runs an event loop.
+    """
+    global _sync_loop
+
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_sync_loop.run_forever,
+                name="sentinel-sync-loop",
+                daemon=True,
+            ).start()
+
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop).result()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import re
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Optional
+
+# Local blocklist, e.g.
+# '{"phrases": ["ignore everything"], "patterns": ["repeat \\\\w+ non-stop"],
+#   "denylist": ["exact text"], "denylist_hashes": ["<sha256>"]}'
+SENTINEL_PREFILTER = os.getenv("SENTINEL_PREFILTER")
+SENTINEL_PREFILTER_FILE = os.getenv("SENTINEL_PREFILTER_FILE")
+# Input guardrails the pre-filter stands in for, it is skipped for calls
+# without any of them, such as checks of LLM answers
+SENTINEL_PREFILTER_GUARDRAILS = os.getenv(
+    "SENTINEL_PREFILTER_GUARDRAILS", "jailbreak,off-topic"
+).split(",")
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(normalize(text).encode("utf-8")).hexdigest()
+
+
+class PreFilter:
+    """
+    Reject known-bad inputs locally before calling Sentinel.
+
+    Phrases and patterns are compiled once into a single case-insensitive
+    regex, and exact texts are matched by the hash of their normalized form.
+    """
+
+    def __init__(
+        self,
+        phrases: Iterable[str] = (),
+        patterns: Iterable[str] = (),
+        denylist: Iterable[str] = (),
+        denylist_hashes: Iterable[str] = (),
+        guardrails: Iterable[str] = SENTINEL_PREFILTER_GUARDRAILS,
+    ):
+        alternatives = [re.escape(normalize(p)) for p in phrases if p] + [
+            f"(?:{pattern})" for pattern in patterns
+        ]
+        self.regex = (
+            re.compile("|".join(alternatives), re.IGNORECASE)
+            if alternatives
+            else None
+        )
+        self.hashes = {hash_text(text) for text in denylist} | set(
+            denylist_hashes
+        )
+
+        self.guardrails = {guardrail for guardrail in guardrails if guardrail}
+
+        self.local_decisions = 0
+        self.remote_decisions = 0
+
+    @classmethod
+    def from_env(cls) -> "PreFilter":
+        config: Dict[str, Any] = {}
+        if SENTINEL_PREFILTER_FILE:
+            with open(SENTINEL_PREFILTER_FILE) as f:
+                config.update(json.load(f))
+        if SENTINEL_PREFILTER:
+            config.update(json.loads(SENTINEL_PREFILTER))
+
+        return cls(**config)
+
+    @property
+    def enabled(self) -> bool:
+        return self.regex is not None or bool(self.hashes)
+
+    def applies_to(self, guardrails: Iterable[str]) -> bool:
+        """Whether a call with these guardrails is pre-filtered"""
+        return self.enabled and not self.guardrails.isdisjoint(guardrails)
+
+    def check(self, text: str) -> Optional[str]:
+        """Return the reason if the text is rejected locally"""
+        if not self.enabled:
+            return None
+
+        normalized = normalize(text)
+        if (
+            self.hashes
+            and hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+            in self.hashes
+        ):
+            self.local_decisions += 1
+            return "denylist"
+
+        if self.regex is not None and self.regex.search(normalized):
+            self.local_decisions += 1
+            return "blocklist"
+
+        self.remote_decisions += 1
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "local_decisions": self.local_decisions,
+            "remote_decisions": self.remote_decisions,
+        }
@@ -0,0 +1,183 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Optional
+from typing import TypeVar
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that is known to be unhealthy"""
+
+
+class AttemptCancelledError(Exception):
+    """Raised when every hedged attempt was cancelled by something other
+    than the caller, such as a closing dispatcher"""
+
+
+class CircuitBreaker:
+    """
+    Fail fast while an upstream is unhealthy.
+
+    The circuit opens after `failure_threshold` consecutive failures. Once
+    `recovery_timeout` seconds have passed, a single trial call is let
+    through (half-open): its success closes the circuit, its failure
+    opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, failure_threshold: int = 5, recovery_timeout: float = 30.0
+    ):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+
+        self.rejected = 0
+        self.times_opened = 0
+
+    def check(self):
+        """Raise `CircuitOpenError` if a call is not allowed now"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.recovery_timeout:
+                self.rejected += 1
+                raise CircuitOpenError("Sentinel circuit is open")
+
+            self.state = self.HALF_OPEN
+
+        if self.state == self.HALF_OPEN:
+            if self._trial_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError("Sentinel circuit is half-open")
+
+            self._trial_in_flight = True
+
+    def record_success(self):
+        self._trial_in_flight = False
+        self.consecutive_failures = 0
+        self.state = self.CLOSED
+
+    def release(self):
+        """End a call that tells nothing about the health of the upstream,
+        such as a rejected request, letting the next trial call through"""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._trial_in_flight = False
+        self.consecutive_failures += 1
+
+        if (
+            self.state == self.HALF_OPEN
+            or self.consecutive_failures >= self.failure_threshold
+        ):
+            if self.state != self.OPEN:
+                self.times_opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+        }
+
+
+class Hedger:
+    """
+    Send a second, hedged attempt when the first one is slower than the
+    recent `quantile` latency, and use whichever succeeds first.
+
+    Hedging only starts once `min_samples` latencies have been recorded.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = True,
+        quantile: float = 0.95,
+        min_delay: float = 0.05,
+        min_samples: int = 20,
+        window: int = 200,
+    ):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._latencies: Deque[float] = deque(maxlen=window)
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, latency: float):
+        self._latencies.append(latency)
+
+    @property
+    def delay(self) -> Optional[float]:
+        """Time to wait for the first attempt before hedging, if any"""
+        if not self.enabled or len(self._latencies) < self.min_samples:
+            return None
+
+        latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self.quantile), len(latencies) - 1)
+        return max(latencies[index], self.min_delay)
+
+    async def run(self, fn: Callable[[], Awaitable[T]]) -> T:
+        self.calls += 1
+        start = time.monotonic()
+
+        if (delay := self.delay) is None:
+            result = await fn()
+            self.record(time.monotonic() - start)
+            return result
+
+        tasks = [asyncio.ensure_future(fn())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(fn()))
+
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.cancelled():
+                        error = error or AttemptCancelledError(
+                            "Hedged attempt was cancelled"
+                        )
+                        continue
+                    if (error := task.exception()) is None:
+                        if len(tasks) > 1 and task is tasks[1]:
+                            self.hedge_wins += 1
+                        self.record(time.monotonic() - start)
+                        return task.result()
+
+            raise error  # type: ignore[misc]
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_delay": self.delay,
+        }
@@ -1,42 +1,179 @@
+import asyncio
 import json
 import os
 import time
+import weakref
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import Tuple
 
-import requests
+import httpx
 from tenacity import retry
+from tenacity import RetryCallState
+from tenacity import RetryError
 from tenacity import stop_after_attempt
 from tenacity import wait_exponential
 
+from libs import admission
+from libs import metrics
+from libs import tracing
 from libs.logging_helper import logger
+from services.sentinel import batching
+from services.sentinel import cache
+from services.sentinel import client
+from services.sentinel import prefilter
+from services.sentinel import resilience
+from services.sentinel import singleflight
 
 # Load Sentinel Server details from Env Variables
 SENTINEL_BASE_URL = os.getenv("SENTINEL_BASE_URL")
 SENTINEL_API_KEY = os.getenv("SENTINEL_API_KEY")
+SENTINEL_MAX_ATTEMPTS = int(os.getenv("SENTINEL_MAX_ATTEMPTS", "3"))
+SENTINEL_RETRY_MAX_WAIT = float(os.getenv("SENTINEL_RETRY_MAX_WAIT", "10"))
+# Micro-batching of concurrent calls: "off", "fanout" or "http"
+SENTINEL_BATCH_MODE = os.getenv("SENTINEL_BATCH_MODE", "off")
+SENTINEL_BATCH_WINDOW = float(os.getenv("SENTINEL_BATCH_WINDOW", "0.005"))
+SENTINEL_BATCH_MAX_SIZE = int(os.getenv("SENTINEL_BATCH_MAX_SIZE", "32"))
+SENTINEL_BATCH_PATH = os.getenv(
+    "SENTINEL_BATCH_PATH", "/api/v1/validate/batch"
+)
+# Long inputs are split into overlapping chunks validated concurrently,
+# set SENTINEL_CHUNK_THRESHOLD=0 to disable
+SENTINEL_CHUNK_THRESHOLD = int(os.getenv("SENTINEL_CHUNK_THRESHOLD", "4000"))
+SENTINEL_CHUNK_SIZE = int(os.getenv("SENTINEL_CHUNK_SIZE", "2000"))
+SENTINEL_CHUNK_OVERLAP = int(os.getenv("SENTINEL_CHUNK_OVERLAP", "200"))
+SENTINEL_CHUNK_CONCURRENCY = int(os.getenv("SENTINEL_CHUNK_CONCURRENCY", "4"))
+# Total time a call may take, retries included
+SENTINEL_LATENCY_BUDGET = float(os.getenv("SENTINEL_LATENCY_BUDGET", "10"))
+SENTINEL_HEDGE_REQUESTS = os.getenv("SENTINEL_HEDGE_REQUESTS") == "true"
+SENTINEL_BREAKER_FAILURE_THRESHOLD = int(
+    os.getenv("SENTINEL_BREAKER_FAILURE_THRESHOLD", "5")
+)
+SENTINEL_BREAKER_RECOVERY_TIMEOUT = float(
+    os.getenv("SENTINEL_BREAKER_RECOVERY_TIMEOUT", "30")
+)
+# What to do with a guardrail when Sentinel cannot be reached:
+# "open" lets the text through, "closed" rejects it
+SENTINEL_DEFAULT_FAIL_POLICY = os.getenv(
+    "SENTINEL_DEFAULT_FAIL_POLICY", "closed"
+)
+SENTINEL_FAIL_POLICIES: Dict[str, str] = json.loads(
+    os.getenv("SENTINEL_FAIL_POLICIES", "{}")
+)
+
+SCORE_THRESHOLD = 0.95
+"""A guardrail fails when its score reaches this threshold"""
 
 if not SENTINEL_BASE_URL or not SENTINEL_API_KEY:
     raise Exception(
         "Missing SENTINEL_BASE_URL / SENTINEL_API_KEY in environment variables"
     )
 
+SENTINEL_HEADERS = {
+    "x-api-key": SENTINEL_API_KEY,
+    "Content-Type": "application/json",
+}
+
+result_cache = cache.SentinelCache()
+in_flight = singleflight.SingleFlight()
+breaker = resilience.CircuitBreaker(
+    failure_threshold=SENTINEL_BREAKER_FAILURE_THRESHOLD,
+    recovery_timeout=SENTINEL_BREAKER_RECOVERY_TIMEOUT,
+)
+hedger = resilience.Hedger(enabled=SENTINEL_HEDGE_REQUESTS)
+local_filter = prefilter.PreFilter.from_env()
+
+_dispatchers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_dispatcher() -> batching.BatchDispatcher:
+    """Return the batch dispatcher of the running event loop"""
+    loop = asyncio.get_running_loop()
+
+    if (dispatcher := _dispatchers.get(loop)) is None:
+        transport: batching.BatchTransport = (
+            batching.HttpBatchTransport(
+                url=f"{SENTINEL_BASE_URL}{SENTINEL_BATCH_PATH}",
+                headers=SENTINEL_HEADERS,
+                get_client=client.get_client,
+            )
+            if SENTINEL_BATCH_MODE == "http"
+            else batching.FanOutTransport(_post_validate)
+        )
+        dispatcher = _dispatchers[loop] = batching.BatchDispatcher(
+            transport,
+            window=SENTINEL_BATCH_WINDOW,
+            max_batch_size=SENTINEL_BATCH_MAX_SIZE,
+        )
+
+    return dispatcher
+
+
+def stats() -> Dict[str, Any]:
+    """Counters of the Sentinel client, logged when the circuit opens"""
+    return {
+        "cache": result_cache.stats(),
+        "in_flight": in_flight.stats(),
+        "breaker": breaker.stats(),
+        "hedging": hedger.stats(),
+        "prefilter": local_filter.stats(),
+    }
+
 
 def validate(
     text: str,
     guardrails: dict,
     additional_params: dict | None,
 ) -> Tuple[bool, str | None]:
-    sentinel_check_result = call_sentinel_api(
-        text=text,
-        guardrails=guardrails,
-        additional_params=additional_params,
+    """Blocking version of `avalidate`"""
+    return client.run_sync(
+        avalidate(
+            text=text,
+            guardrails=guardrails,
+            additional_params=additional_params,
+        )
     )
 
+
+async def avalidate(
+    text: str,
+    guardrails: dict,
+    additional_params: dict | None,
+) -> Tuple[bool, str | None]:
+    if local_filter.applies_to(guardrails) and (
+        reason := local_filter.check(text)
+    ):
+        logger.info({"msg": "Rejected by local pre-filter", "reason": reason})
+        return False, (
+            f"These validations failed: local-{reason}. Revise your prompt or check with our technical support."  # noqa: E501
+        )
+
+    try:
+        if SENTINEL_CHUNK_THRESHOLD and len(text) > SENTINEL_CHUNK_THRESHOLD:
+            scores = await get_chunked_scores(
+                text, guardrails, additional_params
+            )
+        else:
+            sentinel_check_result = await acall_sentinel_api(
+                text=text,
+                guardrails=guardrails,
+                additional_params=additional_params,
+            )
+            scores = {
+                guardrail: result["score"]
+                for guardrail, result in sentinel_check_result[
+                    "results"
+                ].items()
+            }
+    except Exception as e:
+        return apply_fail_policy(guardrails, e)
+
     failed_guardrails: List[str] = []
 
-    for guardrail, result in sentinel_check_result["results"].items():
-        if result["score"] >= 0.95:
-            failed_guardrails.append(f'{guardrail} ({result["score"]:.3f})')
+    for guardrail, score in scores.items():
+        if score >= SCORE_THRESHOLD:
+            failed_guardrails.append(f"{guardrail} ({score:.3f})")
     if failed_guardrails:
         return False, (
             f"These validations failed: {' '.join(failed_guardrails[0:])}. Revise your prompt or check with our technical support."  # noqa: E501
@@ -45,47 +182,281 @@ def validate(
     return True, None
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential())
+def split_text(text: str, size: int, overlap: int) -> List[str]:
+    """Split text into chunks of `size` characters,
+    each overlapping the previous one by `overlap` characters"""
+    step = max(size - overlap, 1)
+    return [
+        text[start : start + size]
+        for start in range(0, max(len(text) - overlap, 1), step)
+    ]
+
+
+async def get_chunked_scores(
+    text: str,
+    guardrails: dict,
+    additional_params: dict | None,
+) -> Dict[str, float]:
+    """
+    Validate a long text chunk by chunk, concurrently,
+    and merge the scores of each guardrail with max.
+
+    Returns as soon as any chunk fails a guardrail, aborting the requests
+    of the other chunks (unless they are sent in a shared batch).
+    """
+    semaphore = asyncio.Semaphore(SENTINEL_CHUNK_CONCURRENCY)
+
+    async def check_chunk(chunk: str):
+        async with semaphore:
+            return await acall_sentinel_api(
+                text=chunk,
+                guardrails=guardrails,
+                additional_params=additional_params,
+                coalesce=False,
+            )
+
+    tasks = [
+        asyncio.ensure_future(check_chunk(chunk))
+        for chunk in split_text(
+            text, SENTINEL_CHUNK_SIZE, SENTINEL_CHUNK_OVERLAP
+        )
+    ]
+
+    scores: Dict[str, float] = {}
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            for guardrail, guardrail_result in result["results"].items():
+                scores[guardrail] = max(
+                    scores.get(guardrail, 0.0), guardrail_result["score"]
+                )
+
+            if any(score >= SCORE_THRESHOLD for score in scores.values()):
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    logger.debug(
+        {
+            "msg": "Validated long text in chunks",
+            "chunks": len(tasks),
+            "scores": scores,
+        }
+    )
+
+    return scores
+
+
+def apply_fail_policy(
+    guardrails: dict, error: Exception
+) -> Tuple[bool, str | None]:
+    """Decide on a text that could not be validated,
+    using the fail-open / fail-closed policy of each guardrail"""
+    fail_closed = [
+        guardrail
+        for guardrail in guardrails
+        if SENTINEL_FAIL_POLICIES.get(guardrail, SENTINEL_DEFAULT_FAIL_POLICY)
+        != "open"
+    ]
+
+    logger.warning(
+        {
+            "msg": "Sentinel unavailable, applying fail policy",
+            "error": str(error),
+            "fail_closed_guardrails": fail_closed,
+        }
+    )
+
+    if fail_closed:
+        return False, (
+            f"These validations could not be completed: {' '.join(fail_closed)}. Please try again later."  # noqa: E501
+        )
+
+    return True, None
+
+
 def call_sentinel_api(
     text: str,
     guardrails: dict,
     additional_params: dict | None,
 ):
-    start = time.time()
+    """Blocking version of `acall_sentinel_api`"""
+    return client.run_sync(
+        acall_sentinel_api(
+            text=text,
+            guardrails=guardrails,
+            additional_params=additional_params,
+        )
+    )
 
-    # Set url & headers
-    url = f"{SENTINEL_BASE_URL}/api/v1/validate"
-    headers = {
-        "x-api-key": SENTINEL_API_KEY,
-        "Content-Type": "application/json",
-    }
 
-    payload = json.dumps(
-        {"text": text, "guardrails": guardrails, **(additional_params or {})}
+async def acall_sentinel_api(
+    text: str,
+    guardrails: dict,
+    additional_params: dict | None,
+    coalesce: bool = True,
+):
+    """
+    Call Sentinel, serving repeated inputs from the result cache and
+    coalescing identical concurrent calls into one request.
+
+    A coalesced request keeps running when its caller is cancelled, for
+    the other callers. With `coalesce=False` the request is made by the
+    caller, so cancelling the caller aborts it.
+    """
+    key = cache.make_key(text, guardrails, additional_params)
+
+    with tracing.span(
+        "sentinel.call", guardrails=",".join(guardrails)
+    ) as call_span:
+        if (result := await result_cache.aget(key)) is not None:
+            metrics.SENTINEL_CACHE_HITS.inc()
+            call_span.set(cache_hit=True)
+            logger.debug(
+                {
+                    "msg": "Sentinel cache hit",
+                    "cache_stats": result_cache.stats(),
+                }
+            )
+            return result
+
+        async def request_and_cache():
+            try:
+                breaker.check()
+            except resilience.CircuitOpenError:
+                metrics.SENTINEL_CIRCUIT_REJECTED.inc()
+                raise
+
+            try:
+                async with admission.upstream_slot(
+                    "sentinel", admission.ADMISSION_SENTINEL_MAX_CONCURRENCY
+                ):
+                    start = time.monotonic()
+                    with tracing.span("sentinel.request"):
+                        result = await asyncio.wait_for(
+                            _request_sentinel_api(
+                                text=text,
+                                guardrails=guardrails,
+                                additional_params=additional_params,
+                            ),
+                            timeout=SENTINEL_LATENCY_BUDGET,
+                        )
+            except BaseException as e:
+                if is_upstream_failure(e):
+                    record_upstream_failure()
+                else:
+                    breaker.release()
+                raise
+
+            breaker.record_success()
+            metrics.SENTINEL_CIRCUIT_OPEN.set(0)
+            duration = time.monotonic() - start
+            for guardrail in guardrails:
+                metrics.SENTINEL_LATENCY.observe(duration, guardrail=guardrail)
+
+            await result_cache.aset(key, result)
+            return result
+
+        if not coalesce:
+            return await request_and_cache()
+
+        return await in_flight.do(key, request_and_cache)
+
+
+def record_upstream_failure():
+    """Count a failed call towards opening the circuit"""
+    was_open = breaker.state == breaker.OPEN
+    breaker.record_failure()
+
+    if breaker.state == breaker.OPEN:
+        metrics.SENTINEL_CIRCUIT_OPEN.set(1)
+        if not was_open:
+            logger.warning({"msg": "Sentinel circuit opened", **stats()})
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Whether an error means that Sentinel is unhealthy: a timeout, a
+    connection error or a 5xx response, not a rejected request"""
+    if isinstance(error, RetryError) and error.last_attempt.failed:
+        error = error.last_attempt.exception()
+
+    if isinstance(error, client.SentinelAPIError):
+        return error.status_code >= 500
+
+    return isinstance(error, (asyncio.TimeoutError, httpx.TransportError))
+
+
+def on_retry(retry_state: RetryCallState):
+    metrics.RETRIES.inc(upstream="sentinel")
+    tracing.add_event(
+        "retry",
+        attempt=retry_state.attempt_number,
+        error=repr(retry_state.outcome.exception()),
     )
 
+
+@retry(
+    stop=stop_after_attempt(SENTINEL_MAX_ATTEMPTS),
+    wait=wait_exponential(max=SENTINEL_RETRY_MAX_WAIT),
+    before_sleep=on_retry,
+)
+async def _request_sentinel_api(
+    text: str,
+    guardrails: dict,
+    additional_params: dict | None,
+):
+    payload = {
+        "text": text,
+        "guardrails": guardrails,
+        **(additional_params or {}),
+    }
+
+    if SENTINEL_BATCH_MODE == "off":
+        return await hedger.run(lambda: _post_validate(payload))
+
+    return await hedger.run(lambda: get_dispatcher().submit(payload))
+
+
+async def _post_validate(payload: dict):
+    start = time.time()
+
+    url = f"{SENTINEL_BASE_URL}/api/v1/validate"
+    content = json.dumps(payload)
+
     logger.debug(
         {
             "msg": "Calling Sentinel API",
-            "payload": payload,
+            "payload": content,
         }
     )
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    response = await client.get_client().post(
+        url, headers=SENTINEL_HEADERS, content=content
+    )
 
     logger.info(
         {
             "msg": "Sentinel API response",
-            "response": response.text,
-            "response_headers": response.headers.lower_items(),
+            "status_code": response.status_code,
             "duration": time.time() - start,
         }
     )
+    # Built only if debug logs are on, and the record is not rate limited
+    logger.debug(
+        lambda: {
+            "msg": "Sentinel API response body",
+            "response": response.text,
+            "response_headers": response.headers.multi_items(),
+        },
+        extra={"log_key": "Sentinel API response body"},
+    )
 
     if response.status_code != 200:
-        raise Exception(
+        raise client.SentinelAPIError(
             f"Sentinel API responds with code {response.status_code}: "
-            f"{response.text}"
+            f"{response.text}",
+            response.status_code,
         )
 
     return response.json()
@@ -0,0 +1,5 @@
+import os
+
+# Required at import time by the Sentinel client, never called by the tests
+os.environ.setdefault("SENTINEL_BASE_URL", "http://sentinel.test")
+os.environ.setdefault("SENTINEL_API_KEY", "test")
@@ -0,0 +1,153 @@
+import asyncio
+
+import pytest
+
+from libs import admission
+from libs.admission import AdmissionRejected
+from libs.admission import FairLimiter
+
+
+async def enqueue(limiter: FairLimiter, users, served):
+    """Start a turn per user, each waiting in the queue in this order"""
+
+    async def turn(name: str):
+        await limiter.acquire(name.rstrip("0123456789"))
+        served.append(name)
+        await asyncio.sleep(0)
+        limiter.release()
+
+    tasks = []
+    for name in users:
+        tasks.append(asyncio.create_task(turn(name)))
+        await asyncio.sleep(0)
+
+    return tasks
+
+
+def test_waiting_turns_are_served_round_robin_across_users():
+    async def main():
+        limiter = FairLimiter("test", 1)
+        await limiter.acquire("holder")
+        served = []
+        tasks = await enqueue(
+            limiter, ["alice1", "alice2", "alice3", "bob1", "carol1"], served
+        )
+
+        limiter.release()
+        await asyncio.gather(*tasks)
+
+        assert served == ["alice1", "bob1", "carol1", "alice2", "alice3"]
+        assert limiter.stats()["active"] == 0
+        assert limiter.stats()["waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_position_counts_the_turns_served_before():
+    async def main():
+        limiter = FairLimiter("test", 1)
+        await limiter.acquire("holder")
+        tasks = await enqueue(
+            limiter, ["alice1", "alice2", "alice3", "bob1", "carol1"], []
+        )
+
+        positions = {
+            f"{user}{index + 1}": limiter.position(user, waiter)
+            for user, queue in limiter._queues.items()
+            for index, waiter in enumerate(queue)
+        }
+
+        assert positions == {
+            "alice1": 1,
+            "bob1": 2,
+            "carol1": 3,
+            "alice2": 4,
+            "alice3": 5,
+        }
+        limiter.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(main())
+
+
+def test_turns_are_rejected_once_the_queue_is_full():
+    async def main():
+        limiter = FairLimiter("test", 1, max_waiting=1)
+        await limiter.acquire("alice")
+        waiting = asyncio.create_task(limiter.acquire("bob"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await limiter.acquire("carol")
+
+        assert rejected.value.reason == "queue_full"
+        limiter.release()
+        await waiting
+        assert limiter.stats()["active"] == 1
+
+    asyncio.run(main())
+
+
+def test_turns_are_rejected_after_waiting_too_long():
+    async def main():
+        limiter = FairLimiter("test", 1, max_wait=0.05, position_interval=0.01)
+        await limiter.acquire("alice")
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await limiter.acquire("bob")
+
+        assert rejected.value.reason == "timeout"
+        assert limiter.stats()["waiting"] == 0
+        assert limiter.stats()["users_waiting"] == 0
+
+    asyncio.run(main())
+
+
+def test_turn_cancelled_once_admitted_hands_its_slot_on():
+    async def main():
+        limiter = FairLimiter("test", 1)
+        await limiter.acquire("alice")
+        bob = asyncio.create_task(limiter.acquire("bob"))
+        await asyncio.sleep(0)
+        carol = asyncio.create_task(limiter.acquire("carol"))
+        await asyncio.sleep(0)
+
+        # Bob is admitted, and cancelled before he runs again
+        limiter.release()
+        bob.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await bob
+
+        await carol
+        assert limiter.stats()["active"] == 1
+        limiter.release()
+        assert limiter.stats()["active"] == 0
+
+    asyncio.run(main())
+
+
+def test_limiter_takes_a_new_limit(monkeypatch):
+    monkeypatch.setattr(admission, "_limiters", {})
+
+    async def main():
+        limiter = admission.get_limiter("test", 1)
+        await limiter.acquire("alice")
+        bob = asyncio.create_task(limiter.acquire("bob"))
+        await asyncio.sleep(0)
+
+        assert admission.get_limiter("test", 2) is limiter
+        await bob
+        assert limiter.stats()["active"] == 2
+
+        admission.get_limiter("test", 1)
+        carol = asyncio.create_task(limiter.acquire("carol"))
+        await asyncio.sleep(0)
+        # Draining down to the new limit before admitting again
+        limiter.release()
+        await asyncio.sleep(0)
+        assert not carol.done()
+        limiter.release()
+        await carol
+        assert limiter.stats()["active"] == 1
+
+    asyncio.run(main())
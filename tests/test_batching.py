@@ -0,0 +1,165 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from services.sentinel.batching import BatchDispatcher
+from services.sentinel.batching import FanOutTransport
+from services.sentinel.batching import HttpBatchTransport
+from services.sentinel.client import SentinelAPIError
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.batches = []
+
+    async def __call__(self, payloads):
+        self.batches.append([payload["text"] for payload in payloads])
+        return [{"text": payload["text"]} for payload in payloads]
+
+
+def submit_all(dispatcher: BatchDispatcher, texts):
+    async def main():
+        return await asyncio.gather(
+            *(dispatcher.submit({"text": text}) for text in texts),
+            return_exceptions=True,
+        )
+
+    return asyncio.run(main())
+
+
+def test_calls_within_the_window_are_sent_as_one_batch():
+    transport = RecordingTransport()
+    dispatcher = BatchDispatcher(transport, window=0.01, max_batch_size=10)
+
+    results = submit_all(dispatcher, ["a", "b", "c"])
+
+    assert results == [{"text": "a"}, {"text": "b"}, {"text": "c"}]
+    assert transport.batches == [["a", "b", "c"]]
+
+
+def test_full_batch_is_sent_without_waiting_for_the_window():
+    transport = RecordingTransport()
+    dispatcher = BatchDispatcher(transport, window=60, max_batch_size=2)
+
+    async def main():
+        return await asyncio.wait_for(
+            asyncio.gather(
+                *(dispatcher.submit({"text": text}) for text in "abcd")
+            ),
+            timeout=1,
+        )
+
+    asyncio.run(main())
+
+    assert transport.batches == [["a", "b"], ["c", "d"]]
+    assert dispatcher.stats()["max_batch_size"] == 2
+
+
+def test_each_caller_gets_the_error_of_its_own_payload():
+    async def send_one(payload):
+        if payload["text"] == "bad":
+            raise ValueError("rejected")
+        return {"text": payload["text"]}
+
+    dispatcher = BatchDispatcher(FanOutTransport(send_one), window=0.01)
+
+    results = submit_all(dispatcher, ["a", "bad", "c"])
+
+    assert results[0] == {"text": "a"}
+    assert isinstance(results[1], ValueError)
+    assert results[2] == {"text": "c"}
+
+
+def test_failed_batch_fails_every_caller():
+    async def transport(payloads):
+        raise ConnectionError("down")
+
+    dispatcher = BatchDispatcher(transport, window=0.01)
+
+    results = submit_all(dispatcher, ["a", "b"])
+
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+
+def make_http_transport(handler) -> HttpBatchTransport:
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return HttpBatchTransport(
+        url="http://sentinel.test/batch", headers={}, get_client=lambda: client
+    )
+
+
+def test_http_batch_groups_payloads_by_shared_params():
+    bodies = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        bodies.append(body)
+        return httpx.Response(
+            200,
+            json={
+                "results": [
+                    {"results": {"text": text, "group": body["guardrails"]}}
+                    for text in body["texts"]
+                ]
+            },
+        )
+
+    transport = make_http_transport(handler)
+    payloads = [
+        {"text": "a", "guardrails": "g1"},
+        {"text": "b", "guardrails": "g2"},
+        {"text": "c", "guardrails": "g1"},
+    ]
+
+    results = asyncio.run(transport(payloads))
+
+    assert sorted(body["texts"] for body in bodies) == [["a", "c"], ["b"]]
+    assert [result["results"]["text"] for result in results] == [
+        "a",
+        "b",
+        "c",
+    ]
+    assert results[1]["results"]["group"] == "g2"
+
+
+def test_http_batch_error_fails_its_group_only():
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        if body["guardrails"] == "bad":
+            return httpx.Response(503, text="unavailable")
+        return httpx.Response(
+            200, json={"results": [{"results": {}} for _ in body["texts"]]}
+        )
+
+    transport = make_http_transport(handler)
+
+    results = asyncio.run(
+        transport(
+            [
+                {"text": "a", "guardrails": "bad"},
+                {"text": "b", "guardrails": "good"},
+            ]
+        )
+    )
+
+    assert isinstance(results[0], SentinelAPIError)
+    assert results[0].status_code == 503
+    assert results[1] == {"results": {}}
+
+
+def test_caller_gone_before_the_batch_returns_is_skipped():
+    transport = RecordingTransport()
+    dispatcher = BatchDispatcher(transport, window=0.01)
+
+    async def main():
+        gone = asyncio.create_task(dispatcher.submit({"text": "gone"}))
+        kept = asyncio.create_task(dispatcher.submit({"text": "kept"}))
+        await asyncio.sleep(0)
+        gone.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await gone
+        return await kept
+
+    assert asyncio.run(main()) == {"text": "kept"}
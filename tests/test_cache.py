@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+from services.sentinel.cache import make_key
+from services.sentinel.cache import SentinelCache
+
+
+def test_key_ignores_whitespace_and_order_of_params():
+    guardrails = {"jailbreak": {}}
+
+    assert make_key("What is  2 + 2?\n", guardrails, {"a": 1, "b": 2}) == (
+        make_key("What is 2 + 2?", guardrails, {"b": 2, "a": 1})
+    )
+    assert make_key("text", guardrails, None) == make_key(
+        "text", guardrails, {}
+    )
+
+
+def test_key_depends_on_text_guardrails_and_params():
+    key = make_key("text", {"jailbreak": {}}, None)
+
+    assert key != make_key("other text", {"jailbreak": {}}, None)
+    assert key != make_key("text", {"off-topic": {}}, None)
+    assert key != make_key("text", {"jailbreak": {}}, {"threshold": 0.5})
+
+
+def test_entries_expire_after_ttl():
+    cache = SentinelCache(max_size=10, ttl=60, db_path=None)
+
+    cache.set("fresh", 1)
+    cache.set("stale", 2, expires_at=time.time() - 1)
+
+    assert cache.get("fresh") == 1
+    assert cache.get("stale") is None
+    assert cache.stats()["size"] == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SentinelCache(max_size=2, ttl=60, db_path=None)
+
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_disk_tier_serves_entries_after_a_restart(tmp_path):
+    db_path = str(tmp_path / "cache.sqlite")
+
+    async def main():
+        await SentinelCache(max_size=10, db_path=db_path).aset("key", 1)
+
+        cache = SentinelCache(max_size=10, db_path=db_path)
+        assert await cache.aget("key") == 1
+        assert await cache.aget("missing") is None
+        assert cache.stats()["disk_hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    asyncio.run(main())
+
+
+def test_disabled_cache_stores_nothing():
+    cache = SentinelCache(max_size=0, db_path=None)
+
+    async def main():
+        await cache.aset("key", 1)
+        return await cache.aget("key")
+
+    assert asyncio.run(main()) is None
@@ -0,0 +1,291 @@
+import asyncio
+import uuid
+from typing import Awaitable
+from typing import Callable
+
+from chainlit.types import Pagination
+from chainlit.types import ThreadFilter
+from chainlit.user import User
+from sqlalchemy import text
+
+from apps.data_layer import BatchSQLAlchemyDataLayer
+from apps.data_layer import CachedDataLayer
+from apps.data_layer import unwrapped
+from apps.data_layer import WriteBehindDataLayer
+
+SCHEMA = (
+    """CREATE TABLE users (
+        "id" TEXT PRIMARY KEY, "identifier" TEXT NOT NULL UNIQUE,
+        "metadata" TEXT NOT NULL, "createdAt" TEXT)""",
+    """CREATE TABLE threads (
+        "id" TEXT PRIMARY KEY, "createdAt" TEXT, "name" TEXT,
+        "userId" TEXT, "userIdentifier" TEXT, "tags" TEXT,
+        "metadata" TEXT)""",
+    """CREATE TABLE steps (
+        "id" TEXT PRIMARY KEY, "name" TEXT NOT NULL, "type" TEXT NOT NULL,
+        "threadId" TEXT NOT NULL, "parentId" TEXT, "streaming" BOOLEAN,
+        "waitForAnswer" BOOLEAN, "isError" BOOLEAN, "metadata" TEXT,
+        "tags" TEXT, "input" TEXT, "output" TEXT, "createdAt" TEXT,
+        "command" TEXT, "start" TEXT, "end" TEXT, "generation" TEXT,
+        "showInput" TEXT, "language" TEXT, "indent" INT,
+        "defaultOpen" BOOLEAN)""",
+    """CREATE TABLE elements (
+        "id" TEXT PRIMARY KEY, "threadId" TEXT, "type" TEXT, "url" TEXT,
+        "chainlitKey" TEXT, "name" TEXT NOT NULL, "display" TEXT,
+        "objectKey" TEXT, "size" TEXT, "page" INT, "language" TEXT,
+        "forId" TEXT, "mime" TEXT, "props" TEXT)""",
+    """CREATE TABLE feedbacks (
+        "id" TEXT PRIMARY KEY, "forId" TEXT NOT NULL,
+        "threadId" TEXT NOT NULL, "value" INT NOT NULL, "comment" TEXT)""",
+)
+
+
+def run_with_data_layer(
+    test: Callable[[BatchSQLAlchemyDataLayer], Awaitable[None]],
+):
+    """Run a test against a fresh in-memory sqlite database"""
+
+    async def main():
+        data_layer = BatchSQLAlchemyDataLayer(
+            conninfo=(
+                f"sqlite+aiosqlite:///file:{uuid.uuid4().hex}"
+                "?mode=memory&cache=shared&uri=true"
+            )
+        )
+        # The database lives as long as a connection to it is open
+        async with data_layer.engine.connect() as keep_alive:
+            for statement in SCHEMA:
+                await keep_alive.execute(text(statement))
+            await keep_alive.commit()
+
+            await data_layer.create_indexes()
+            await test(data_layer)
+
+        await data_layer.engine.dispose()
+
+    asyncio.run(main())
+
+
+def make_step(step_id: str, thread_id: str = "t1", **fields):
+    return {
+        "id": step_id,
+        "name": "assistant",
+        "type": "assistant_message",
+        "threadId": thread_id,
+        "output": "",
+        "createdAt": f"2024-01-01T00:00:{step_id[-2:]}Z",
+        **fields,
+    }
+
+
+async def count_steps(data_layer: BatchSQLAlchemyDataLayer) -> int:
+    rows = await data_layer.execute_sql("SELECT COUNT(*) AS n FROM steps", {})
+    return rows[0]["n"]
+
+
+def test_writes_are_batched_and_merged():
+    async def test(data_layer):
+        write_behind = WriteBehindDataLayer(data_layer, flush_interval=60)
+        create_step = unwrapped(write_behind, "create_step")
+        update_step = unwrapped(write_behind, "update_step")
+
+        await write_behind.update_thread("t1", name="Chat")
+        for i in range(10):
+            await create_step(make_step(f"s{i:02}"))
+        await update_step(make_step("s09", output="final answer"))
+
+        assert await count_steps(data_layer) == 0
+        # Pending writes are visible to reads
+        thread = await write_behind.get_thread("t1")
+        assert thread["name"] == "Chat"
+        assert thread["steps"][-1]["output"] == "final answer"
+
+        await write_behind.flush()
+
+        assert await count_steps(data_layer) == 10
+        thread = await data_layer.get_thread("t1")
+        assert thread["steps"][-1]["output"] == "final answer"
+        assert write_behind.stats()["merged"] == 1
+        assert write_behind.stats()["flushes"] == 1
+
+        await write_behind.aclose()
+
+    run_with_data_layer(test)
+
+
+def test_failed_batch_is_replayed_one_by_one():
+    async def test(data_layer):
+        write_behind = WriteBehindDataLayer(data_layer, flush_interval=60)
+        create_step = unwrapped(write_behind, "create_step")
+
+        await create_step(make_step("s01"))
+        # Unknown column, fails the batch transaction
+        await create_step(make_step("s02", unknown_column="x"))
+        await create_step(make_step("s03"))
+
+        await write_behind.flush()
+
+        rows = await data_layer.execute_sql(
+            'SELECT "id" FROM steps ORDER BY "id"', {}
+        )
+        assert [row["id"] for row in rows] == ["s01", "s03"]
+        assert write_behind.stats()["pending"] == 0
+
+        await write_behind.aclose()
+
+    run_with_data_layer(test)
+
+
+def test_aclose_drains_pending_writes():
+    async def test(data_layer):
+        write_behind = WriteBehindDataLayer(data_layer, flush_interval=60)
+        create_step = unwrapped(write_behind, "create_step")
+
+        for i in range(5):
+            await create_step(make_step(f"s{i:02}"))
+        assert await count_steps(data_layer) == 0
+
+        await write_behind.aclose()
+
+        assert await count_steps(data_layer) == 5
+        assert write_behind.stats()["pending"] == 0
+
+        # Written through once closed
+        await create_step(make_step("s05"))
+        assert await count_steps(data_layer) == 6
+
+    run_with_data_layer(test)
+
+
+def test_list_threads_pages_by_keyset():
+    async def test(data_layer):
+        user = await data_layer.create_user(User(identifier="alice"))
+        other = await data_layer.create_user(User(identifier="bob"))
+
+        expected = []
+        for i in range(7):
+            # Pairs of threads created at the same time
+            created_at = f"2024-01-01T00:00:0{i // 2}Z"
+            thread_id = f"t{i}"
+            await data_layer.execute_sql(
+                'INSERT INTO threads ("id", "createdAt", "userId") '
+                "VALUES (:id, :created_at, :user_id)",
+                {
+                    "id": thread_id,
+                    "created_at": created_at,
+                    "user_id": user.id,
+                },
+            )
+            expected.append((created_at, thread_id))
+        await data_layer.execute_sql(
+            'INSERT INTO threads ("id", "createdAt", "userId") '
+            "VALUES ('other', '2024-01-01T00:00:09Z', :user_id)",
+            {"user_id": other.id},
+        )
+        expected = [
+            thread_id for _, thread_id in sorted(expected, reverse=True)
+        ]
+
+        listed = []
+        cursor = None
+        while True:
+            page = await data_layer.list_threads(
+                Pagination(first=3, cursor=cursor),
+                ThreadFilter(userId=user.id),
+            )
+            listed += [thread["id"] for thread in page.data]
+            assert all(thread["steps"] == [] for thread in page.data)
+            if not page.pageInfo.hasNextPage:
+                break
+            cursor = page.pageInfo.endCursor
+
+        assert listed == expected
+
+    run_with_data_layer(test)
+
+
+def test_list_threads_goes_on_after_the_cursor_thread_is_deleted():
+    async def test(data_layer):
+        user = await data_layer.create_user(User(identifier="alice"))
+        for i in range(4):
+            await data_layer.execute_sql(
+                'INSERT INTO threads ("id", "createdAt", "userId") '
+                "VALUES (:id, :created_at, :user_id)",
+                {
+                    "id": f"t{i}",
+                    "created_at": f"2024-01-01T00:00:0{i}Z",
+                    "user_id": user.id,
+                },
+            )
+        filters = ThreadFilter(userId=user.id)
+
+        page = await data_layer.list_threads(Pagination(first=2), filters)
+        assert [thread["id"] for thread in page.data] == ["t3", "t2"]
+
+        await data_layer.delete_thread("t2")
+        page = await data_layer.list_threads(
+            Pagination(first=2, cursor=page.pageInfo.endCursor), filters
+        )
+
+        assert [thread["id"] for thread in page.data] == ["t1", "t0"]
+
+    run_with_data_layer(test)
+
+
+def test_thread_cache_is_dropped_on_thread_writes():
+    async def test(data_layer):
+        cached = CachedDataLayer(data_layer)
+        user = await data_layer.create_user(User(identifier="alice"))
+        filters = ThreadFilter(userId=user.id)
+
+        async def list_names():
+            page = await cached.list_threads(Pagination(first=10), filters)
+            return [thread["name"] for thread in page.data]
+
+        await cached.update_thread("t1", name="First", user_id=user.id)
+        assert await list_names() == ["First"]
+        assert (await cached.get_thread("t1"))["name"] == "First"
+
+        # Renamed behind the cache, which serves the cached copies
+        await data_layer.update_thread("t1", name="Behind")
+        assert await list_names() == ["First"]
+        assert (await cached.get_thread("t1"))["name"] == "First"
+
+        # The owner of the thread is known from the listing
+        await cached.update_thread("t1", name="Renamed")
+        assert await list_names() == ["Renamed"]
+        assert (await cached.get_thread("t1"))["name"] == "Renamed"
+
+        await cached.delete_thread("t1")
+        assert await list_names() == []
+        assert await cached.get_thread("t1") is None
+        assert cached.stats()["hits"] == 2
+
+    run_with_data_layer(test)
+
+
+def test_thread_cache_keeps_pages_of_other_users():
+    async def test(data_layer):
+        cached = CachedDataLayer(data_layer)
+        alice = await data_layer.create_user(User(identifier="alice"))
+        bob = await data_layer.create_user(User(identifier="bob"))
+
+        await cached.update_thread("a1", name="Alice", user_id=alice.id)
+        await cached.update_thread("b1", name="Bob", user_id=bob.id)
+        for user in (alice, bob):
+            await cached.list_threads(
+                Pagination(first=10), ThreadFilter(userId=user.id)
+            )
+
+        await cached.update_thread("a1", name="Alice renamed")
+        await cached.list_threads(
+            Pagination(first=10), ThreadFilter(userId=bob.id)
+        )
+        page = await cached.list_threads(
+            Pagination(first=10), ThreadFilter(userId=alice.id)
+        )
+
+        assert page.data[0]["name"] == "Alice renamed"
+        assert cached.stats()["hits"] == 1
+
+    run_with_data_layer(test)
@@ -0,0 +1,63 @@
+import logging
+
+from libs.logging_helper import RateLimitFilter
+
+
+def make_record(msg, **extra) -> logging.LogRecord:
+    record = logging.LogRecord(
+        "test", logging.DEBUG, "app.py", 1, msg, None, None
+    )
+    record.__dict__.update(extra)
+    return record
+
+
+def test_rate_limit_applies_to_the_keys_given_only():
+    rate_limit = RateLimitFilter({"Streaming event": 2}, {})
+
+    passed = [
+        rate_limit.filter(make_record({"msg": "Streaming event"}))
+        for _ in range(5)
+    ]
+
+    assert passed == [True, True, False, False, False]
+    assert all(
+        rate_limit.filter(make_record({"msg": "Other event"}))
+        for _ in range(5)
+    )
+
+
+def test_next_record_carries_the_dropped_count():
+    rate_limit = RateLimitFilter({}, {"Streaming event": 0})
+
+    assert not rate_limit.filter(make_record({"msg": "Streaming event"}))
+    assert not rate_limit.filter(make_record({"msg": "Streaming event"}))
+
+    rate_limit.sample_rates = {}
+    rate_limit.rate_limits = {"Streaming event": 1}
+    record = make_record({"msg": "Streaming event"})
+    assert rate_limit.filter(record)
+    assert record.dropped == 2
+
+
+def test_lazy_record_is_limited_by_its_msg():
+    rate_limit = RateLimitFilter({"Response body": 1}, {})
+
+    first = make_record(lambda: {"msg": "Response body", "body": "..."})
+    second = make_record(lambda: {"msg": "Response body", "body": "..."})
+
+    assert rate_limit.filter(first)
+    assert first.msg["body"] == "..."
+    assert not rate_limit.filter(second)
+
+
+def test_lazy_record_with_a_log_key_is_not_resolved_when_dropped():
+    rate_limit = RateLimitFilter({"Response body": 1}, {})
+    calls = []
+
+    def message():
+        calls.append(1)
+        return {"msg": "Response body"}
+
+    assert rate_limit.filter(make_record(message, log_key="Response body"))
+    assert not rate_limit.filter(make_record(message, log_key="Response body"))
+    assert calls == []
@@ -0,0 +1,114 @@
+import asyncio
+
+from langchain_core.messages import AIMessage
+from langchain_core.messages import HumanMessage
+from langchain_core.messages import SystemMessage
+
+from apps.memory import IndexedChatMessageHistory
+from apps.memory import SessionMemoryStore
+from apps.memory import to_pending_record
+
+
+def make_chat(turns: int):
+    messages = [SystemMessage(content="system", additional_kwargs={"id": "s"})]
+    for i in range(turns):
+        messages.append(
+            HumanMessage(
+                content=f"question {i}", additional_kwargs={"id": f"h{i}"}
+            )
+        )
+        messages.append(
+            AIMessage(content=f"answer {i}", additional_kwargs={"id": f"a{i}"})
+        )
+    return messages
+
+
+def resume(messages, max_messages: int) -> IndexedChatMessageHistory:
+    split = max(len(messages) - max_messages, 0)
+    return IndexedChatMessageHistory(
+        messages=messages[split:],
+        older=map(to_pending_record, messages[:split]),
+    )
+
+
+def test_window_keeps_system_message_of_capped_resume():
+    history = resume(make_chat(50), 4)
+
+    messages, _ = history.window(50)
+
+    assert messages[0].content == "system"
+    assert messages[-1].content == "answer 49"
+    assert len(history.older) > 0
+
+
+def test_page_in_keeps_order_after_system_message():
+    messages = make_chat(10)
+    history = resume(messages, 4)
+
+    history.page_in(None)
+
+    assert [m.content for m in history.messages] == [
+        m.content for m in messages
+    ]
+
+
+def test_edit_of_older_message_pages_it_in():
+    history = resume(make_chat(10), 4)
+
+    index = history.index_of("h2")
+
+    assert index is not None
+    assert history.messages[index].content == "question 2"
+    assert not history.older
+    history.truncate(index)
+    assert history.last_message.content == "answer 1"
+
+
+def test_new_message_is_not_looked_up_in_older_messages():
+    history = resume(make_chat(10), 4)
+
+    assert history.index_of("unknown") is None
+    assert len(history.older) > 0
+
+
+def test_store_keeps_a_running_total_of_hot_messages(tmp_path):
+    store = SessionMemoryStore(db_path=str(tmp_path / "memory.sqlite"))
+    store.set("a", IndexedChatMessageHistory(messages=make_chat(2)))
+    store.set("b", IndexedChatMessageHistory(messages=make_chat(3)))
+
+    assert store.hot_messages == 5 + 7
+
+    history = store.get_cached("a")
+    history.add_message(HumanMessage(content="question 2"))
+    store.get_cached("a")
+    assert store.hot_messages == 6 + 7
+
+    store.discard("b")
+    assert store.hot_messages == 6
+    store.close()
+
+
+def test_store_spills_least_recently_used_sessions(tmp_path):
+    store = SessionMemoryStore(
+        max_messages=10, db_path=str(tmp_path / "memory.sqlite")
+    )
+
+    async def main():
+        for session_id in ("a", "b", "c"):
+            store.set(
+                session_id, IndexedChatMessageHistory(messages=make_chat(2))
+            )
+        await store.spill()
+
+        assert store.get_cached("a") is None
+        assert store.hot_messages == 10
+
+        history = await store.aget("a")
+        assert [m.content for m in history.messages] == [
+            m.content for m in make_chat(2)
+        ]
+        assert store.hot_messages == 15
+        assert store.stats()["rehydrations"] == 1
+
+    asyncio.run(main())
+    store.close()
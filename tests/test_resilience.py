@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+import pytest
+
+from services.sentinel.resilience import AttemptCancelledError
+from services.sentinel.resilience import CircuitBreaker
+from services.sentinel.resilience import CircuitOpenError
+from services.sentinel.resilience import Hedger
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.check()
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=60)
+
+    breaker.check()
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_success()
+    open_breaker(breaker)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    assert breaker.stats()["rejected"] == 1
+    assert breaker.stats()["times_opened"] == 1
+
+
+def test_half_open_breaker_lets_a_single_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=60)
+    open_breaker(breaker)
+    breaker.opened_at = time.monotonic() - 60
+
+    breaker.check()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.check()
+
+
+def test_failed_trial_opens_the_breaker_again():
+    breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=60)
+    open_breaker(breaker)
+    breaker.opened_at = time.monotonic() - 60
+
+    breaker.check()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_released_trial_lets_the_next_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=60)
+    open_breaker(breaker)
+    breaker.opened_at = time.monotonic() - 60
+
+    breaker.check()
+    breaker.release()
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.check()
+
+
+def make_hedger(latency: float) -> Hedger:
+    hedger = Hedger(min_samples=1, min_delay=0.01)
+    hedger.record(latency)
+    return hedger
+
+
+def test_hedger_does_not_hedge_without_samples():
+    hedger = Hedger(min_samples=2)
+    hedger.record(0.01)
+    attempts = []
+
+    async def fn():
+        attempts.append(1)
+        return "ok"
+
+    assert asyncio.run(hedger.run(fn)) == "ok"
+    assert len(attempts) == 1
+    assert hedger.stats()["hedges"] == 0
+
+
+def test_hedged_attempt_wins_over_a_slow_first_attempt():
+    hedger = make_hedger(0.01)
+    delays = [1.0, 0.0]
+
+    async def fn():
+        delay = delays.pop(0)
+        await asyncio.sleep(delay)
+        return delay
+
+    assert asyncio.run(hedger.run(fn)) == 0.0
+    assert hedger.stats()["hedges"] == 1
+    assert hedger.stats()["hedge_wins"] == 1
+
+
+def test_hedger_raises_when_every_attempt_fails():
+    hedger = make_hedger(0.01)
+
+    async def fn():
+        await asyncio.sleep(0.02)
+        raise ValueError("down")
+
+    with pytest.raises(ValueError):
+        asyncio.run(hedger.run(fn))
+
+
+def test_cancelled_attempt_fails_without_cancelling_the_caller():
+    hedger = make_hedger(0.01)
+    outcomes = [asyncio.CancelledError, ValueError]
+
+    async def fn():
+        await asyncio.sleep(0.02)
+        raise outcomes.pop(0)()
+
+    with pytest.raises(ValueError):
+        asyncio.run(hedger.run(fn))
+
+    hedger = make_hedger(0.01)
+
+    async def cancelled():
+        await asyncio.sleep(0.02)
+        raise asyncio.CancelledError()
+
+    with pytest.raises(AttemptCancelledError):
+        asyncio.run(hedger.run(cancelled))
@@ -0,0 +1,91 @@
+import asyncio
+
+import httpx
+from tenacity import Future
+from tenacity import RetryError
+
+from services.sentinel import resilience
+from services.sentinel import sentinel
+from services.sentinel.client import SentinelAPIError
+
+
+def test_fail_policy_blocks_on_fail_closed_guardrails(monkeypatch):
+    monkeypatch.setattr(sentinel, "SENTINEL_DEFAULT_FAIL_POLICY", "closed")
+    monkeypatch.setattr(sentinel, "SENTINEL_FAIL_POLICIES", {"toxic": "open"})
+
+    passed, message = sentinel.apply_fail_policy(
+        {"jailbreak": {}, "toxic": {}}, TimeoutError()
+    )
+
+    assert not passed
+    assert "jailbreak" in message
+    assert "toxic" not in message
+
+
+def test_fail_policy_passes_when_every_guardrail_fails_open(monkeypatch):
+    monkeypatch.setattr(sentinel, "SENTINEL_DEFAULT_FAIL_POLICY", "open")
+    monkeypatch.setattr(sentinel, "SENTINEL_FAIL_POLICIES", {})
+
+    assert sentinel.apply_fail_policy({"jailbreak": {}}, TimeoutError()) == (
+        True,
+        None,
+    )
+
+
+def test_only_timeouts_connection_errors_and_5xx_are_upstream_failures():
+    assert sentinel.is_upstream_failure(asyncio.TimeoutError())
+    assert sentinel.is_upstream_failure(httpx.ConnectError("refused"))
+    assert sentinel.is_upstream_failure(SentinelAPIError("error", 503))
+    assert not sentinel.is_upstream_failure(SentinelAPIError("invalid", 422))
+    assert not sentinel.is_upstream_failure(ValueError())
+
+
+def test_retry_error_is_judged_by_its_last_attempt():
+    def retry_error(error: Exception) -> RetryError:
+        return RetryError(Future.construct(1, error, has_exception=True))
+
+    assert sentinel.is_upstream_failure(
+        retry_error(SentinelAPIError("error", 500))
+    )
+    assert not sentinel.is_upstream_failure(
+        retry_error(SentinelAPIError("invalid", 400))
+    )
+
+
+def call_with_error(monkeypatch, error: Exception, text: str):
+    async def request(**kwargs):
+        raise error
+
+    async def main():
+        try:
+            await sentinel.acall_sentinel_api(text, {"jailbreak": {}}, None)
+        except Exception as e:
+            return e
+
+    monkeypatch.setattr(sentinel, "_request_sentinel_api", request)
+    return asyncio.run(main())
+
+
+def test_breaker_ignores_rejected_requests(monkeypatch):
+    breaker = resilience.CircuitBreaker(failure_threshold=2)
+    monkeypatch.setattr(sentinel, "breaker", breaker)
+
+    for i in range(4):
+        call_with_error(
+            monkeypatch, SentinelAPIError("invalid", 422), f"rejected {i}"
+        )
+
+    assert breaker.state == breaker.CLOSED
+
+    for i in range(2):
+        call_with_error(
+            monkeypatch, SentinelAPIError("error", 502), f"failed {i}"
+        )
+
+    assert breaker.state == breaker.OPEN
+    assert isinstance(
+        call_with_error(
+            monkeypatch, SentinelAPIError("error", 502), "short-circuited"
+        ),
+        resilience.CircuitOpenError,
+    )
@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from services.sentinel.singleflight import SingleFlight
+
+
+def test_concurrent_calls_with_the_same_key_share_one_call():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(
+            *(single_flight.do("key", fn) for _ in range(5)),
+            single_flight.do("other", fn),
+        )
+
+    assert asyncio.run(main()) == ["result"] * 6
+    assert len(calls) == 2
+    assert single_flight.stats() == {
+        "in_flight": 0,
+        "calls": 2,
+        "coalesced": 4,
+    }
+
+
+def test_every_caller_gets_the_exception():
+    single_flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        raise ValueError("down")
+
+    async def main():
+        return await asyncio.gather(
+            *(single_flight.do("key", fn) for _ in range(3)),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert len({id(result) for result in results}) == 1
+
+
+def test_cancelled_caller_does_not_cancel_the_call_for_others():
+    single_flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        first = asyncio.create_task(single_flight.do("key", fn))
+        second = asyncio.create_task(single_flight.do("key", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == "result"
+
+
+def test_later_calls_start_a_new_call():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        return [await single_flight.do("key", fn) for _ in range(2)]
+
+    assert asyncio.run(main()) == [1, 2]